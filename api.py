@@ -4,10 +4,14 @@ import json
 import logging
 
 from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 from fhir.resources.R4B.operationoutcome import OperationOutcome
 
+import metrics
+from helpers import token_manager
 from models import JWKS
-from resourceHandler import return_patient
+from resourceHandler import read_flights, resource_cache, return_patient, search_cache, search_flights
 
 logger: logging.Logger = logging.getLogger("main.api")
 
@@ -15,7 +19,7 @@ api_router: APIRouter = APIRouter()
 
 
 @api_router.get("/")
-def return_root() -> dict:
+async def return_root() -> dict:
     """Root function of the API"""
     logger.info("Retrieved root of API")
     return OperationOutcome(
@@ -24,24 +28,49 @@ def return_root() -> dict:
 
 
 @api_router.get("/favicon.ico")
-def return_favicon() -> None:
+async def return_favicon() -> None:
     return None
 
 
 @api_router.get("/health")
-def return_health_check() -> dict:
+async def return_health_check() -> dict:
     return {"status": "FHIR Proxy is ready to receive requests"}
 
 
 @api_router.get("/get_resource_health")
-def return_home_data() -> OperationOutcome | dict:
+async def return_home_data() -> Response:
     """Testing function to get a Patient"""
-    return return_patient("e63wRTbPfr1p8UW81d8Seiw3")
+    return await return_patient("e63wRTbPfr1p8UW81d8Seiw3")
 
 
-@api_router.get("/jwks", response_model=JWKS)
-def return_jwks() -> JWKS:
-    with open("jwks.json", "r") as fo:
-        jwks_obj: dict = json.load(fo)
+@api_router.get("/cache_stats")
+async def return_cache_stats() -> dict:
+    """Hit, miss and eviction counters for the resource and search caches, and how many requests were coalesced onto an in-flight one"""
+    return {
+        "resources": await run_in_threadpool(resource_cache.stats),
+        "searches": await run_in_threadpool(search_cache.stats),
+        "coalesced_reads": read_flights.stats(),
+        "coalesced_searches": search_flights.stats(),
+    }
+
+
+@api_router.get("/token_stats")
+async def return_token_stats() -> dict:
+    """Refresh latency and failure counters for the access token"""
+    return token_manager.stats()
+
+
+@api_router.get("/metrics")
+async def return_metrics() -> Response:
+    """Prometheus metrics for this worker, rendered in the threadpool since the cache stats can read the SQLite cache"""
+    return Response(content=await run_in_threadpool(metrics.render_metrics), media_type=metrics.metrics_content_type)
 
-    return JWKS(**jwks_obj)
+
+# Read once when the app starts, the file only changes with a redeploy
+with open("jwks.json", "r") as fo:
+    jwks: JWKS = JWKS(**json.load(fo))
+
+
+@api_router.get("/jwks", response_model=JWKS)
+async def return_jwks() -> JWKS:
+    return jwks
@@ -2,17 +2,23 @@
 
 import json
 import logging
+import re
 import time
+from collections.abc import AsyncIterator, Callable
 
 import httpx
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
-from fhir.resources.R4B.bundle import Bundle
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from fhir.resources.R4B.operationoutcome import OperationOutcome
 
+import metrics
+import upstream
+from compression import accepts, encodings, stream_decompressor
 from helpers import check_response
 from models import JWKS
-from util import fhir_auth, fhir_url
+from serializer import FastJSONResponse
+from util import fhir_auth, fhir_url, passthrough_log_totals, passthrough_scan_bytes
 
 logger: logging.Logger = logging.getLogger("main.api_passthrough")
 
@@ -20,17 +26,17 @@ api_passthrough_router: APIRouter = APIRouter()
 
 
 @api_passthrough_router.get("/favicon.ico")
-def return_favicon():
+async def return_favicon():
     return None
 
 
 @api_passthrough_router.get("/health")
-def return_health_check() -> dict:
+async def return_health_check() -> dict:
     return {"status": "FHIR Proxy is ready to receive requests"}
 
 
 @api_passthrough_router.get("/")
-def return_root() -> dict:
+async def return_root() -> dict:
     """Root function of the API"""
     logger.info("Retrieved root of API")
     return OperationOutcome(
@@ -38,71 +44,112 @@ def return_root() -> dict:
     ).model_dump(exclude_none=True)
 
 
+@api_passthrough_router.get("/metrics")
+async def return_metrics() -> Response:
+    """Prometheus metrics for this worker, rendered in the threadpool since the cache stats can read the SQLite cache"""
+    return Response(content=await run_in_threadpool(metrics.render_metrics), media_type=metrics.metrics_content_type)
+
+
+# Read once when the app starts, the file only changes with a redeploy
+with open("jwks.json", "r") as fo:
+    jwks: JWKS = JWKS(**json.load(fo))
+
+
 @api_passthrough_router.get("/jwks", response_model=JWKS)
-def return_jwks() -> JWKS:
-    with open("jwks.json", "r") as fo:
-        jwks_obj: dict = json.load(fo)
+async def return_jwks() -> JWKS:
+    return jwks
 
-    return JWKS(**jwks_obj)
 
+not_json_outcome: OperationOutcome = OperationOutcome(
+    issue=[{"severity": "error", "code": "processing", "diagnostics": "The response returned from the FHIR_URL was not JSON parseable, please see logs for what the server responded"}]
+)
 
-@api_passthrough_router.get("/{resource_type}/{id}", response_model=dict)
-def return_resource_by_id(resource_type: str, id: str) -> OperationOutcome | JSONResponse | dict:
-    """Function for reading a resource given its id"""
+relayed_headers: tuple[str, ...] = ("content-type", "etag", "last-modified", "cache-control", "location", "content-location", "www-authenticate")
 
-    start_time = time.time()
-    logger.info(f"Reading {resource_type} Resource with ID: {id}")
-    query_headers = {"Accept": "application/json"}
+total_pattern: re.Pattern[bytes] = re.compile(rb'"total"\s*:\s*(\d+)')
 
-    if fhir_auth:
-        query_headers["Authorization"] = fhir_auth
 
-    resource_read = httpx.get(fhir_url + f"{resource_type}/{id}", headers=query_headers)
+async def relay_body(resp: httpx.Response, resource_type: str, start_time: float, encoding: str | None = None) -> AsyncIterator[bytes]:
+    """
+    Yields the upstream body as it arrives, only looking at the first few KB when logging Bundle totals is turned on
 
-    check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=resource_read)
-    if check_output:
-        return JSONResponse(check_output.model_dump(exclude_none=True), status_code=resource_read.status_code)
+    With an encoding the body is relayed still compressed, and only the start of it is decompressed to look for the total.
+    """
 
+    head: bytes = b""
+    size: int = 0
+    decompressor: Callable[[bytes], bytes] | None = stream_decompressor(encoding) if encoding and passthrough_log_totals else None
     try:
-        logger.debug(f"External call took {round(resource_read.elapsed.total_seconds(), 4)} seconds")
-        logger.debug(f"This call took {round(time.time() - start_time, 4)} seconds")
-        return JSONResponse(resource_read.json(), status_code=resource_read.status_code)
-    except json.JSONDecodeError:
-        logger.error(f"Status Code: {resource_read.status_code}")
-        logger.error(f"Response Text: {resource_read.text}")
-        return OperationOutcome(
-            issue=[{"severity": "error", "code": "processing", "diagnostics": "The response returned from the FHIR_URL was not JSON parseable, please see logs for what the server responded"}]
-        )
+        async for chunk in resp.aiter_raw() if encoding else resp.aiter_bytes():
+            if passthrough_log_totals and len(head) < passthrough_scan_bytes:
+                head += (decompressor(chunk) if decompressor else chunk)[: passthrough_scan_bytes - len(head)]
+            size += len(chunk)
+            yield chunk
+    finally:
+        await resp.aclose()
 
+    if passthrough_log_totals:
+        total_match: re.Match[bytes] | None = total_pattern.search(head)
+        logger.info("Found %s %s resources and returned %s bytes", total_match.group(1).decode() if total_match else "unknown", resource_type, size)
+    logger.debug("External call took %.4f seconds", upstream.elapsed_seconds(resp))
+    logger.debug("This call took %.4f seconds", time.time() - start_time)
 
-@api_passthrough_router.get("/{resource_type}", response_model_exclude_none=True, response_model=dict)
-def return_resource(resource_type: str, req: Request) -> OperationOutcome | JSONResponse | Bundle:
-    start_time = time.time()
-    search_params = dict(req.query_params)
-    query_string = resource_type + "?" + req.url.query
 
-    logger.info(f"Searching {resource_type} with Parameters: {search_params}")
+async def relay_response(resource_type: str, url: str, start_time: float, accept_encoding: str = "") -> Response:
+    """
+    Streams the upstream response to the client without parsing it, unless the upstream returned an error or something that is not JSON
+
+    A compressed upstream body is relayed without decompressing it when the client accepts the same Content-Encoding.
+    """
+
     query_headers = {"Accept": "application/json"}
 
     if fhir_auth:
         query_headers["Authorization"] = fhir_auth
 
-    resp: httpx.Response = httpx.get(fhir_url + query_string, headers=query_headers)
+    resp: httpx.Response = await upstream.stream_get(url, headers=query_headers)
 
-    check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=resp)
-    if check_output:
-        return JSONResponse(check_output, status_code=resp.status_code)
+    if resp.status_code != 200:
+        await resp.aread()
+        await resp.aclose()
+        check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=resp)
+        if check_output:
+            return FastJSONResponse(check_output.model_dump(exclude_none=True), status_code=resp.status_code)
+        return Response(content=resp.content, status_code=resp.status_code, headers={key: resp.headers[key] for key in relayed_headers if key in resp.headers})
 
-    try:
-        logger.info(
-            f"Found {resp.json()['total'] if 'total' in resp.json() else 'unknown'} {resource_type} resources and returning a Bundle of {len(resp.json()['entry']) if 'entry' in resp.json() else 0} resources"
-        )
-        logger.debug(f"External call took {round(resp.elapsed.total_seconds(), 4)} seconds")
-        logger.debug(f"This call took {round(time.time() - start_time, 4)} seconds")
-        return JSONResponse(resp.json(), status_code=resp.status_code)
-    except json.JSONDecodeError:
+    if "json" not in resp.headers.get("content-type", ""):
+        await resp.aread()
+        await resp.aclose()
         logger.error(f"Status Code: {resp.status_code}")
         logger.error(f"Response Text: {resp.text}")
-        return OperationOutcome(
-            issue=[{"severity": "error", "code": "processing", "diagnostics": "The response returned from the FHIR_URL was not JSON parseable, please see logs for what the server responded"}]
-        )
+        return FastJSONResponse(not_json_outcome.model_dump(exclude_none=True))
+
+    headers: dict[str, str] = {key: resp.headers[key] for key in relayed_headers if key in resp.headers}
+    encoding: str | None = resp.headers.get("content-encoding")
+    if encoding in encodings and accepts(accept_encoding, encoding):
+        headers["content-encoding"] = encoding
+    else:
+        encoding = None
+
+    return StreamingResponse(relay_body(resp, resource_type=resource_type, start_time=start_time, encoding=encoding), status_code=resp.status_code, headers=headers)
+
+
+@api_passthrough_router.get("/{resource_type}/{id}", response_model=dict)
+async def return_resource_by_id(resource_type: str, id: str, req: Request) -> Response:
+    """Function for reading a resource given its id"""
+
+    start_time = time.time()
+    logger.info("Reading %s Resource with ID: %s", resource_type, id)
+
+    return await relay_response(resource_type=resource_type, url=fhir_url + f"{resource_type}/{id}", start_time=start_time, accept_encoding=req.headers.get("accept-encoding", ""))
+
+
+@api_passthrough_router.get("/{resource_type}", response_model_exclude_none=True, response_model=dict)
+async def return_resource(resource_type: str, req: Request) -> Response:
+    start_time = time.time()
+    search_params = dict(req.query_params)
+    query_string = resource_type + "?" + req.url.query
+
+    logger.info("Searching %s with Parameters: %s", resource_type, search_params)
+
+    return await relay_response(resource_type=resource_type, url=fhir_url + query_string, start_time=start_time, accept_encoding=req.headers.get("accept-encoding", ""))
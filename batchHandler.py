@@ -0,0 +1,107 @@
+"""File for running the GET entries of a FHIR batch Bundle concurrently"""
+
+import asyncio
+import logging
+import re
+from http import HTTPStatus
+from typing import Annotated
+
+from fastapi import APIRouter, Body, Request
+from fastapi.responses import Response
+from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+from cache import CacheEntry
+from query import SearchQuery
+from resilience import UpstreamUnavailable
+from resourceHandler import accept_header_value, all_pages_param, get_resource_entry, get_search_entry
+from serializer import FastJSONResponse, dumps
+from util import batch_concurrency, deploy_url, fhir_url
+
+logger: logging.Logger = logging.getLogger("main.batchHandler")
+
+batch_router: APIRouter = APIRouter()
+
+# A read like Patient/123 or a search like Observation, ids follow the FHIR id rules
+entry_path_pattern: re.Pattern = re.compile(r"[A-Za-z]+(/[A-Za-z0-9\-.]{1,64})?")
+
+
+def outcome(status_code: int, diagnostics: str, code: str = "processing") -> tuple[int, bytes]:
+    return status_code, dumps({"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": code, "diagnostics": diagnostics}]})
+
+
+def response_entry(status_code: int, body: bytes) -> bytes:
+    """A batch-response entry, successful results go in resource and errors in response.outcome, the body is inserted as is to avoid parsing it again"""
+
+    status: bytes = f'"{status_code} {HTTPStatus(status_code).phrase}"'.encode()
+    if status_code < 300:
+        return b'{"resource":' + body + b',"response":{"status":' + status + b"}}"
+    return b'{"response":{"status":' + status + b',"outcome":' + body + b"}}"
+
+
+def relative_url(url: str) -> str:
+    """Batch entry urls are usually relative, like Patient/123, but may also start with the proxy or FHIR server base"""
+
+    for base in (deploy_url.rstrip("/") + "/", fhir_url):
+        if url.startswith(base):
+            return url[len(base) :]
+    return url.lstrip("/")
+
+
+async def run_entry(entry: dict, cache_control: str) -> tuple[int, bytes]:
+    """Runs one batch entry through the same read and search handling as a GET, returning the status code and body"""
+
+    request: dict = entry.get("request") or {}
+    if request.get("method") != "GET":
+        return outcome(405, f"Batch entries must be GET requests, not {request.get('method')}", "not-supported")
+    if not request.get("url"):
+        return outcome(400, "Batch entry is missing request.url", "required")
+
+    path, _, query = relative_url(request["url"]).partition("?")
+    if not entry_path_pattern.fullmatch(path):
+        return outcome(400, f"Batch entry url {request['url']} is not a read or a search", "not-supported")
+    search_query: SearchQuery = SearchQuery.parse(path.partition("/")[0], query)
+    if search_query.get(all_pages_param) is not None:
+        return outcome(400, f"{all_pages_param} is not supported in a batch", "not-supported")
+
+    output: CacheEntry | OperationOutcome
+    resource_type, _, id = path.partition("/")
+    if id:
+        output = await get_resource_entry(resource_type, id)
+    else:
+        output = await get_search_entry(search_query, cache_control)
+
+    if isinstance(output, OperationOutcome):
+        return 500, output.model_dump_json(exclude_none=True).encode("utf-8")
+    return output.status_code, output.content
+
+
+@batch_router.post("/")
+async def process_batch(req: Request, bundle: Annotated[dict, Body()]) -> Response:
+    """
+    Runs the GET entries of a FHIR batch Bundle, at most BATCH_CONCURRENCY at once, and returns a batch-response Bundle
+
+    Each entry goes through the same caches and reference expansion as the matching read or search and gets its own status. Entries that fail have an OperationOutcome
+    in response.outcome and do not affect the other entries.
+    """
+
+    if bundle.get("resourceType") != "Bundle" or bundle.get("type") != "batch":
+        return FastJSONResponse(outcome(400, "The request body must be a Bundle of type batch", "invalid")[1], status_code=400)
+
+    entries: list[dict] = bundle.get("entry") or []
+    cache_control: str = req.headers.get("cache-control", "")
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(batch_concurrency)
+    logger.info(f"Running a batch of {len(entries)} entries")
+
+    async def run(entry: dict) -> bytes:
+        async with semaphore:
+            try:
+                return response_entry(*await run_entry(entry, cache_control))
+            except UpstreamUnavailable as exc:
+                return response_entry(*outcome(503, str(exc), "transient"))
+            except Exception as exc:
+                logger.error(f"Batch entry {entry.get('request', {}).get('url')} failed: {exc}")
+                return response_entry(*outcome(500, f"The request failed: {exc}", "exception"))
+
+    response_entries: list[bytes] = await asyncio.gather(*(run(entry) for entry in entries))
+
+    return Response(content=b'{"resourceType":"Bundle","type":"batch-response","entry":[' + b",".join(response_entries) + b"]}", media_type=accept_header_value)
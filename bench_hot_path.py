@@ -0,0 +1,278 @@
+"""
+Micro-benchmarks for the proxy hot path
+
+Every stage runs against Epic-shaped Patient and Observation payloads with the FHIR server replaced by an httpx.MockTransport, so the numbers are the
+proxy's own CPU cost per request. Results are written as JSON so runs can be compared, e.g. after upgrading fhir.resources or fhirsearchhelper:
+
+    python bench_hot_path.py --output bench_results.json
+    python bench_hot_path.py --compare bench_results.json --threshold 1.25
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any
+
+os.environ.setdefault("CLIENT_ID", "benchmark")
+os.environ.setdefault("SCOPE", "system/*.read")
+os.environ.setdefault("FHIR_URL", "https://fhir.example.org/api/FHIR/R4/")
+os.environ.setdefault("FHIR_AUTH", "Bearer benchmark")
+
+import httpx
+from fhir.resources.R4B.patient import Patient
+
+import upstream
+from helpers import check_response, create_search_query
+from models import ObservationSearchParams
+from serializer import FastJSONResponse
+from util import fhir_url
+
+
+def epic_patient(patient_id: str = "e63wRTbPfr1p8UW81d8Seiw3") -> dict:
+    return {
+        "resourceType": "Patient",
+        "id": patient_id,
+        "extension": [
+            {"url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-birthsex", "valueCode": "F"},
+            {
+                "url": "http://open.epic.com/FHIR/StructureDefinition/extension/legal-sex",
+                "valueCodeableConcept": {"coding": [{"system": "urn:oid:1.2.840.114350.1.13.0.1.7.10.698084.130.657370.19999000", "code": "female"}]},
+            },
+        ],
+        "identifier": [
+            {"use": "usual", "type": {"text": "EPI"}, "system": "urn:oid:1.2.840.114350.1.13.0.1.7.5.737384.0", "value": "E4007"},
+            {"use": "usual", "system": "urn:oid:2.16.840.1.113883.4.1", "value": "xxx-xx-1234"},
+        ],
+        "active": True,
+        "name": [{"use": "official", "text": "Allison Mychart", "family": "Mychart", "given": ["Allison"]}],
+        "telecom": [{"system": "phone", "value": "608-123-4567", "use": "home"}, {"system": "email", "value": "allison@example.org", "rank": 1}],
+        "gender": "female",
+        "birthDate": "1987-09-12",
+        "address": [{"use": "home", "line": ["123 Main St."], "city": "Madison", "district": "DANE", "state": "WI", "postalCode": "53703", "country": "US"}],
+        "generalPractitioner": [{"reference": "Practitioner/eM5CWtq15N0WJeuCet5bJlQ3", "type": "Practitioner", "display": "Physician Family Medicine, MD"}],
+    }
+
+
+def epic_observation(index: int, patient_id: str = "e63wRTbPfr1p8UW81d8Seiw3") -> dict:
+    code: str = "4548-4" if index % 3 == 0 else "2345-7"
+    return {
+        "fullUrl": f"{fhir_url}Observation/eGd2eIVGc0u6-obs{index}",
+        "resource": {
+            "resourceType": "Observation",
+            "id": f"eGd2eIVGc0u6-obs{index}",
+            "basedOn": [{"reference": "ServiceRequest/eB6bFU.qZ5E4FB6XqPiVsWQ3", "display": "Hemoglobin A1c"}],
+            "status": "final",
+            "category": [
+                {
+                    "coding": [
+                        {"system": "urn:oid:1.2.840.114350.1.13.0.1.7.10.798268.30", "code": "Lab"},
+                        {"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "laboratory", "display": "Laboratory"},
+                    ],
+                    "text": "Laboratory",
+                }
+            ],
+            "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": "Hemoglobin A1c"}], "text": "Hemoglobin A1c"},
+            "subject": {"reference": f"Patient/{patient_id}", "display": "Mychart, Allison"},
+            "effectiveDateTime": f"2023-{(index % 12) + 1:02d}-15T14:05:00Z",
+            "issued": f"2023-{(index % 12) + 1:02d}-15T16:13:00Z",
+            "performer": [{"reference": "Organization/enRyWnSP963FYDpoks4NHOA3", "display": "Epic Lab"}],
+            "valueQuantity": {"value": 5.0 + (index % 10) / 10, "unit": "%", "system": "http://unitsofmeasure.org", "code": "%"},
+            "interpretation": [{"coding": [{"system": "urn:oid:1.2.840.114350.1.13.0.1.7.10.798268.500", "code": "N"}], "text": "Normal"}],
+            "referenceRange": [{"low": {"value": 4.0, "unit": "%"}, "high": {"value": 5.6, "unit": "%"}, "text": "4.0 - 5.6 %"}],
+        },
+        "search": {"mode": "match"},
+    }
+
+
+def epic_observation_bundle(entries: int) -> dict:
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": entries,
+        "link": [{"relation": "self", "url": f"{fhir_url}Observation?patient=e63wRTbPfr1p8UW81d8Seiw3&category=laboratory"}],
+        "entry": [epic_observation(index) for index in range(entries)],
+    }
+
+
+def mock_fhir_server(bundle_entries: int) -> httpx.MockTransport:
+    patient: dict = epic_patient()
+    bundle_bytes: bytes = json.dumps(epic_observation_bundle(bundle_entries)).encode()
+    not_found: dict = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found", "diagnostics": "The resource could not be found."}]}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/Observation"):
+            return httpx.Response(200, content=bundle_bytes, headers={"content-type": "application/fhir+json"})
+        if "/Patient/" in request.url.path:
+            return httpx.Response(200, json=patient)
+        return httpx.Response(404, json=not_found)
+
+    return httpx.MockTransport(handler)
+
+
+def summarize(samples_ns: list[int]) -> dict[str, float | int]:
+    samples_us: list[float] = sorted(sample / 1000 for sample in samples_ns)
+    return {
+        "iterations": len(samples_us),
+        "mean_us": round(statistics.fmean(samples_us), 3),
+        "median_us": round(statistics.median(samples_us), 3),
+        "p95_us": round(samples_us[int(len(samples_us) * 0.95) - 1], 3),
+        "min_us": round(samples_us[0], 3),
+    }
+
+
+def bench(fn: Callable[[], Any], iterations: int, warmup: int = 5) -> dict[str, float | int]:
+    for _ in range(warmup):
+        fn()
+    samples: list[int] = []
+    for _ in range(iterations):
+        start: int = time.perf_counter_ns()
+        fn()
+        samples.append(time.perf_counter_ns() - start)
+    return summarize(samples)
+
+
+async def bench_async(fn: Callable[[], Awaitable[Any]], iterations: int, warmup: int = 5) -> dict[str, float | int]:
+    for _ in range(warmup):
+        await fn()
+    samples: list[int] = []
+    for _ in range(iterations):
+        start: int = time.perf_counter_ns()
+        await fn()
+        samples.append(time.perf_counter_ns() - start)
+    return summarize(samples)
+
+
+def run_sync_stages(iterations: int, bundle_entries: int) -> dict[str, dict]:
+    from query import SearchQuery
+    from search import plan_search
+
+    patient_json: dict = epic_patient()
+    bundle_json: dict = epic_observation_bundle(bundle_entries)
+    ok_response = httpx.Response(200, json=patient_json)
+    error_response = httpx.Response(404, json={"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]})
+    search_params = ObservationSearchParams.model_construct(patient="e63wRTbPfr1p8UW81d8Seiw3", category="laboratory", code="http://loinc.org|4548-4")
+    raw_query: str = "patient=e63wRTbPfr1p8UW81d8Seiw3&category=laboratory&code=http://loinc.org%7C4548-4"
+
+    return {
+        "check_response_ok": bench(lambda: check_response("Patient", ok_response), iterations),
+        "check_response_error": bench(lambda: check_response("Patient", error_response), iterations),
+        "create_search_query": bench(lambda: create_search_query("Observation", search_params), iterations),
+        "parse_search_query": bench(lambda: SearchQuery.parse("Observation", raw_query), iterations),
+        "patient_model_round_trip": bench(lambda: Patient(**patient_json).model_dump(exclude_none=True), iterations),
+        "plan_search": bench(lambda: plan_search(SearchQuery.parse("Observation", raw_query)), iterations),
+        "json_response_render_bundle": bench(lambda: FastJSONResponse(bundle_json).body, iterations),
+    }
+
+
+async def run_app_stages(iterations: int, bundle_entries: int) -> dict[str, dict]:
+    import resourceHandler
+    from main import app
+    from query import SearchQuery
+    from search import SearchPlan, plan_search, process_search_page
+    from serializer import loads
+
+    upstream.client = httpx.AsyncClient(transport=mock_fhir_server(bundle_entries))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as proxy:
+
+        async def uncached_read() -> None:
+            resourceHandler.resource_cache.clear()
+            await proxy.get("/Patient/e63wRTbPfr1p8UW81d8Seiw3")
+
+        async def cached_read() -> None:
+            await proxy.get("/Patient/e63wRTbPfr1p8UW81d8Seiw3")
+
+        async def health() -> None:
+            await proxy.get("/health")
+
+        async def search() -> None:
+            await proxy.get("/Observation?patient=e63wRTbPfr1p8UW81d8Seiw3&category=laboratory", headers={"Cache-Control": "no-store"})
+
+        plan: SearchPlan = plan_search(SearchQuery.parse("Observation", "patient=e63wRTbPfr1p8UW81d8Seiw3&category=laboratory&code=http://loinc.org%7C4548-4"))
+        bundle_bytes: bytes = json.dumps(epic_observation_bundle(bundle_entries)).encode()
+
+        async def search_page_processing() -> None:
+            # The page is filtered in place, so each run gets a fresh copy
+            await process_search_page(plan, loads(bundle_bytes), resourceHandler.fetch_reference)
+
+        results: dict[str, dict] = {
+            "middleware_and_routing": await bench_async(health, iterations),
+            "read_by_id_uncached": await bench_async(uncached_read, iterations),
+            "read_by_id_cached": await bench_async(cached_read, iterations),
+            "search_page_processing": await bench_async(search_page_processing, iterations),
+            "search_uncached": await bench_async(search, max(iterations // 10, 10)),
+        }
+    await upstream.close_client()
+    return results
+
+
+def package_version(name: str) -> str | None:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> list[str]:
+    with open(baseline_path, "r") as fo:
+        baseline: dict = json.load(fo)
+
+    regressions: list[str] = []
+    for stage, stats in results["stages"].items():
+        if stage not in baseline.get("stages", {}):
+            continue
+        ratio: float = stats["median_us"] / baseline["stages"][stage]["median_us"]
+        if ratio > threshold:
+            regressions.append(f"{stage}: median {stats['median_us']}us is {ratio:.2f}x the baseline of {baseline['stages'][stage]['median_us']}us")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the FHIRProxy hot path")
+    parser.add_argument("--iterations", type=int, default=200, help="Iterations per stage")
+    parser.add_argument("--bundle-entries", type=int, default=100, help="Number of Observations in the mocked search Bundle")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="A previous results file to compare medians against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Ratio to the baseline median that counts as a regression")
+    parser.add_argument("--with-logging", action="store_true", help="Keep the proxy's logging on, which includes console output in every stage")
+    args = parser.parse_args()
+
+    if not args.with_logging:
+        logging.disable(logging.CRITICAL)
+
+    stages: dict[str, dict] = run_sync_stages(args.iterations, args.bundle_entries)
+    stages.update(asyncio.run(run_app_stages(args.iterations, args.bundle_entries)))
+
+    results: dict = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "packages": {name: package_version(name) for name in ("fastapi", "fhir.resources", "fhirsearchhelper", "httpx", "pydantic")},
+        "parameters": {"iterations": args.iterations, "bundle_entries": args.bundle_entries, "logging": args.with_logging},
+        "stages": stages,
+    }
+
+    with open(args.output, "w") as fo:
+        json.dump(results, fo, indent=2)
+
+    for stage, stats in stages.items():
+        print(f"{stage:34s} median {stats['median_us']:>12.1f}us   p95 {stats['p95_us']:>12.1f}us")
+    print(f"Wrote results to {args.output}")
+
+    if args.compare:
+        regressions: list[str] = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
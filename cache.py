@@ -0,0 +1,382 @@
+"""File for the response caches, kept in memory or in a SQLite file shared by the workers on a node"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from fastapi.concurrency import run_in_threadpool
+
+from compression import decompress, pack
+
+logger: logging.Logger = logging.getLogger("main.cache")
+
+# Errors from a locked, unreadable or corrupt SQLite cache, which are treated as a cache miss rather than failing the request
+disk_errors: tuple[type[Exception], ...] = (sqlite3.Error, zlib.error, OSError, ValueError)
+
+
+@dataclass(slots=True)
+class CacheEntry:
+    body: bytes
+    status_code: int
+    expires: float
+    headers: dict[str, str] = field(default_factory=dict)
+    # Set when body is compressed, it is then sent as is to clients that accept the encoding
+    encoding: str | None = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    @property
+    def content(self) -> bytes:
+        """The uncompressed body"""
+        return decompress(self.body, self.encoding) if self.encoding else self.body
+
+    def response_headers(self) -> dict[str, str]:
+        return self.headers | {"Content-Encoding": self.encoding} if self.encoding else self.headers
+
+
+class ResourceCache:
+    """
+    Bounded LRU cache of serialized responses
+
+    Entries are evicted least recently used first once the total size of the stored bodies goes over max_bytes.
+    Every entry also has its own expiry, which is looked up from ttls by resource type and falls back to default_ttl.
+    Expired entries are kept for stale_ttl more seconds, in which get_stale still returns them for when the FHIR server is unavailable.
+    Bodies of at least compress_min_size bytes are stored gzipped, None stores every body as it is given.
+    Async code uses aget, aget_stale and aset, which DiskCache runs in the threadpool and which here just call the in-memory methods.
+    """
+
+    def __init__(self, max_bytes: int, default_ttl: float, ttls: dict[str, float] | None = None, stale_ttl: float = 0.0, compress_min_size: int | None = None) -> None:
+        self.max_bytes: int = max_bytes
+        self.default_ttl: float = default_ttl
+        self.ttls: dict[str, float] = ttls or {}
+        self.stale_ttl: float = stale_ttl
+        self.compress_min_size: int | None = compress_min_size
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry: CacheEntry | None = self._entries.get(key)
+        return entry is not None and entry.expires > time.time()
+
+    def ttl_for(self, resource_type: str) -> float:
+        return self.ttls.get(resource_type, self.default_ttl)
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            entry: CacheEntry | None = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires <= time.time():
+                if entry.expires + self.stale_ttl <= time.time():
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get_stale(self, key: str) -> CacheEntry | None:
+        """Returns an entry even if it has expired, as long as it is within stale_ttl of expiring"""
+
+        with self._lock:
+            entry: CacheEntry | None = self._entries.get(key)
+            return entry if entry is not None and entry.expires + self.stale_ttl > time.time() else None
+
+    def set(self, key: str, resource_type: str, body: bytes, status_code: int = 200, ttl: float | None = None, headers: dict[str, str] | None = None) -> CacheEntry:
+        encoding: str | None = None
+        if self.compress_min_size is not None:
+            body, encoding = pack(body, self.compress_min_size)
+        entry = CacheEntry(body=body, status_code=status_code, expires=time.time() + (ttl if ttl is not None else self.ttl_for(resource_type)), headers=headers or {}, encoding=encoding)
+        if entry.size > self.max_bytes:
+            logger.debug("Not caching %s since its size of %s bytes is larger than the cache budget", key, entry.size)
+            # An older version under the same key would otherwise keep being served
+            self.delete(key)
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                oldest_key: str = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return entry
+
+    async def aget(self, key: str) -> CacheEntry | None:
+        return self.get(key)
+
+    async def aget_stale(self, key: str) -> CacheEntry | None:
+        return self.get_stale(key)
+
+    async def aset(self, key: str, resource_type: str, body: bytes, status_code: int = 200, ttl: float | None = None, headers: dict[str, str] | None = None) -> CacheEntry:
+        return self.set(key, resource_type, body, status_code=status_code, ttl=ttl, headers=headers)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int | float]:
+        lookups: int = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry: CacheEntry = self._entries.pop(key)
+        self.size -= entry.size
+
+
+class DiskCache:
+    """
+    Cache of serialized responses in a SQLite database that every worker on a node opens, so they share one warm cache that also survives restarts
+
+    The database is in WAL mode so reads do not wait on writes from other workers. Bodies are stored zlib compressed, or gzipped once they are at least
+    compress_min_size bytes so they can be sent to clients without recompressing, and max_bytes applies to the compressed size.
+    Caches with different names share the database but have their own budget. Once a cache is over its budget, the entries that were accessed least recently
+    are evicted first, and access times are only written every access_interval seconds to keep hits from turning into writes.
+    Hit and miss counters are for this worker only. Expired entries are kept for stale_ttl more seconds for get_stale, like in ResourceCache.
+    SQLite and zlib calls block, so async code uses aget, aget_stale and aset, which run in the threadpool. A database that is locked for longer than
+    busy_timeout seconds, or that cannot be read or written, counts as a miss and the response is not stored.
+    """
+
+    access_interval: float = 10.0
+    compression_level: int = 1
+    busy_timeout: float = 1.0
+
+    def __init__(self, path: str, name: str, max_bytes: int, default_ttl: float, ttls: dict[str, float] | None = None, stale_ttl: float = 0.0, compress_min_size: int | None = None) -> None:
+        self.path: str = path
+        self.name: str = name
+        self.max_bytes: int = max_bytes
+        self.default_ttl: float = default_ttl
+        self.ttls: dict[str, float] = ttls or {}
+        self.stale_ttl: float = stale_ttl
+        self.compress_min_size: int | None = compress_min_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.expirations: int = 0
+        self.errors: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._pid: int = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Opened on first use in each worker, since a connection cannot be shared with a forked process
+        if self._conn is None or self._pid != os.getpid():
+            conn: sqlite3.Connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    cache TEXT NOT NULL, key TEXT NOT NULL, body BLOB NOT NULL, status_code INTEGER NOT NULL, headers TEXT NOT NULL,
+                    expires REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (cache, key)
+                );
+                CREATE INDEX IF NOT EXISTS entries_accessed ON entries (cache, accessed);
+                CREATE TABLE IF NOT EXISTS sizes (cache TEXT PRIMARY KEY, size INTEGER NOT NULL);
+                CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+                    INSERT INTO sizes (cache, size) VALUES (new.cache, new.size) ON CONFLICT (cache) DO UPDATE SET size = size + new.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+                    UPDATE sizes SET size = size - old.size WHERE cache = old.cache;
+                END;
+                """
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM entries WHERE cache = ?", (self.name,)).fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connection().execute("SELECT 1 FROM entries WHERE cache = ? AND key = ? AND expires > ?", (self.name, key, time.time())).fetchone() is not None
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            row: tuple | None = self._connection().execute("SELECT size FROM sizes WHERE cache = ?", (self.name,)).fetchone()
+        return row[0] if row else 0
+
+    def ttl_for(self, resource_type: str) -> float:
+        return self.ttls.get(resource_type, self.default_ttl)
+
+    def get(self, key: str) -> CacheEntry | None:
+        now: float = time.time()
+        try:
+            with self._lock:
+                conn: sqlite3.Connection = self._connection()
+                row: tuple | None = conn.execute("SELECT body, status_code, headers, expires, accessed FROM entries WHERE cache = ? AND key = ?", (self.name, key)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                body, status_code, headers, expires, accessed = row
+                if expires <= now:
+                    if expires + self.stale_ttl <= now:
+                        conn.execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, key))
+                        self.expirations += 1
+                    self.misses += 1
+                    return None
+                if now - accessed > self.access_interval:
+                    conn.execute("UPDATE entries SET accessed = ? WHERE cache = ? AND key = ?", (now, self.name, key))
+            entry: CacheEntry = self._entry(body, status_code, expires, headers)
+        except disk_errors as exc:
+            self._failed("read", key, exc)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def get_stale(self, key: str) -> CacheEntry | None:
+        """Returns an entry even if it has expired, as long as it is within stale_ttl of expiring"""
+
+        try:
+            with self._lock:
+                row: tuple | None = (
+                    self._connection()
+                    .execute("SELECT body, status_code, headers, expires FROM entries WHERE cache = ? AND key = ? AND expires > ?", (self.name, key, time.time() - self.stale_ttl))
+                    .fetchone()
+                )
+            if row is None:
+                return None
+            body, status_code, headers, expires = row
+            return self._entry(body, status_code, expires, headers)
+        except disk_errors as exc:
+            self._failed("read", key, exc)
+            return None
+
+    def _failed(self, action: str, key: str, exc: Exception) -> None:
+        self.errors += 1
+        logger.warning(f"Unable to {action} {key} in the SQLite cache at {self.path}, treating it as a miss: {exc}")
+
+    @staticmethod
+    def _entry(body: bytes, status_code: int, expires: float, headers: str) -> CacheEntry:
+        # gzip data starts with 1f 8b and zlib data never does, so gzipped bodies are told apart without a column for the encoding
+        if body[:2] == b"\x1f\x8b":
+            return CacheEntry(body=body, status_code=status_code, expires=expires, headers=json.loads(headers), encoding="gzip")
+        return CacheEntry(body=zlib.decompress(body), status_code=status_code, expires=expires, headers=json.loads(headers))
+
+    def set(self, key: str, resource_type: str, body: bytes, status_code: int = 200, ttl: float | None = None, headers: dict[str, str] | None = None) -> CacheEntry:
+        encoding: str | None = None
+        if self.compress_min_size is not None:
+            body, encoding = pack(body, self.compress_min_size)
+        entry = CacheEntry(body=body, status_code=status_code, expires=time.time() + (ttl if ttl is not None else self.ttl_for(resource_type)), headers=headers or {}, encoding=encoding)
+        compressed: bytes = body if encoding else zlib.compress(body, self.compression_level)
+        if len(compressed) > self.max_bytes:
+            logger.debug("Not caching %s since its compressed size of %s bytes is larger than the cache budget", key, len(compressed))
+            self.delete(key)
+            return entry
+        try:
+            with self._lock:
+                conn: sqlite3.Connection = self._connection()
+                # Deleting before inserting, rather than INSERT OR REPLACE, so the delete trigger keeps the size total right
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, key))
+                    conn.execute(
+                        "INSERT INTO entries (cache, key, body, status_code, headers, expires, accessed, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (self.name, key, compressed, status_code, json.dumps(entry.headers), entry.expires, time.time(), len(compressed)),
+                    )
+                    self._evict(conn)
+        except disk_errors as exc:
+            self._failed("store", key, exc)
+        return entry
+
+    async def aget(self, key: str) -> CacheEntry | None:
+        return await run_in_threadpool(self.get, key)
+
+    async def aget_stale(self, key: str) -> CacheEntry | None:
+        return await run_in_threadpool(self.get_stale, key)
+
+    async def aset(self, key: str, resource_type: str, body: bytes, status_code: int = 200, ttl: float | None = None, headers: dict[str, str] | None = None) -> CacheEntry:
+        return await run_in_threadpool(self.set, key, resource_type, body, status_code, ttl, headers)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        size: int = conn.execute("SELECT size FROM sizes WHERE cache = ?", (self.name,)).fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        self.expirations += conn.execute("DELETE FROM entries WHERE cache = ? AND expires <= ?", (self.name, time.time() - self.stale_ttl)).rowcount
+        size = conn.execute("SELECT size FROM sizes WHERE cache = ?", (self.name,)).fetchone()[0]
+        while size > self.max_bytes:
+            oldest: list[tuple[str, int]] = conn.execute("SELECT key, size FROM entries WHERE cache = ? ORDER BY accessed LIMIT 100", (self.name,)).fetchall()
+            if not oldest:
+                break
+            for key, entry_size in oldest:
+                if size <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, key))
+                size -= entry_size
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        try:
+            with self._lock:
+                self._connection().execute("DELETE FROM entries WHERE cache = ? AND key = ?", (self.name, key))
+        except disk_errors as exc:
+            self._failed("delete", key, exc)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM entries WHERE cache = ?", (self.name,))
+
+    def stats(self) -> dict[str, int | float]:
+        lookups: int = self.hits + self.misses
+        stats: dict[str, int | float] = {
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "errors": self.errors,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+        try:
+            return {"entries": len(self), "size_bytes": self.size} | stats
+        except disk_errors as exc:
+            # Left out rather than reported as 0 while the database cannot be read
+            logger.warning(f"Unable to read the size of the SQLite cache at {self.path}: {exc}")
+            return stats
+
+
+def open_cache(
+    backend: str, path: str, name: str, max_bytes: int, default_ttl: float, ttls: dict[str, float] | None = None, stale_ttl: float = 0.0, compress_min_size: int | None = None
+) -> ResourceCache | DiskCache:
+    """Creates a cache for the CACHE_BACKEND setting, either memory or sqlite"""
+
+    if backend == "sqlite":
+        logger.info(f"Using the SQLite cache at {path} for {name}")
+        return DiskCache(path, name, max_bytes=max_bytes, default_ttl=default_ttl, ttls=ttls, stale_ttl=stale_ttl, compress_min_size=compress_min_size)
+    return ResourceCache(max_bytes=max_bytes, default_ttl=default_ttl, ttls=ttls, stale_ttl=stale_ttl, compress_min_size=compress_min_size)
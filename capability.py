@@ -0,0 +1,124 @@
+"""File for the index of search parameters the FHIR server supports, compiled from the CapabilityStatement once instead of on every search"""
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import fhirsearchhelper
+
+from serializer import loads
+from util import capability_check_interval, capability_statement_file
+
+logger: logging.Logger = logging.getLogger("main.capability")
+
+
+@dataclass(frozen=True, slots=True)
+class TrueWhen:
+    """A search parameter that is only supported when another parameter has one of the given values, from Epic's true-when extension"""
+
+    field: str
+    values: frozenset[str]
+    # field==value only matches the exact value, field in [...] also matches several comma separated values that are all in the list
+    any_of: bool
+
+    def matches(self, search_params: dict[str, str]) -> bool:
+        value: str | None = search_params.get(self.field)
+        if value is None:
+            return False
+        if value in self.values:
+            return True
+        return self.any_of and all(part in self.values for part in value.split(","))
+
+
+class SearchIndex:
+    """
+    Resource type to the search parameters the FHIR server supports, with None for parameters that are always supported
+
+    Gives the same answers as fhirsearchhelper's run_gap_analysis, which walks the CapabilityStatement models on every call.
+    """
+
+    def __init__(self, capability_statement: dict) -> None:
+        self.params: dict[str, dict[str, TrueWhen | None]] = {}
+        for resource in capability_statement.get("rest", [{}])[0].get("resource", []):
+            if not resource.get("searchParam"):
+                continue
+            supported: dict[str, TrueWhen | None] = {}
+            seen: set[str] = set()
+            for search_param in resource["searchParam"]:
+                name: str | None = search_param.get("name")
+                if not name or name in seen:
+                    continue
+                seen.add(name)
+                if not search_param.get("extension"):
+                    supported[name] = None
+                    continue
+                true_when: str | None = next((ext.get("valueString") for ext in search_param["extension"] if ext.get("url") == "true-when"), None)
+                if true_when and "==" in true_when:
+                    field, value = true_when.split("==", 1)
+                    supported[name] = TrueWhen(field, frozenset([value]), any_of=False)
+                elif true_when and " in " in true_when:
+                    field, values = true_when.split(" in ", 1)
+                    supported[name] = TrueWhen(field, frozenset(value.strip() for value in values.strip("[").strip("]").split(",")), any_of=True)
+                # Parameters with any other extension are never supported
+            self.params[resource["type"]] = supported
+        self.resource_types: frozenset[str] = frozenset(self.params)
+
+    def unsupported_params(self, resource_type: str, search_params: dict[str, str]) -> list[str]:
+        """The parameters of a search the FHIR server does not support, which are filtered on instead"""
+
+        supported: dict[str, TrueWhen | None] = self.params.get(resource_type, {})
+        unsupported: list[str] = []
+        for name in search_params:
+            if name not in supported:
+                unsupported.append(name)
+                continue
+            true_when: TrueWhen | None = supported[name]
+            if true_when is not None and not true_when.matches(search_params):
+                unsupported.append(name)
+        return unsupported
+
+
+def capability_statement_path(file_path: str) -> str:
+    """Files named after one of the CapabilityStatements that ship with fhirsearchhelper are read from there, as load_capability_statement does"""
+
+    packaged_path: Path = Path(fhirsearchhelper.__file__).parent / "capabilitystatements" / file_path
+    return str(packaged_path) if packaged_path.is_file() else file_path
+
+
+search_index: SearchIndex | None = None
+loaded_mtime: float = 0.0
+next_check: float = 0.0
+
+
+def load_search_index() -> SearchIndex:
+    """Compiles the index from the CapabilityStatement file, called at startup and whenever the file changes"""
+
+    global search_index, loaded_mtime
+    path: str = capability_statement_path(capability_statement_file)
+    mtime: float = os.stat(path).st_mtime
+    with open(path, "rb") as file:
+        search_index = SearchIndex(loads(file.read()))
+    loaded_mtime = mtime
+    logger.info(f"Loaded search parameters for {len(search_index.resource_types)} resource types from {path}")
+    return search_index
+
+
+def get_search_index() -> SearchIndex:
+    """Returns the index, reloading it if the CapabilityStatement file changed, which is checked at most every CAPABILITY_CHECK_INTERVAL seconds"""
+
+    global next_check
+    if search_index is None:
+        return load_search_index()
+
+    now: float = time.monotonic()
+    if now < next_check:
+        return search_index
+    next_check = now + capability_check_interval
+    try:
+        if os.stat(capability_statement_path(capability_statement_file)).st_mtime != loaded_mtime:
+            return load_search_index()
+    except (OSError, ValueError, KeyError) as exc:
+        logger.error(f"Unable to reload the CapabilityStatement, still using the one loaded before: {exc}")
+    return search_index
@@ -0,0 +1,40 @@
+"""File for coalescing concurrent identical upstream requests"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+logger: logging.Logger = logging.getLogger("main.coalesce")
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time
+
+    The first caller for a key starts the call as a task, and anyone asking for the same key while it is running waits on that task instead of starting their own.
+    The task is shielded so a client disconnecting does not cancel the work the other callers are waiting on.
+    """
+
+    def __init__(self) -> None:
+        self.calls: int = 0
+        self.coalesced: int = 0
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task: asyncio.Task | None = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.debug("Waiting on in-flight request for %s", key)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
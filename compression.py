@@ -0,0 +1,186 @@
+"""File for gzip and brotli compression of response bodies, for the caches, the upstream client and clients of the proxy"""
+
+import gzip
+import zlib
+from collections.abc import Callable
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from conditional import encoded_tag
+from util import brotli_quality, compression_level, compression_min_size
+
+try:
+    # brotli is optional, installing it (e.g. with httpx[brotli]) adds br to the encodings asked for upstream and offered to clients
+    import brotli
+except ImportError:
+    brotli = None
+
+# In order of preference, the caches always store gzip since every client that asks for compression accepts it
+encodings: tuple[str, ...] = ("br", "gzip") if brotli is not None else ("gzip",)
+compressible_types: tuple[str, ...] = ("json", "text/", "xml", "javascript")
+
+compression_stats: dict[str, int] = {"compressed": 0, "passed_through": 0, "decompressed": 0}
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=compression_level, mtime=0)
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.decompress(body)
+    return gzip.decompress(body)
+
+
+def pack(body: bytes, min_size: int) -> tuple[bytes, str | None]:
+    """Gzips a body for storing in a cache if it is at least min_size bytes, returning the stored bytes and their encoding"""
+
+    if len(body) < min_size:
+        return body, None
+    return compress(body, "gzip"), "gzip"
+
+
+def accepted_encodings(accept_encoding: str) -> dict[str, float]:
+    """Parses an Accept-Encoding header into encodings and their q values"""
+
+    accepted: dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q: float = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def accepts(accept_encoding: str, encoding: str) -> bool:
+    accepted: dict[str, float] = accepted_encodings(accept_encoding)
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    """The encoding to compress with for a client, the one it gives the highest q value, with ties going to the order in encodings"""
+
+    accepted: dict[str, float] = accepted_encodings(accept_encoding)
+    best: str | None = None
+    best_q: float = 0.0
+    for encoding in encodings:
+        q: float = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def stream_compressor(encoding: str) -> Callable[[bytes, bool], bytes]:
+    """Returns a function that compresses a body one chunk at a time, flushing each chunk so streamed pages are not held back"""
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=brotli_quality)
+        return lambda chunk, last: compressor.process(chunk) + (compressor.finish() if last else compressor.flush())
+    gzip_compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    return lambda chunk, last: gzip_compressor.compress(chunk) + gzip_compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def stream_decompressor(encoding: str) -> Callable[[bytes], bytes]:
+    if encoding == "br":
+        return brotli.Decompressor().process
+    return zlib.decompressobj(31).decompress
+
+
+class CompressionMiddleware:
+    """
+    Negotiates the Content-Encoding of responses with the client's Accept-Encoding
+
+    Responses that are already compressed, from the caches or relayed from the FHIR server, are sent as is to clients that accept their encoding and decompressed
+    for the ones that do not. Uncompressed responses of at least minimum_size bytes are compressed with the encoding the client prefers. A strong ETag gets the
+    encoding as a suffix when the body is sent compressed.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = compression_min_size) -> None:
+        self.app: ASGIApp = app
+        self.minimum_size: int = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding: str = Headers(scope=scope).get("accept-encoding", "")
+        await self.app(scope, receive, CompressionResponder(send, accept_encoding, self.minimum_size).send)
+
+
+class CompressionResponder:
+    """Holds back the start of a response until its first body chunk, which decides whether it is compressed, decompressed or sent as is"""
+
+    def __init__(self, send: Send, accept_encoding: str, minimum_size: int) -> None:
+        self._send: Send = send
+        self.accept_encoding: str = accept_encoding
+        self.minimum_size: int = minimum_size
+        self.start: Message | None = None
+        self.transform: Callable[[bytes, bool], bytes] | None = None
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+        if self.start is None:
+            if self.transform is not None:
+                message = {"type": "http.response.body", "body": self.transform(body, not more_body), "more_body": more_body}
+            await self._send(message)
+            return
+
+        start, self.start = self.start, None
+        self.transform = self.negotiate(MutableHeaders(scope=start), body, more_body)
+        if self.transform is not None:
+            body = self.transform(body, not more_body)
+            if not more_body:
+                MutableHeaders(scope=start)["content-length"] = str(len(body))
+        await self._send(start)
+        await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def negotiate(self, headers: MutableHeaders, body: bytes, more_body: bool) -> Callable[[bytes, bool], bytes] | None:
+        """Sets the Content-Encoding for the response and returns the function its body goes through, None if it is sent as is"""
+
+        content_encoding: str | None = headers.get("content-encoding")
+        if content_encoding:
+            headers.add_vary_header("Accept-Encoding")
+            if accepts(self.accept_encoding, content_encoding) or content_encoding not in encodings:
+                compression_stats["passed_through"] += 1
+                if "etag" in headers:
+                    headers["etag"] = encoded_tag(headers["etag"], content_encoding)
+                return None
+            compression_stats["decompressed"] += 1
+            del headers["content-encoding"]
+            if not more_body:
+                return lambda chunk, last: decompress(chunk, content_encoding)
+            if "content-length" in headers:
+                del headers["content-length"]
+            decompressor: Callable[[bytes], bytes] = stream_decompressor(content_encoding)
+            return lambda chunk, last: decompressor(chunk)
+
+        encoding: str | None = choose_encoding(self.accept_encoding)
+        if encoding is None or not any(kind in headers.get("content-type", "") for kind in compressible_types) or (not more_body and len(body) < self.minimum_size):
+            return None
+        compression_stats["compressed"] += 1
+        headers["content-encoding"] = encoding
+        headers.add_vary_header("Accept-Encoding")
+        if "etag" in headers:
+            headers["etag"] = encoded_tag(headers["etag"], encoding)
+        if not more_body:
+            return lambda chunk, last: compress(chunk, encoding)
+        if "content-length" in headers:
+            del headers["content-length"]
+        return stream_compressor(encoding)
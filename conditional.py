@@ -0,0 +1,104 @@
+"""File for conditional requests, the ETag and Last-Modified validators of cached reads and checking them against If-None-Match and If-Modified-Since"""
+
+import hashlib
+import re
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from starlette.datastructures import Headers
+
+# Expansion puts parts of other resources into these, so a read of one can change without its own version changing
+expanded_resource_types: frozenset[str] = frozenset({"MedicationRequest", "Condition", "DocumentReference"})
+
+conditional_stats: dict[str, int] = {"not_modified": 0, "revalidated": 0}
+# The suffix strong ETags get when a body is sent compressed, since a strong ETag stands for the exact bytes sent
+encoded_tag_pattern: re.Pattern[str] = re.compile(r'-(gzip|br)"$')
+
+
+def content_tag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def validators(resource_type: str, resource_obj: dict, body: bytes, upstream_headers: Headers | dict[str, str]) -> dict[str, str]:
+    """
+    ETag and Last-Modified headers for a read that is being cached
+
+    Resources returned as they were read keep the FHIR server's ETag, or W/"<meta.versionId>" as FHIR servers use, which can also be sent back to the server
+    to revalidate. Expanded resources get a hash of the body that is sent instead, since it depends on the resources that were expanded into it.
+    """
+
+    meta: dict = resource_obj.get("meta", {})
+    headers: dict[str, str] = {}
+    if resource_type in expanded_resource_types:
+        headers["ETag"] = content_tag(body)
+    elif "etag" in upstream_headers:
+        headers["ETag"] = upstream_headers["etag"]
+    elif meta.get("versionId"):
+        headers["ETag"] = f'W/"{meta["versionId"]}"'
+    else:
+        headers["ETag"] = content_tag(body)
+
+    if "last-modified" in upstream_headers:
+        headers["Last-Modified"] = upstream_headers["last-modified"]
+    elif meta.get("lastUpdated"):
+        try:
+            headers["Last-Modified"] = format_datetime(datetime.fromisoformat(meta["lastUpdated"].replace("Z", "+00:00")).astimezone(timezone.utc), usegmt=True)
+        except ValueError:
+            pass
+    return headers
+
+
+def encoded_tag(etag: str, encoding: str) -> str:
+    """The ETag of a body sent with a Content-Encoding, weak ETags stay the same as the encodings are equivalent"""
+
+    if etag.startswith("W/") or not etag.endswith('"') or encoded_tag_pattern.search(etag):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def identity_tag(etag: str) -> str:
+    """An ETag compared weakly and without its encoding suffix, so a client can send back the one for any encoding"""
+
+    return encoded_tag_pattern.sub('"', etag.strip().removeprefix("W/"))
+
+
+def revalidation_headers(resource_type: str, cached_headers: dict[str, str]) -> dict[str, str]:
+    """Conditional headers for refetching an expired read, empty when the cached validators did not come from the FHIR server"""
+
+    if resource_type in expanded_resource_types:
+        return {}
+    headers: dict[str, str] = {}
+    if cached_headers.get("ETag", "").startswith("W/"):
+        headers["If-None-Match"] = cached_headers["ETag"]
+    if "Last-Modified" in cached_headers:
+        headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+    return headers
+
+
+def parse_http_date(value: str) -> datetime | None:
+    """An HTTP date as an aware UTC datetime, dates with a -0000 zone come back naive from parsedate_to_datetime and are taken as UTC"""
+
+    try:
+        parsed: datetime = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+
+def not_modified(request_headers: Headers, cached_headers: dict[str, str]) -> bool:
+    """Whether a client's If-None-Match or, without one, If-Modified-Since says its copy is current, with ETags compared weakly as for GETs"""
+
+    if_none_match: str | None = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etag: str | None = cached_headers.get("ETag")
+        if etag is None:
+            return False
+        tags: set[str] = {identity_tag(tag) for tag in if_none_match.split(",")}
+        return "*" in tags or identity_tag(etag) in tags
+
+    if_modified_since: str | None = request_headers.get("if-modified-since")
+    if if_modified_since is None or "Last-Modified" not in cached_headers:
+        return False
+    since: datetime | None = parse_http_date(if_modified_since)
+    modified: datetime | None = parse_http_date(cached_headers["Last-Modified"])
+    return since is not None and modified is not None and modified <= since
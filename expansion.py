@@ -0,0 +1,143 @@
+"""File for expanding references that clients expect inline, for a single read or for every entry of a search Bundle"""
+
+import asyncio
+import base64
+import logging
+from collections.abc import Awaitable, Callable, Iterable
+
+import html2text
+from fastapi.concurrency import run_in_threadpool
+
+from util import expansion_concurrency
+
+logger: logging.Logger = logging.getLogger("main.expansion")
+
+# Reads a reference like Medication/123 and returns the resource, or None if it could not be read
+Fetch = Callable[[str], Awaitable[dict | None]]
+
+onset_keys: tuple[str, ...] = ("onsetAge", "onsetDateTime", "onsetPeriod", "onsetRange", "onsetString", "recordedDate")
+unknown_onset: str = "9999-12-31"
+
+
+async def resolve_references(references: Iterable[str], fetch: Fetch) -> dict[str, dict | None]:
+    """Fetches each distinct reference once, with at most EXPANSION_CONCURRENCY fetches running at a time"""
+
+    unique_references: list[str] = list(dict.fromkeys(references))
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(expansion_concurrency)
+
+    async def resolve(reference: str) -> dict | None:
+        async with semaphore:
+            return await fetch(reference)
+
+    resolved: list[dict | None] = await asyncio.gather(*(resolve(reference) for reference in unique_references))
+    if unique_references:
+        logger.debug("Resolved %s distinct references", len(unique_references))
+    return dict(zip(unique_references, resolved))
+
+
+async def expand_medication_references(resources: list[dict], fetch: Fetch) -> list[dict | None]:
+    """Replaces MedicationRequest.medicationReference with the referenced Medication.code as medicationCodeableConcept, None where the Medication could not be read"""
+
+    medications: dict[str, dict | None] = await resolve_references(
+        (resource["medicationReference"]["reference"] for resource in resources if "reference" in resource.get("medicationReference", {})), fetch
+    )
+
+    expanded: list[dict | None] = []
+    for resource in resources:
+        if "reference" in resource.get("medicationReference", {}):
+            medication: dict | None = medications[resource["medicationReference"]["reference"]]
+            if not medication or "code" not in medication:
+                logger.error(f"Unable to expand {resource['medicationReference']['reference']} for MedicationRequest/{resource.get('id')}")
+                expanded.append(None)
+                continue
+            resource["medicationCodeableConcept"] = medication["code"]
+            del resource["medicationReference"]
+        expanded.append(resource)
+
+    return expanded
+
+
+async def expand_condition_onsets(resources: list[dict], fetch: Fetch) -> list[dict | None]:
+    """Sets Condition.onsetDateTime from the start of the referenced Encounter when a Condition has no onset, None where the Encounter could not be read"""
+
+    missing_onset: list[dict] = [resource for resource in resources if not any(onset_key in resource for onset_key in onset_keys)]
+    encounters: dict[str, dict | None] = await resolve_references((resource["encounter"]["reference"] for resource in missing_onset if "reference" in resource.get("encounter", {})), fetch)
+
+    expanded: list[dict | None] = []
+    for resource in resources:
+        if any(onset_key in resource for onset_key in onset_keys):
+            expanded.append(resource)
+            continue
+        if "reference" in resource.get("encounter", {}):
+            encounter: dict | None = encounters[resource["encounter"]["reference"]]
+            if encounter is None:
+                logger.error(f"Unable to read {resource['encounter']['reference']} for Condition/{resource.get('id')}")
+                expanded.append(None)
+                continue
+            resource["onsetDateTime"] = encounter.get("period", {}).get("start", unknown_onset)
+        else:
+            resource["onsetDateTime"] = unknown_onset
+        expanded.append(resource)
+
+    return expanded
+
+
+def html_to_text(html: str) -> str:
+    text_maker = html2text.HTML2Text()
+    text_maker.ignore_images = True
+    return text_maker.handle(html)
+
+
+def convert_document_content(resource: dict) -> dict | None:
+    """Adds a text/plain copy of every text/html attachment and moves the first text/plain attachment to the front, None if the document has neither"""
+
+    html_contents: list[dict] = [content for content in resource["content"] if content["attachment"].get("contentType") == "text/html"]
+    if not html_contents and not any(content["attachment"].get("contentType") == "text/plain" for content in resource["content"]):
+        return None
+
+    for content in html_contents:
+        html: str = base64.b64decode(content["attachment"].get("data", "")).decode("utf-8", errors="replace")
+        resource["content"].append({"attachment": {"contentType": "text/plain", "data": base64.b64encode(html_to_text(html).encode("utf-8")).decode("utf-8")}})
+
+    plain_text_index: int = next(index for index, content in enumerate(resource["content"]) if content["attachment"].get("contentType") == "text/plain")
+    resource["content"][0], resource["content"][plain_text_index] = resource["content"][plain_text_index], resource["content"][0]
+
+    return resource
+
+
+async def expand_document_contents(resources: list[dict], fetch: Fetch) -> list[dict | None]:
+    """Inlines the Binary behind each DocumentReference attachment url and converts HTML notes to plain text, None where a Binary could not be read"""
+
+    binaries: dict[str, dict | None] = await resolve_references(
+        (content["attachment"]["url"] for resource in resources for content in resource.get("content", []) if "url" in content.get("attachment", {})), fetch
+    )
+
+    async def expand(resource: dict) -> dict | None:
+        for content in resource.get("content", []):
+            attachment: dict = content.get("attachment", {})
+            if "url" not in attachment:
+                continue
+            binary: dict | None = binaries[attachment["url"]]
+            if not binary or "data" not in binary:
+                logger.warning(f"Skipping DocumentReference/{resource.get('id')} since {attachment['url']} could not be retrieved")
+                return None
+            attachment["data"] = binary["data"]
+            del attachment["url"]
+        # Converting large notes is CPU heavy, so it is kept off the event loop
+        return await run_in_threadpool(convert_document_content, resource) if "content" in resource else None
+
+    return list(await asyncio.gather(*(expand(resource) for resource in resources)))
+
+
+async def expand_resources(resource_type: str, resources: list[dict], fetch: Fetch) -> list[dict | None]:
+    """Expands a list of resources of one type, returning them in the same order with None for resources that could not be expanded"""
+
+    match resource_type:
+        case "MedicationRequest":
+            return await expand_medication_references(resources, fetch)
+        case "Condition":
+            return await expand_condition_onsets(resources, fetch)
+        case "DocumentReference":
+            return await expand_document_contents(resources, fetch)
+        case _:
+            return list(resources)
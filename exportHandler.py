@@ -0,0 +1,344 @@
+"""File for bulk export jobs that run patient-level searches in the background and write the results to NDJSON files"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import aclosing
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl
+
+from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+import metrics
+from capability import get_search_index
+from models import ExportRequest
+from query import SearchQuery
+from resourceHandler import fetch_reference, first_search_page
+from search import all_pages
+from serializer import FastJSONResponse, dumps
+from util import export_dir, export_workers
+
+logger: logging.Logger = logging.getLogger("main.exportHandler")
+
+export_router: APIRouter = APIRouter()
+
+ndjson_media_type: str = "application/fhir+ndjson"
+manifest_file_name: str = "manifest.json"
+error_file_type: str = "OperationOutcome"
+checkpoint_interval: float = 1.0
+job_id_pattern: re.Pattern = re.compile(r"[0-9a-f]{32}")
+
+# Shared by every job so concurrent exports do not multiply the load on the FHIR server
+export_slots: asyncio.Semaphore = asyncio.Semaphore(export_workers)
+
+
+def outcome(diagnostics: str, code: str = "processing") -> dict:
+    return OperationOutcome(issue=[{"severity": "error", "code": code, "diagnostics": diagnostics}]).model_dump(exclude_none=True)  # type: ignore
+
+
+class ExportJob:
+    """
+    A bulk export job and its manifest
+
+    The manifest records the completed patient and resource type pairs along with the size of every NDJSON file at that point. It is written to disk
+    at most every second, and a resumed job truncates its files back to the recorded sizes and runs the pairs that were not recorded as completed.
+    """
+
+    def __init__(self, manifest: dict) -> None:
+        self.manifest: dict = manifest
+        self.directory: str = os.path.join(export_dir, manifest["id"])
+        self.completed: set[str] = set(manifest["completed"])
+        self.task: asyncio.Task | None = None
+        self.write_lock: asyncio.Lock = asyncio.Lock()
+        self.run_started: float = time.monotonic()
+        self.last_checkpoint: float = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.manifest["id"]
+
+    @property
+    def request(self) -> ExportRequest:
+        return ExportRequest(**self.manifest["request"])
+
+    def elapsed(self) -> float:
+        return self.manifest["elapsed"] + (time.monotonic() - self.run_started if self.task and not self.task.done() else 0.0)
+
+    def file_path(self, resource_type: str) -> str:
+        return os.path.join(self.directory, f"{resource_type}.ndjson")
+
+    def write_manifest(self) -> None:
+        temp_path: str = os.path.join(self.directory, f"{manifest_file_name}.tmp")
+        with open(temp_path, "w") as fo:
+            json.dump(self.manifest, fo)
+        os.replace(temp_path, os.path.join(self.directory, manifest_file_name))
+
+    async def checkpoint(self) -> None:
+        self.manifest["elapsed"] = self.elapsed()
+        self.run_started = time.monotonic()
+        self.last_checkpoint = time.monotonic()
+        await run_in_threadpool(self.write_manifest)
+
+    def append_lines(self, resource_type: str, lines: list[bytes]) -> None:
+        if not lines:
+            return
+        data: bytes = b"".join(lines)
+        with open(self.file_path(resource_type), "ab") as fo:
+            fo.write(data)
+        file_info: dict = self.manifest["files"].setdefault(resource_type, {"count": 0, "bytes": 0})
+        file_info["count"] += len(lines)
+        file_info["bytes"] += len(data)
+
+    def truncate_files(self) -> None:
+        """Drops anything written after the last checkpoint, including files first written after it, those pairs are run again"""
+        for file_name in os.listdir(self.directory):
+            resource_type, extension = os.path.splitext(file_name)
+            if extension != ".ndjson":
+                continue
+            file_info: dict | None = self.manifest["files"].get(resource_type)
+            if file_info is None:
+                os.remove(self.file_path(resource_type))
+            else:
+                os.truncate(self.file_path(resource_type), file_info["bytes"])
+
+    async def record(self, resource_type: str, patient: str, lines: list[bytes], errors: list[bytes], seconds: float) -> None:
+        async with self.write_lock:
+            await run_in_threadpool(self.append_lines, resource_type, lines)
+            await run_in_threadpool(self.append_lines, error_file_type, errors)
+            stats: dict = self.manifest["stats"].setdefault(resource_type, {"resources": 0, "searches": 0, "errors": 0, "seconds": 0.0})
+            stats["resources"] += len(lines)
+            stats["searches"] += 1
+            stats["errors"] += len(errors)
+            stats["seconds"] += seconds
+            self.completed.add(f"{patient}|{resource_type}")
+            self.manifest["completed"].append(f"{patient}|{resource_type}")
+            if time.monotonic() - self.last_checkpoint >= checkpoint_interval:
+                await self.checkpoint()
+
+    async def export_search(self, patient: str, resource_type: str) -> None:
+        """Runs one patient's search for one resource type, following every page"""
+
+        patient_param: str = "_id" if resource_type == "Patient" else "patient"
+        type_filter: str | None = self.request.typeFilters.get(resource_type)
+        query: SearchQuery = SearchQuery.from_params(resource_type, [(patient_param, patient), *parse_qsl(type_filter or "")])
+
+        lines: list[bytes] = []
+        errors: list[bytes] = []
+        start_time: float = time.perf_counter()
+        async with export_slots:
+            try:
+                first_page, query_headers = await first_search_page(query)
+                if isinstance(first_page, OperationOutcome):
+                    errors.append(first_page.model_dump_json(exclude_none=True).encode("utf-8") + b"\n")
+                else:
+                    async with aclosing(all_pages(query, first_page, query_headers, fetch_reference)) as pages:
+                        async for page in pages:
+                            if isinstance(page, OperationOutcome):
+                                errors.append(page.model_dump_json(exclude_none=True).encode("utf-8") + b"\n")
+                                break
+                            lines.extend(dumps(entry["resource"]) + b"\n" for entry in page.get("entry", []) if "resource" in entry)
+            except Exception as exc:
+                logger.error(f"Export {self.id} failed to search {query}: {exc}")
+                errors.append(dumps(outcome(f"Searching {query} failed: {exc}", "exception")) + b"\n")
+
+        await self.record(resource_type, patient, lines, errors, time.perf_counter() - start_time)
+
+    async def run(self) -> None:
+        request: ExportRequest = self.request
+        pending: list[tuple[str, str]] = [(patient, resource_type) for patient in request.patients for resource_type in request.types if f"{patient}|{resource_type}" not in self.completed]
+        logger.info(f"Export {self.id} has {len(pending)} of {self.manifest['searches']} searches left to run")
+
+        pending_iter = iter(pending)
+
+        async def worker() -> None:
+            for patient, resource_type in pending_iter:
+                await self.export_search(patient, resource_type)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(export_workers, len(pending)) or 1)))
+            self.manifest["status"] = "completed"
+            logger.info(f"Export {self.id} completed in {self.elapsed():.2f} seconds")
+        except asyncio.CancelledError:
+            # Left as in-progress so it is resumed on the next startup, unless the job is being deleted
+            await self.checkpoint()
+            raise
+        except Exception as exc:
+            logger.error(f"Export {self.id} failed: {exc}")
+            self.manifest["status"] = "failed"
+            self.manifest["diagnostics"] = str(exc)
+        await self.checkpoint()
+
+    def start(self) -> None:
+        self.run_started = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+
+    def progress(self) -> dict:
+        elapsed: float = self.elapsed()
+        return {
+            "id": self.id,
+            "status": self.manifest["status"],
+            "transactionTime": self.manifest["transactionTime"],
+            "searches": self.manifest["searches"],
+            "completedSearches": len(self.manifest["completed"]),
+            "elapsedSeconds": round(elapsed, 3),
+            "stats": {
+                resource_type: stats | {"seconds": round(stats["seconds"], 3), "resourcesPerSecond": round(stats["resources"] / elapsed, 3) if elapsed else 0.0}
+                for resource_type, stats in self.manifest["stats"].items()
+            },
+        }
+
+
+export_jobs: dict[str, ExportJob] = {}
+
+
+def export_stats() -> dict:
+    running: list[ExportJob] = [job for job in export_jobs.values() if job.task and not job.task.done()]
+    return {"running": len(running), "pending_searches": sum(job.manifest["searches"] - len(job.manifest["completed"]) for job in running)}
+
+
+metrics.register_stats("export", "kind", "jobs", export_stats)
+
+
+def load_job(job_id: str) -> ExportJob | None:
+    """A job from this process, or from its manifest on disk for jobs that have finished or were started before a restart"""
+
+    if not job_id_pattern.fullmatch(job_id):
+        return None
+    if job_id in export_jobs:
+        return export_jobs[job_id]
+    manifest_path: str = os.path.join(export_dir, job_id, manifest_file_name)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as fo:
+        return ExportJob(json.load(fo))
+
+
+async def resume_exports() -> None:
+    """Resumes jobs that were still running when the proxy last stopped, called from the FastAPI lifespan"""
+
+    if not os.path.isdir(export_dir):
+        return
+    for job_id in os.listdir(export_dir):
+        job: ExportJob | None = load_job(job_id)
+        if job and job.manifest["status"] == "in-progress" and job_id not in export_jobs:
+            await run_in_threadpool(job.truncate_files)
+            export_jobs[job_id] = job
+            job.start()
+            logger.info(f"Resuming export {job_id}")
+
+
+async def stop_exports() -> None:
+    """Cancels running jobs, which checkpoint themselves so they can be resumed"""
+
+    running: list[asyncio.Task] = [job.task for job in export_jobs.values() if job.task and not job.task.done()]
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
+
+
+@export_router.post("/$export", status_code=202)
+async def start_export(export_request: ExportRequest, req: Request) -> Response:
+    """
+    Starts a bulk export of the given resource types for each of the given patients
+
+    Returns 202 with a Content-Location header to poll for the status of the export. typeFilters adds search parameters to a resource type, e.g. {"Observation": "category=laboratory"}.
+    """
+
+    supported_types: frozenset[str] = get_search_index().resource_types
+    unsupported_types: list[str] = [resource_type for resource_type in export_request.types if not resource_type.isalnum() or resource_type not in supported_types]
+    if unsupported_types:
+        return FastJSONResponse(outcome(f"Searching {', '.join(unsupported_types)} is not supported", "not-supported"), status_code=400)
+
+    job_id: str = uuid.uuid4().hex
+    job = ExportJob(
+        {
+            "id": job_id,
+            "status": "in-progress",
+            "request": export_request.model_dump(),
+            "requestUrl": str(req.url),
+            "transactionTime": datetime.now(timezone.utc).isoformat(),
+            "searches": len(export_request.patients) * len(export_request.types),
+            "completed": [],
+            "files": {},
+            "stats": {},
+            "elapsed": 0.0,
+        }
+    )
+    await run_in_threadpool(os.makedirs, job.directory, exist_ok=True)
+    await job.checkpoint()
+    export_jobs[job_id] = job
+    job.start()
+    logger.info(f"Started export {job_id} of {export_request.types} for {len(export_request.patients)} patients")
+
+    status_url: str = str(req.url_for("export_status", job_id=job_id))
+    return FastJSONResponse(job.progress(), status_code=202, headers={"Content-Location": status_url})
+
+
+@export_router.get("/$export/{job_id}")
+async def export_status(job_id: str, req: Request) -> Response:
+    """Returns 202 with the progress of a running export, or 200 with the files to download once it has completed"""
+
+    job: ExportJob | None = load_job(job_id)
+    if not job:
+        return FastJSONResponse(outcome(f"There is no export with id {job_id}", "not-found"), status_code=404)
+
+    match job.manifest["status"]:
+        case "in-progress":
+            progress: dict = job.progress()
+            return FastJSONResponse(progress, status_code=202, headers={"X-Progress": f"{progress['completedSearches']} of {progress['searches']} searches completed"})
+        case "completed":
+            files: dict[str, dict] = job.manifest["files"]
+            return FastJSONResponse(
+                {
+                    "transactionTime": job.manifest["transactionTime"],
+                    "request": job.manifest["requestUrl"],
+                    "requiresAccessToken": False,
+                    "output": [
+                        {"type": resource_type, "url": str(req.url_for("export_file", job_id=job_id, file_name=f"{resource_type}.ndjson")), "count": file_info["count"]}
+                        for resource_type, file_info in files.items()
+                        if resource_type != error_file_type
+                    ],
+                    "error": [{"type": error_file_type, "url": str(req.url_for("export_file", job_id=job_id, file_name=f"{error_file_type}.ndjson")), "count": files[error_file_type]["count"]}]
+                    if error_file_type in files
+                    else [],
+                    "extension": {"stats": job.progress()["stats"]},
+                }
+            )
+        case _:
+            return FastJSONResponse(outcome(f"Export {job_id} failed: {job.manifest.get('diagnostics', 'unknown error')}", "exception"), status_code=500)
+
+
+@export_router.get("/$export/{job_id}/{file_name}")
+async def export_file(job_id: str, file_name: str) -> Response:
+    """Downloads one of the NDJSON files of a completed export"""
+
+    job: ExportJob | None = load_job(job_id)
+    resource_type: str = file_name.removesuffix(".ndjson")
+    if not job or job.manifest["status"] != "completed" or not file_name.endswith(".ndjson") or resource_type not in job.manifest["files"]:
+        return FastJSONResponse(outcome(f"There is no file {file_name} for a completed export with id {job_id}", "not-found"), status_code=404)
+    return FileResponse(job.file_path(resource_type), media_type=ndjson_media_type)
+
+
+@export_router.delete("/$export/{job_id}", status_code=202)
+async def delete_export(job_id: str) -> Response:
+    """Cancels an export if it is running and deletes its files"""
+
+    job: ExportJob | None = load_job(job_id)
+    if not job:
+        return FastJSONResponse(outcome(f"There is no export with id {job_id}", "not-found"), status_code=404)
+
+    export_jobs.pop(job_id, None)
+    if job.task and not job.task.done():
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+    await run_in_threadpool(shutil.rmtree, job.directory, ignore_errors=True)
+    logger.info(f"Deleted export {job_id}")
+    return Response(status_code=202)
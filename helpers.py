@@ -1,5 +1,6 @@
 """File for helper functions"""
 
+import asyncio
 import logging
 import time
 import uuid
@@ -7,43 +8,142 @@ from json import JSONDecodeError
 
 import httpx
 import jwt
-from fhir.resources.R4B.capabilitystatement import CapabilityStatement
-from fhir.resources.R4B.extension import Extension
 from fhir.resources.R4B.operationoutcome import OperationOutcome
 
-from models import EpicTokenResponse
-from util import client_id, fhir_auth, fhir_url, private_key
+import metrics
+import upstream
+from models import EpicTokenResponse, SmartEndpoints
+from query import SearchQuery
+from serializer import loads
+from util import client_id, discovery_ttl, fhir_auth, fhir_url, private_key, token_refresh_skew
 
 logger: logging.Logger = logging.getLogger("main.helpers")
 
 token_object: EpicTokenResponse | None = None
 
+oauth_uris_extension_url: str = "http://fhir-registry.smarthealthit.org/StructureDefinition/oauth-uris"
+smart_endpoints: SmartEndpoints | None = None
+smart_endpoints_lock: asyncio.Lock = asyncio.Lock()
+smart_endpoints_refresh: asyncio.Task | None = None
 
-def get_token_object() -> EpicTokenResponse | OperationOutcome:
+# What fetching the SMART endpoints or a token raises when the FHIR server cannot be reached or its response is not what was expected
+discovery_errors: tuple[type[Exception], ...] = (httpx.HTTPError, ValueError, KeyError)
+
+
+class TokenManager:
+    """
+    Keeps the backend services access token fresh
+
+    Once a token is within refresh_skew seconds of expiring a single background task fetches the next one, and requests keep using the current token until it
+    actually expires. Only when there is no valid token do requests wait, and then they all wait on the same refresh and share its result, failed or not.
+    After a failed refresh no new one starts for a backoff that doubles with each failure from min_backoff up to max_backoff, and requests without a valid
+    token fail straight away in the meantime instead of each posting to the token endpoint.
+    """
+
+    def __init__(self, refresh_skew: float, min_backoff: float = 1.0, max_backoff: float = 60.0) -> None:
+        self.refresh_skew: float = refresh_skew
+        self.min_backoff: float = min_backoff
+        self.max_backoff: float = max_backoff
+        self.token: EpicTokenResponse | None = None
+        self.refreshes: int = 0
+        self.failures: int = 0
+        self.last_refresh_seconds: float = 0.0
+        self.total_refresh_seconds: float = 0.0
+        self.backoff: float = 0.0
+        self.retry_at: float = 0.0
+        self._refresh_task: asyncio.Task | None = None
+
+    def valid(self) -> bool:
+        return self.token is not None and time.time() < self.token.expires
+
+    def needs_refresh(self) -> bool:
+        return self.token is None or time.time() >= self.token.expires - self.refresh_skew
+
+    async def get_token(self) -> EpicTokenResponse | None:
+        if self.valid():
+            if self.needs_refresh():
+                self.start_refresh()
+            return self.token
+        refresh: asyncio.Task | None = self.start_refresh()
+        if refresh is None:
+            logger.warning(f"Not requesting a token for {self.retry_at - time.monotonic():.1f} more seconds after the last refresh failed")
+            return None
+        # Shielded so a request that is cancelled while waiting does not cancel the refresh the other requests are waiting on
+        return await asyncio.shield(refresh)
+
+    def start_refresh(self) -> asyncio.Task | None:
+        """Returns the refresh in flight, or starts one, or returns None while backing off after a failed refresh"""
+
+        if self._refresh_task is None and time.monotonic() >= self.retry_at:
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self) -> EpicTokenResponse | None:
+        start_time: float = time.perf_counter()
+        try:
+            try:
+                with metrics.stage_timer("token_refresh"):
+                    new_token: EpicTokenResponse | None = await get_token()
+            except discovery_errors as exc:
+                logger.error(f"Requesting a new token failed: {exc}")
+                new_token = None
+            refresh_seconds: float = time.perf_counter() - start_time
+            self.last_refresh_seconds = refresh_seconds
+            self.total_refresh_seconds += refresh_seconds
+            if new_token:
+                self.token = new_token
+                self.refreshes += 1
+                self.backoff = 0.0
+                self.retry_at = 0.0
+                logger.info(f"Refreshed token in {refresh_seconds:.3f} seconds")
+            else:
+                self.failures += 1
+                self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+                self.retry_at = time.monotonic() + self.backoff
+                logger.error(f"Token refresh failed after {refresh_seconds:.3f} seconds, {self.failures} failures so far, retrying in {self.backoff:.1f} seconds")
+            return self.token if self.valid() else None
+        finally:
+            self._refresh_task = None
+
+    def stats(self) -> dict[str, int | float | None]:
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_refresh_seconds": round(self.last_refresh_seconds, 4),
+            "average_refresh_seconds": round(self.total_refresh_seconds / (self.refreshes + self.failures), 4) if self.refreshes + self.failures else 0.0,
+            "expires_in_seconds": round(self.token.expires - time.time(), 1) if self.token else None,
+            "backoff_seconds": self.backoff,
+        }
+
+
+token_manager: TokenManager = TokenManager(refresh_skew=token_refresh_skew)
+metrics.register_stats("token", "source", "backend_services", token_manager.stats)
+
+
+async def get_token_object() -> EpicTokenResponse | OperationOutcome:
     global token_object
-    if not token_object or time.time() > token_object.expires:
-        # If FHIR auth not an env var
-        if not fhir_auth:
-            token_object = get_token()
+    # If FHIR auth not an env var
+    if not fhir_auth:
+        token_object = await token_manager.get_token()
+    elif not token_object:
+        if len(fhir_auth.split(" ")) == 2:
+            token_object = EpicTokenResponse(access_token=fhir_auth.split(" ")[1], token_type=fhir_auth.split(" ")[0], expires_in=100000000, expires=99999999999, scope="not applicable")
         else:
-            if len(fhir_auth.split(" ")) == 2:
-                token_object = EpicTokenResponse(access_token=fhir_auth.split(" ")[1], token_type=fhir_auth.split(" ")[0], expires_in=100000000, expires=99999999999, scope="not applicable")
-            else:
-                logger.error('Your FHIR_AUTH did not have a space in it, ensure your env var is formatted correctly. E.g. "Bearer 1233445"')
-                token_object = None
-        if not token_object:
-            return OperationOutcome(issue=[{"severity": "error", "code": "processing", "diagnostics": "There was an issue getting a token for authorization"}])
+            logger.error('Your FHIR_AUTH did not have a space in it, ensure your env var is formatted correctly. E.g. "Bearer 1233445"')
+    if not token_object:
+        return OperationOutcome(issue=[{"severity": "error", "code": "processing", "diagnostics": "There was an issue getting a token for authorization"}])
 
     return token_object
 
 
-def get_token() -> EpicTokenResponse | None:
-    request_jwt: str = create_jwt()
+async def get_token() -> EpicTokenResponse | None:
+    token_url: str = await get_token_url()
+    request_jwt: str = create_jwt(token_url)
 
     request_json = {"grant_type": "client_credentials", "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer", "client_assertion": request_jwt}
-    logger.debug(f"Requesting token using body: {request_json}")
+    logger.debug("Requesting token using body: %s", request_json)
 
-    resp: httpx.Response = httpx.post(get_token_url(), data=request_json)
+    resp: httpx.Response = await upstream.post(token_url, data=request_json)
 
     try:
         resp_dict: dict = resp.json()
@@ -63,45 +163,79 @@ def get_token() -> EpicTokenResponse | None:
     return EpicTokenResponse(**resp_dict)
 
 
-def create_jwt() -> str:
+def create_jwt(token_url: str) -> str:
     exp_time: float = time.time() + 300
 
-    token_url: str = get_token_url()
-
     jwt_payload = {"iss": client_id, "sub": client_id, "aud": token_url, "jti": str(uuid.uuid4()), "exp": int(exp_time)}
-    logger.debug(f"Using JWT Payload of: {jwt_payload}")
+    logger.debug("Using JWT Payload of: %s", jwt_payload)
     encoded: str = jwt.encode(payload=jwt_payload, key=private_key, algorithm="RS384", headers={"alg": "RS384", "typ": "JWT"})  # type: ignore
-    logger.debug(f"Created JWT of: {encoded}")
+    logger.debug("Created JWT of: %s", encoded)
     return encoded
 
 
-def get_token_url() -> str:
-    resp_cap_state: dict = httpx.get(fhir_url + "metadata", headers={"Accept": "application/json"}).json()
-    cap_state: CapabilityStatement = CapabilityStatement(**resp_cap_state)
+async def fetch_smart_endpoints() -> SmartEndpoints:
+    """Reads the SMART oauth-uris extension straight from the CapabilityStatement JSON without validating the whole resource"""
+
+    resp_cap_state: dict = (await upstream.get(fhir_url + "metadata", headers={"Accept": "application/json"})).json()
     logger.info(f"Got CapabilityStatement for URL {fhir_url}")
 
-    oauth_extension: Extension = list(filter(lambda x: x.url == "http://fhir-registry.smarthealthit.org/StructureDefinition/oauth-uris", cap_state.rest[0].security.extension))[0]  # type: ignore
+    oauth_uris: dict[str, str] = {}
+    for rest in resp_cap_state.get("rest", []):
+        for extension in rest.get("security", {}).get("extension", []):
+            if extension.get("url") == oauth_uris_extension_url:
+                oauth_uris = {item["url"]: item["valueUri"] for item in extension.get("extension", []) if "valueUri" in item}
+                break
 
-    token_url: str = list(filter(lambda x: x.url == "token", oauth_extension.extension))[0]  # type: ignore
-    token_url: str = token_url.valueUri  # type: ignore
-    logger.info(f"Found token_url of {token_url}")
+    if "token" not in oauth_uris:
+        raise ValueError(f"The CapabilityStatement at {fhir_url}metadata does not have a token URL in its oauth-uris extension")
 
-    return token_url
+    logger.info(f"Found token_url of {oauth_uris['token']}")
+    return SmartEndpoints(token_url=oauth_uris["token"], authorize_url=oauth_uris.get("authorize"), fetched=time.time())
 
 
-def create_query_string(resource_type: str, search_params) -> str:
-    """Helper function to create a full query string"""
+async def refresh_smart_endpoints() -> SmartEndpoints:
+    global smart_endpoints
+    async with smart_endpoints_lock:
+        # Another request may have finished a refresh while this one was waiting on the lock
+        if smart_endpoints and time.time() - smart_endpoints.fetched < discovery_ttl:
+            return smart_endpoints
+        smart_endpoints = await fetch_smart_endpoints()
+        return smart_endpoints
 
-    query_string: str = f"{resource_type.capitalize()}?"
-    for prop, value in vars(search_params).items():
-        if not value:
-            continue
-        if query_string == f"{resource_type.capitalize()}?":
-            query_string += f"{prop}={value}"
-        else:
-            query_string += f"&{prop}={value}"
 
-    return query_string
+async def background_refresh_smart_endpoints() -> None:
+    global smart_endpoints_refresh
+    try:
+        await refresh_smart_endpoints()
+    except discovery_errors as exc:
+        logger.warning(f"Background refresh of SMART endpoints failed, continuing with the cached endpoints: {exc}")
+    finally:
+        smart_endpoints_refresh = None
+
+
+async def get_smart_endpoints() -> SmartEndpoints:
+    """
+    Returns the cached SMART endpoints
+
+    The first call fetches them, after that an expired entry keeps being served while a single background task refreshes it.
+    """
+
+    global smart_endpoints_refresh
+    if not smart_endpoints:
+        return await refresh_smart_endpoints()
+    if time.time() - smart_endpoints.fetched >= discovery_ttl and smart_endpoints_refresh is None:
+        smart_endpoints_refresh = asyncio.create_task(background_refresh_smart_endpoints())
+    return smart_endpoints
+
+
+async def get_token_url() -> str:
+    return (await get_smart_endpoints()).token_url
+
+
+def create_search_query(resource_type: str, search_params) -> SearchQuery:
+    """Helper function to create the canonical query of a search from the search parameter model of a route"""
+
+    return SearchQuery.from_params(resource_type, vars(search_params).items())
 
 
 def check_response(resource_type: str, resp: httpx.Response) -> OperationOutcome | None:
@@ -114,9 +248,10 @@ def check_response(resource_type: str, resp: httpx.Response) -> OperationOutcome
         return OperationOutcome(issue=[{"severity": "error", "code": "processing", "diagnostics": "There was an issue with authorization"}])  # type: ignore
     elif resp.status_code != 200:
         try:
-            if resp.json()["resourceType"] == "OperationOutcome":
-                logger.error(resp.json())
-                return OperationOutcome(**resp.json())
+            resp_json: dict = loads(resp.content)
+            if resp_json["resourceType"] == "OperationOutcome":
+                logger.error(resp_json)
+                return OperationOutcome(**resp_json)
         except Exception:
             logger.error(f"Something went wrong when trying to search {resource_type}. The response returned with a status code of {resp.status_code} and a body of {resp.text}")
             if "WWW-Authenticate" in resp.headers:
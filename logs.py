@@ -0,0 +1,85 @@
+"""File for the logging pipeline, records are put on a queue by the request path and formatted and written by a background thread"""
+
+import atexit
+import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from models import CustomFormatter
+from serializer import dumps
+from util import access_log_sample_rate
+
+access_logger: logging.Logger = logging.getLogger("main.access")
+
+# Attributes every LogRecord has, anything else on a record came from extra= and is added to JSON output
+record_attributes: frozenset[str] = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object, with the fields passed in extra= next to the message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        log: dict = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        log.update((key, value) for key, value in record.__dict__.items() if key not in record_attributes)
+        if record.exc_info:
+            log["exc_info"] = self.formatException(record.exc_info)
+        return dumps(log).decode()
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    QueueHandler for a listener in the same process
+
+    The stock prepare formats the whole record so it can be pickled, which would put the formatting back on the request path. Here the record is queued
+    as it is, so %-style arguments are only merged into the message on the listener thread and should not be changed after they are logged.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(level: str, log_format: str) -> QueueListener:
+    """Sends the main and fhir.resources loggers through a queue to a single stream handler, which is flushed when the process exits"""
+
+    handler: logging.StreamHandler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if log_format == "json" else CustomFormatter())
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener: QueueListener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler: LocalQueueHandler = LocalQueueHandler(log_queue)
+    main_logger: logging.Logger = logging.getLogger("main")
+    main_logger.setLevel(logging.DEBUG if level == "DEBUG" else logging.INFO)
+    main_logger.addHandler(queue_handler)
+
+    # Handle some fhir.resources warnings
+    fhir_logger: logging.Logger = logging.getLogger("fhir.resources")
+    fhir_logger.setLevel(logging.ERROR)
+    fhir_logger.addHandler(queue_handler)
+    return listener
+
+
+def log_access(method: str, path: str, status_code: int, seconds: float, size: str | None, resource_type: str = "") -> None:
+    """Logs a request, sampling successful ones down to ACCESS_LOG_SAMPLE_RATE"""
+
+    if status_code < 400 and (access_log_sample_rate <= 0 or (access_log_sample_rate < 1 and random.random() >= access_log_sample_rate)):
+        return
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    access_logger.info(
+        "%s %s returned %s in %.2f seconds with a size of %s bytes",
+        method,
+        path,
+        status_code,
+        seconds,
+        size or "unknown",
+        extra={"method": method, "path": path, "status_code": status_code, "seconds": round(seconds, 4), "size": int(size) if size else None, "resource_type": resource_type},
+    )
@@ -2,45 +2,68 @@
 
 import logging
 import time
+from contextlib import asynccontextmanager
 
 import httpx
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
 
+import metrics
+import tracing
 from api import api_router
 from api_passthrough import api_passthrough_router
-from models import CustomFormatter
+from batchHandler import batch_router
+from capability import load_search_index
+from compression import CompressionMiddleware, compression_stats
+from exportHandler import export_router, resume_exports, stop_exports
+from helpers import discovery_errors, refresh_smart_endpoints
+from logs import configure_logging, log_access
+from resilience import UpstreamUnavailable
 from resourceHandler import resource_router
-from util import deploy_url, log_level, passthrough_mode
+from scheduler import SchedulerMiddleware, ip_rate_limiter, rate_limiter, scheduler
+from serializer import FastJSONResponse
+from upstream import close_client, open_client
+from util import compression_enabled, deploy_url, fhir_auth, log_format, log_level, passthrough_mode, server_timing_enabled, upstream_timeout
 
 logger: logging.Logger = logging.getLogger("main")
-logger.setLevel(logging.INFO)
-ch: logging.StreamHandler = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(CustomFormatter())
-logger.addHandler(ch)
-
-if log_level == "DEBUG":
-    logger.info("Logging level is being set to DEBUG")
-    logger.setLevel(logging.DEBUG)
-    ch.setLevel(logging.DEBUG)
-    logger.addHandler(ch)
-else:
-    logger.info("Logging level is at INFO")
-
-# Handle some fhir.resources warnings
-fhir_logger = logging.getLogger("fhir.resources")
-fhir_logger.setLevel(logging.ERROR)
-fhir_logger.addHandler(ch)
+configure_logging(log_level, log_format)
+logger.info(f"Logging level is at {'DEBUG' if log_level == 'DEBUG' else 'INFO'}")
 
-# Making a global timeout for httpx
-httpx._config.DEFAULT_TIMEOUT_CONFIG = httpx.Timeout(timeout=300)
+# Making a global timeout for httpx, for any client created without its own since the upstream client sets UPSTREAM_TIMEOUT itself
+httpx._config.DEFAULT_TIMEOUT_CONFIG = httpx.Timeout(timeout=upstream_timeout)
 
 # ========================== FastAPI variable ==========================
 app_title: str = "FHIRProxy"
 app_version: str = "0.1.0"
-app = FastAPI(title=app_title, version=app_version, swagger_ui_parameters={"operationsSorter": "method"})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Opens the shared upstream client, loads the search parameter index and resumes unfinished exports on startup, and stops them and closes the client on shutdown"""
+    await open_client()
+    if not passthrough_mode and not fhir_auth:
+        try:
+            await refresh_smart_endpoints()
+        except discovery_errors as exc:
+            logger.error(f"Unable to load the SMART endpoints at startup, they will be fetched on the first token request: {exc}")
+    if not passthrough_mode:
+        load_search_index()
+        await resume_exports()
+    yield
+    await stop_exports()
+    await close_client()
+
+
+app = FastAPI(title=app_title, version=app_version, swagger_ui_parameters={"operationsSorter": "method"}, lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Added first so it sits right in front of the routers, with its 429s and 503s still going through CORS, metrics and the access log
+if scheduler is not None or rate_limiter is not None or ip_rate_limiter is not None:
+    app.add_middleware(SchedulerMiddleware)
+
+if compression_enabled:
+    app.add_middleware(CompressionMiddleware)
+    metrics.register_stats("compression", "kind", "responses", lambda: compression_stats)
 
 app.add_middleware(
     CORSMiddleware,
@@ -54,15 +77,42 @@ app.add_middleware(
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     start_time = time.time()
-    response = await call_next(request)
+    metrics.requests_in_flight.inc()
+    started: tuple[tracing.Trace, str | None] | None = tracing.start_trace(request.headers.get("traceparent"))
+    try:
+        with tracing.span("request", parent_id=started[1] if started else None, method=request.method, path=request.url.path):
+            response = await call_next(request)
+            if started and server_timing_enabled:
+                response.headers["Server-Timing"] = tracing.server_timing(started[0])
+    finally:
+        metrics.requests_in_flight.dec()
+        if started:
+            tracing.finish_trace(started[0])
     process_time = time.time() - start_time
-    if "resource_type" in request.path_params:
-        logger.info(f"Resource {request.path_params['resource_type']} query took {process_time:.2f} seconds and has a size of {response.headers['content-length']} bytes")
-    else:
-        logger.info(f"Request took {process_time:.2f} seconds and has a size of {response.headers['content-length']} bytes")
+    route = request.scope.get("route")
+    content_length: str | None = response.headers.get("content-length")
+    metrics.observe_request(
+        method=request.method,
+        route=route.path if route else "unmatched",
+        resource_type=request.path_params.get("resource_type", ""),
+        status_code=response.status_code,
+        seconds=process_time,
+        size=int(content_length) if content_length else None,
+    )
+    log_access(request.method, request.url.path, response.status_code, process_time, content_length, request.path_params.get("resource_type", ""))
     return response
 
 
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable_handler(request: Request, exc: UpstreamUnavailable) -> FastJSONResponse:
+    """Fails fast with a 503 when the circuit breaker is open or the upstream concurrency limit is full, and nothing stale could be served instead"""
+    return FastJSONResponse(
+        {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "transient", "diagnostics": str(exc)}]},
+        status_code=503,
+        headers={"Retry-After": str(max(round(exc.retry_after), 1))},
+    )
+
+
 # ================= App Validation Error Override ======================
 # @app.exception_handler(RequestValidationError)
 # async def validation_exception_handler(request, exc):
@@ -87,6 +137,9 @@ async def add_process_time_header(request: Request, call_next):
 # ========================== Routers inclusion =========================
 if not passthrough_mode:
     app.include_router(api_router, tags=["Main API"])
+    # Included before the resource router so /$export/{job_id} is not matched as a read
+    app.include_router(export_router, tags=["Bulk Export"])
+    app.include_router(batch_router, tags=["Batch"])
     app.include_router(resource_router, tags=["FHIR Resources"])
 else:
     logger.info("Starting up in passthrough mode...")
@@ -0,0 +1,106 @@
+"""File for Prometheus metrics about requests, upstream calls and proxy stages"""
+
+import logging
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+import tracing
+from capability import get_search_index
+
+logger: logging.Logger = logging.getLogger("main.metrics")
+
+metrics_content_type: str = CONTENT_TYPE_LATEST
+
+latency_buckets: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+size_buckets: tuple[float, ...] = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+request_latency: Histogram = Histogram("fhirproxy_request_duration_seconds", "Total time to handle a request", ["method", "route", "resource_type"], buckets=latency_buckets)
+stage_latency: Histogram = Histogram(
+    "fhirproxy_stage_duration_seconds",
+    "Time spent in a single stage of a request, e.g. upstream, token, expansion or serialization",
+    ["stage", "resource_type"],
+    buckets=latency_buckets,
+)
+response_size: Histogram = Histogram("fhirproxy_response_size_bytes", "Size of response bodies sent to clients", ["route", "resource_type"], buckets=size_buckets)
+responses: Counter = Counter("fhirproxy_responses", "Responses sent to clients", ["method", "route", "resource_type", "status_code"])
+searches: Counter = Counter("fhirproxy_searches", "Searches by resource type and the names of their parameters the FHIR server knows", ["resource_type", "params"])
+upstream_responses: Counter = Counter("fhirproxy_upstream_responses", "Responses received from the FHIR server", ["resource_type", "status_code"])
+validations: Counter = Counter("fhirproxy_validations", "Responses from the FHIR server that were validated, or skipped because of VALIDATION_MODE", ["resource_type", "result"])
+scheduler_wait: Histogram = Histogram("fhirproxy_scheduler_wait_seconds", "Time requests waited in their scheduler lane before being handled", ["lane"], buckets=latency_buckets)
+requests_in_flight: Gauge = Gauge("fhirproxy_requests_in_flight", "Requests currently being handled")
+
+# Label values that are not resource types, for routes without one and for calls to the token endpoint and FHIR_URL/metadata
+fixed_resource_type_labels: frozenset[str] = frozenset({"", "token", "metadata"})
+
+
+def resource_type_label(resource_type: str) -> str:
+    """The resource type as a label value, types the FHIR server does not have are all labeled other so clients cannot add label values without limit"""
+    if resource_type in fixed_resource_type_labels or resource_type in get_search_index().resource_types:
+        return resource_type
+    return "other"
+
+
+class StatsCollector(Collector):
+    """Exposes the stats() dictionaries of caches and other components as gauges when /metrics is scraped"""
+
+    def __init__(self) -> None:
+        self.sources: list[tuple[str, str, str, Callable[[], dict]]] = []
+
+    def register(self, subsystem: str, label: str, name: str, stats: Callable[[], dict]) -> None:
+        self.sources.append((subsystem, label, name, stats))
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        families: dict[str, GaugeMetricFamily] = {}
+        for subsystem, label, name, stats in self.sources:
+            for stat, value in stats().items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                metric_name: str = f"fhirproxy_{subsystem}_{stat}"
+                if metric_name not in families:
+                    families[metric_name] = GaugeMetricFamily(metric_name, f"{stat.replace('_', ' ').capitalize()} for the {subsystem.replace('_', ' ')}", labels=[label])
+                families[metric_name].add_metric([name], value)
+        yield from families.values()
+
+
+stats_collector: StatsCollector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def register_stats(subsystem: str, label: str, name: str, stats: Callable[[], dict]) -> None:
+    """Registers a stats() function, e.g. register_stats("cache", "cache", "resources", resource_cache.stats)"""
+    stats_collector.register(subsystem, label, name, stats)
+
+
+@contextmanager
+def stage_timer(stage: str, resource_type: str = "") -> Iterator[None]:
+    """Times a stage for the stage latency histogram, and as a span of the request's trace when tracing is on"""
+
+    start_time: float = time.perf_counter()
+    try:
+        with tracing.span(stage, resource_type=resource_type):
+            yield
+    finally:
+        stage_latency.labels(stage=stage, resource_type=resource_type_label(resource_type)).observe(time.perf_counter() - start_time)
+
+
+def observe_upstream(resource_type: str, status_code: int, seconds: float) -> None:
+    resource_type = resource_type_label(resource_type)
+    upstream_responses.labels(resource_type=resource_type, status_code=str(status_code)).inc()
+    stage_latency.labels(stage="upstream", resource_type=resource_type).observe(seconds)
+
+
+def observe_request(method: str, route: str, resource_type: str, status_code: int, seconds: float, size: int | None) -> None:
+    resource_type = resource_type_label(resource_type)
+    request_latency.labels(method=method, route=route, resource_type=resource_type).observe(seconds)
+    responses.labels(method=method, route=route, resource_type=resource_type, status_code=str(status_code)).inc()
+    if size is not None:
+        response_size.labels(route=route, resource_type=resource_type).observe(size)
+
+
+def render_metrics() -> bytes:
+    return generate_latest(REGISTRY)
@@ -22,10 +22,14 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format_str + reset,
     }
 
+    def __init__(self) -> None:
+        super().__init__()
+        # One formatter per level, built once instead of for every record
+        self.formatters: dict[int, logging.Formatter] = {level: logging.Formatter(log_fmt, "%m/%d/%Y %I:%M:%S %p", style="{") for level, log_fmt in self.FORMATS.items()}
+        self.default_formatter: logging.Formatter = logging.Formatter(self.format_str, "%m/%d/%Y %I:%M:%S %p", style="{")
+
     def format(self, record) -> str:
-        log_fmt: str | None = self.FORMATS.get(record.levelno)
-        formatter: logging.Formatter = logging.Formatter(log_fmt, "%m/%d/%Y %I:%M:%S %p", style="{")
-        return formatter.format(record)
+        return self.formatters.get(record.levelno, self.default_formatter).format(record)
 
 
 class EpicTokenResponse(BaseModel):
@@ -36,6 +40,12 @@ class EpicTokenResponse(BaseModel):
     scope: str
 
 
+class SmartEndpoints(BaseModel):
+    token_url: str
+    authorize_url: Optional[str] = None
+    fetched: float
+
+
 class JWK(BaseModel):
     kid: str
     kty: str = "RSA"
@@ -180,3 +190,9 @@ class MedicationRequestSearchParams(CommonSearchParams):
     reported_boolean: Optional[str] = None
     status: Optional[str] = None
     subject: Optional[str] = None
+
+
+class ExportRequest(BaseModel):
+    patients: list[str] = Field(min_length=1)
+    types: list[str] = Field(min_length=1)
+    typeFilters: dict[str, str] = {}
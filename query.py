@@ -0,0 +1,65 @@
+"""File for the canonical form of a search, parsed once per request and used for the upstream URL, the cache and coalescing keys, logs and metrics"""
+
+from collections.abc import Iterable
+from dataclasses import dataclass
+from urllib.parse import parse_qsl, quote
+
+from util import fhir_url
+
+# Parameters that can only reference a Patient, where patient=Patient/123 and patient=123 are the same search
+patient_reference_params: frozenset[str] = frozenset({"patient"})
+
+
+def normalize_value(name: str, value: str) -> str:
+    if name in patient_reference_params:
+        return value.removeprefix(fhir_url).removeprefix("Patient/")
+    return value
+
+
+@dataclass(frozen=True, slots=True)
+class SearchQuery:
+    """
+    A search as its resource type and its decoded parameters, sorted by name and then value
+
+    Searches that only differ in parameter order, percent-encoding, empty parameters or a Patient/ prefix on a patient reference are equal and have the same key.
+    Repeated parameters are all kept, since e.g. date=ge2024-01-01&date=lt2025-01-01 is a range.
+    """
+
+    resource_type: str
+    params: tuple[tuple[str, str], ...]
+
+    @classmethod
+    def from_params(cls, resource_type: str, params: Iterable[tuple[str, str]]) -> "SearchQuery":
+        return cls(resource_type, tuple(sorted({(name, normalize_value(name, value)) for name, value in params if name and value})))
+
+    @classmethod
+    def parse(cls, resource_type: str, raw_query: str) -> "SearchQuery":
+        """Parses the query string of a request, e.g. patient=123&code=http://loinc.org%7C4548-4"""
+        return cls.from_params(resource_type, parse_qsl(raw_query, keep_blank_values=True))
+
+    def get(self, name: str) -> str | None:
+        return next((value for param, value in self.params if param == name), None)
+
+    def without(self, *names: str) -> "SearchQuery":
+        return SearchQuery(self.resource_type, tuple((name, value) for name, value in self.params if name not in names))
+
+    @property
+    def query(self) -> str:
+        """The parameters percent-encoded in their canonical order, modifiers like code:text are left as they are"""
+        return "&".join(f"{quote(name, safe=':')}={quote(value, safe='')}" for name, value in self.params)
+
+    @property
+    def key(self) -> str:
+        """The search as <resourceType>?<query>, which is the same for every way of writing it"""
+        return f"{self.resource_type}?{self.query}" if self.params else self.resource_type
+
+    @property
+    def names(self) -> tuple[str, ...]:
+        """The distinct parameter names, e.g. category, code and patient, which describe a search without the patient or values in it"""
+        return tuple(dict.fromkeys(name for name, _ in self.params))
+
+    def url(self) -> str:
+        return fhir_url + self.key
+
+    def __str__(self) -> str:
+        return self.key
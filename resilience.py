@@ -0,0 +1,224 @@
+"""File for protecting the FHIR server, and the proxy, when the FHIR server slows down or fails"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+import httpx
+
+logger: logging.Logger = logging.getLogger("main.resilience")
+
+
+class UpstreamUnavailable(httpx.HTTPError):
+    """Raised instead of calling the FHIR server when the circuit breaker is open or no call slot freed up in time"""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after: float = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Limits the calls in flight to the FHIR server with additive increase, multiplicative decrease (AIMD)
+
+    Every call that comes back in time without a 429 or 5xx raises the limit by 1/limit, so roughly by one per round of calls. A call that times out,
+    fails or takes longer than latency_target cuts the limit by backoff, at most once per latency_target so one slow burst does not collapse it.
+    Callers over the limit wait in line for up to queue_timeout, after which UpstreamUnavailable is raised instead of piling up more work.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, latency_target: float, queue_timeout: float, backoff: float = 0.75) -> None:
+        self.limit: float = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit: int = min_limit
+        self.max_limit: int = max_limit
+        self.latency_target: float = latency_target
+        self.queue_timeout: float = queue_timeout
+        self.backoff: float = backoff
+        self.in_flight: int = 0
+        self.rejected: int = 0
+        self.decreases: int = 0
+        self._last_decrease: float = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended, so it is given back
+                self.release(overloaded=False)
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            self.rejected += 1
+            raise UpstreamUnavailable(f"No upstream call slot freed up within {self.queue_timeout} seconds, {self.in_flight} calls are in flight", retry_after=self.latency_target) from None
+
+    def release(self, overloaded: bool | None) -> None:
+        """Frees a slot, adjusting the limit unless overloaded is None, e.g. for a call that was cancelled"""
+
+        self.in_flight -= 1
+        if overloaded:
+            now: float = time.monotonic()
+            if now - self._last_decrease >= self.latency_target:
+                self._last_decrease = now
+                self.decreases += 1
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                logger.warning(f"The FHIR server is slow or failing, lowering the upstream concurrency limit to {int(self.limit)}")
+        elif overloaded is False:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter: asyncio.Future = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def stats(self) -> dict[str, int | float]:
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "queued": len(self._waiters), "rejected": self.rejected, "decreases": self.decreases}
+
+
+class CircuitBreaker:
+    """
+    Stops calling the FHIR server for open_seconds once failure_ratio of the calls in the last window seconds failed
+
+    At least min_calls calls have to be in the window before it can open. After open_seconds, one probe call is let through (half-open):
+    if it succeeds the breaker closes, otherwise it opens again.
+    """
+
+    states: tuple[str, ...] = ("closed", "half-open", "open")
+
+    def __init__(self, failure_ratio: float, min_calls: int, window: float, open_seconds: float) -> None:
+        self.failure_ratio: float = failure_ratio
+        self.min_calls: int = min_calls
+        self.window: float = window
+        self.open_seconds: float = open_seconds
+        self.state: str = "closed"
+        self.opened: int = 0
+        self.rejected: int = 0
+        self._opened_at: float = 0.0
+        self._probing: bool = False
+        self._calls: deque[tuple[float, bool]] = deque()
+
+    def retry_after(self) -> float:
+        return max(self._opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        """Raises UpstreamUnavailable when open, returns True if the call is the half-open probe"""
+
+        if self.state == "open" and self.retry_after() <= 0:
+            self.state = "half-open"
+        if self.state == "closed":
+            return False
+        if self.state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        raise UpstreamUnavailable("The FHIR server is failing or too slow, calls to it are paused", retry_after=self.retry_after() or 1.0)
+
+    def record(self, failed: bool | None, probe: bool) -> None:
+        """Records the result of a call, failed is None for a call that was cancelled before it finished"""
+
+        now: float = time.monotonic()
+        if probe:
+            self._probing = False
+            if failed is None:
+                return
+            if failed:
+                self._open(now)
+            else:
+                logger.info("The FHIR server recovered, closing the circuit breaker")
+                self.state = "closed"
+                self._calls.clear()
+            return
+        if self.state != "closed" or failed is None:
+            return
+
+        self._calls.append((now, failed))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        failures: int = sum(call_failed for _, call_failed in self._calls)
+        if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_ratio:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        logger.error(f"Opening the circuit breaker, calls to the FHIR server are paused for {self.open_seconds} seconds")
+        self.state = "open"
+        self.opened += 1
+        self._opened_at = now
+        self._calls.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        failures: int = sum(call_failed for _, call_failed in self._calls)
+        return {
+            "state": self.states.index(self.state),
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "failure_ratio": round(failures / len(self._calls), 4) if self._calls else 0.0,
+        }
+
+
+class LatencyTracker:
+    """Keeps the latencies of the last size calls and the given percentile of them, recomputed every refresh calls since sorting on every call would add up"""
+
+    def __init__(self, percentile: float, size: int = 1000, refresh: int = 50) -> None:
+        self.percentile: float = percentile
+        self.refresh: int = refresh
+        self.value: float | None = None
+        self._samples: deque[float] = deque(maxlen=size)
+        self._since_refresh: int = 0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self._since_refresh += 1
+        if self._since_refresh >= self.refresh:
+            self._since_refresh = 0
+            ordered: list[float] = sorted(self._samples)
+            self.value = ordered[min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)]
+
+
+class RetryBudget:
+    """
+    Caps retries and hedged requests at ratio of the calls in the last window seconds, plus min_per_second so a quiet proxy can still retry
+
+    A struggling FHIR server makes more calls fail, and without a budget the retries for those would add load right when it can least take it.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, window: float = 10.0) -> None:
+        self.ratio: float = ratio
+        self.min_per_second: float = min_per_second
+        self.window: float = window
+        self.spent: int = 0
+        self.exhausted: int = 0
+        self._calls: deque[float] = deque()
+        self._extras: deque[float] = deque()
+
+    def _prune(self, now: float) -> None:
+        for times in (self._calls, self._extras):
+            while times and times[0] < now - self.window:
+                times.popleft()
+
+    def record_call(self) -> None:
+        now: float = time.monotonic()
+        self._prune(now)
+        self._calls.append(now)
+
+    def try_spend(self) -> bool:
+        now: float = time.monotonic()
+        self._prune(now)
+        if len(self._extras) >= self.ratio * len(self._calls) + self.min_per_second * self.window:
+            self.exhausted += 1
+            return False
+        self._extras.append(now)
+        self.spent += 1
+        return True
+
+    def stats(self) -> dict[str, int | float]:
+        return {"budget_spent": self.spent, "budget_exhausted": self.exhausted}
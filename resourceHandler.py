@@ -1,111 +1,207 @@
 """File for FHIR Resource-based API routes in the application"""
 
+import base64
 import logging
 import typing
 
 import httpx
 from fastapi import APIRouter, Depends, Request
-from fastapi.responses import JSONResponse
-from fastapi_utils.tasks import repeat_every
-from fhir.resources.R4B.bundle import Bundle
+from fastapi.responses import Response, StreamingResponse
 from fhir.resources.R4B.operationoutcome import OperationOutcome
-from fhir.resources.R4B.patient import Patient
-from fhirsearchhelper import run_fhir_query
-from fhirsearchhelper.helpers.conditionhelper import expand_single_condition_onset
-from fhirsearchhelper.helpers.documenthelper import expand_single_document_reference_content
-from fhirsearchhelper.helpers.medicationhelper import expand_single_medication_reference
 from pydantic.error_wrappers import ValidationError
 
-from helpers import check_response, create_query_string, get_token_object
+import metrics
+import upstream
+from cache import CacheEntry, DiskCache, ResourceCache, open_cache
+from capability import get_search_index
+from coalesce import SingleFlight
+from conditional import conditional_stats, not_modified, revalidation_headers, validators
+from expansion import expand_resources
+from helpers import check_response, create_search_query, get_token_object
 from models import ConditionSearchParams, EpicTokenResponse, MedicationRequestSearchParams, ObservationSearchParams, PatientSearchParams
-from util import capability_statement_file, fhir_url
+from query import SearchQuery
+from resilience import UpstreamUnavailable
+from search import run_search, stream_all_pages
+from serializer import FastJSONResponse, dumps, loads
+from util import (
+    cache_backend,
+    cache_default_ttl,
+    cache_error_ttl,
+    cache_max_bytes,
+    cache_path,
+    cache_stale_ttl,
+    cache_ttls,
+    compression_enabled,
+    compression_min_size,
+    fhir_url,
+    search_cache_default_ttl,
+    search_cache_enabled,
+    search_cache_max_bytes,
+    search_cache_ttls,
+)
+from validation import validate_sampled, validate_strict
 
 logger: logging.Logger = logging.getLogger("main.resourceHandler")
 
 accept_header_value: typing.Literal["application/json"] = "application/json"
+all_pages_param: typing.Literal["_proxyAllPages"] = "_proxyAllPages"
 
 resource_router: APIRouter = APIRouter()
 
-cached_resources = {}
+# Cached bodies are only stored gzipped when the compression middleware is there to decompress them for clients that do not accept gzip
+cache_compress_min_size: int | None = compression_min_size if compression_enabled else None
+resource_cache: ResourceCache | DiskCache = open_cache(
+    cache_backend, cache_path, "resources", max_bytes=cache_max_bytes, default_ttl=cache_default_ttl, ttls=cache_ttls, stale_ttl=cache_stale_ttl, compress_min_size=cache_compress_min_size
+)
+search_cache: ResourceCache | DiskCache = open_cache(
+    cache_backend,
+    cache_path,
+    "searches",
+    max_bytes=search_cache_max_bytes,
+    default_ttl=search_cache_default_ttl,
+    ttls=search_cache_ttls,
+    stale_ttl=cache_stale_ttl,
+    compress_min_size=cache_compress_min_size,
+)
+# Reads of these types are checked according to VALIDATION_MODE like search Bundles are, reads of other types are returned as the FHIR server sent them
+validated_read_types: frozenset[str] = frozenset({"Patient"})
+read_flights: SingleFlight = SingleFlight()
+search_flights: SingleFlight = SingleFlight()
 
+metrics.register_stats("cache", "cache", "resources", resource_cache.stats)
+metrics.register_stats("cache", "cache", "searches", search_cache.stats)
+metrics.register_stats("coalescing", "kind", "reads", read_flights.stats)
+metrics.register_stats("coalescing", "kind", "searches", search_flights.stats)
+metrics.register_stats("conditional", "kind", "reads", lambda: conditional_stats)
 
-@resource_router.on_event("startup")
-@repeat_every(seconds=60 * 5, logger=logger)
-def clear_cached_resources():
-    logger.info("Clearing cached resources array...")
-    global cached_resources
-    del cached_resources
-    cached_resources = {}  # noqa: F841
-    logger.info("Finished clearing cached resources!")
 
+def serialize_resource(resource: dict) -> bytes:
+    return dumps(resource)
+
+
+def cached_response(entry: CacheEntry) -> Response:
+    return Response(content=entry.body, status_code=entry.status_code, headers=entry.response_headers(), media_type=accept_header_value)
+
+
+def entry_response(output: CacheEntry | OperationOutcome) -> Response:
+    """The response for a read or search, an OperationOutcome is rendered here since the routes' response_model=dict would reject the model"""
+    if isinstance(output, CacheEntry):
+        return cached_response(output)
+    return FastJSONResponse(output.model_dump(exclude_none=True))
+
+
+async def stale_entry(cache: ResourceCache | DiskCache, key: str, exc: UpstreamUnavailable) -> CacheEntry:
+    """A successful response kept past its TTL, served with a Warning header while the FHIR server is unavailable, otherwise exc is raised again"""
+
+    entry: CacheEntry | None = await cache.aget_stale(key)
+    if entry is None or entry.status_code != 200:
+        raise exc
+    logger.warning(f"Serving a stale copy of {key} since the FHIR server is unavailable: {exc}")
+    return CacheEntry(body=entry.body, status_code=entry.status_code, expires=entry.expires, headers=entry.headers | {"Warning": '110 - "Response is Stale"'}, encoding=entry.encoding)
 
-@resource_router.get("/{resource_type}/{id}", response_model=dict)
-def return_resource_by_id(resource_type: str, id: str) -> OperationOutcome | JSONResponse | dict:
-    """Function for reading a resource given its id"""
 
-    if f"{resource_type}/{id}" in cached_resources:
-        return cached_resources[f"{resource_type}/{id}"]
+async def read_resource(resource_type: str, id: str) -> CacheEntry | OperationOutcome:
+    """Reads a resource from the FHIR server, expands it and stores it in the resource cache"""
 
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+    cache_key: str = f"{resource_type}/{id}"
+    with metrics.stage_timer("token", resource_type):
+        token_object: EpicTokenResponse | OperationOutcome = await get_token_object()
 
     if isinstance(token_object, OperationOutcome):
         return token_object
 
     query_headers = {"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value}
-    resource_read: httpx.Response = httpx.get(fhir_url + f"{resource_type}/{id}", headers=query_headers)
+    # An expired copy is revalidated with a conditional read, so an unchanged resource is not sent and expanded again
+    stale: CacheEntry | None = await resource_cache.aget_stale(cache_key)
+    if stale is not None and stale.status_code == 200:
+        query_headers |= revalidation_headers(resource_type, stale.headers)
+    resource_read: httpx.Response = await upstream.get(fhir_url + f"{resource_type}/{id}", headers=query_headers)
+
+    if resource_read.status_code == 304 and stale is not None:
+        conditional_stats["revalidated"] += 1
+        return await resource_cache.aset(cache_key, resource_type, stale.content, headers=stale.headers)
 
     check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=resource_read)
     if check_output:
-        return_output = JSONResponse(check_output.model_dump(exclude_none=True), status_code=resource_read.status_code, headers=resource_read.headers)
-        cached_resources[f"{resource_type}/{id}"] = return_output
-        return return_output
-
-    resource_obj: dict = resource_read.json()
-
-    match resource_type:
-        case "DocumentReference":
-            doc_ref_output = expand_single_document_reference_content(resource=resource_obj, base_url=fhir_url, query_headers=query_headers)
-            logger.error("check for hitting resource")
-            return_resource_obj = doc_ref_output
-        case "MedicationRequest":
-            med_req_output = expand_single_medication_reference(resource=resource_obj, base_url=fhir_url, query_headers=query_headers)
-            if med_req_output:
-                return_resource_obj = med_req_output
-            else:
-                logger.warning("Unable to expand Medication reference")
-                return_resource_obj = resource_obj
-        case "Condition":
-            condition_output = expand_single_condition_onset(resource=resource_obj, base_url=fhir_url, query_headers=query_headers)
-            if condition_output:
-                return_resource_obj = condition_output
-            else:
-                logger.warning("Unable to add onsetDateTime to resource")
-                return_resource_obj = resource_obj
-        case _:
-            return_resource_obj = resource_obj
-
-    return_output = JSONResponse(return_resource_obj, status_code=resource_read.status_code)
-    cached_resources[f"{resource_type}/{id}"] = return_output
-
-    return return_output
-
-
-@resource_router.get("/{resource_type}", response_model_exclude_none=True)
-def return_resource(resource_type: str, req: Request) -> OperationOutcome | Bundle | None:
-    search_params = dict(req.query_params)
-    query_string = resource_type + "?" + req.url.query
-
-    logger.info(f"Searching {resource_type} with Parameters: {search_params}")
-
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+        return await resource_cache.aset(cache_key, resource_type, serialize_resource(check_output.model_dump(exclude_none=True)), status_code=resource_read.status_code, ttl=cache_error_ttl)
+
+    if resource_type == "Binary" and "json" not in resource_read.headers.get("content-type", "json"):
+        # Some servers return the raw content of a Binary even when JSON is asked for
+        resource_obj: dict = {"resourceType": "Binary", "id": id, "contentType": resource_read.headers["content-type"], "data": base64.b64encode(resource_read.content).decode("utf-8")}
+    else:
+        resource_obj = loads(resource_read.content)
+
+    if resource_type in validated_read_types:
+        try:
+            await validate_strict(resource_type, resource_obj)
+        except ValidationError as err:
+            logger.error(err)
+            return OperationOutcome(issue=[{"severity": "error", "code": "processing", "diagnostics": f"The {resource_type} failed FHIR validation, please see logs for more details"}])  # type: ignore
+
+    with metrics.stage_timer("expansion", resource_type):
+        return_resource_obj = await expand_resource(resource_type, resource_obj)
+
+    with metrics.stage_timer("serialization", resource_type):
+        resource_bytes: bytes = serialize_resource(return_resource_obj)
+    if resource_type in validated_read_types:
+        validate_sampled(resource_type, return_resource_obj)
+
+    return await resource_cache.aset(
+        cache_key, resource_type, resource_bytes, status_code=resource_read.status_code, headers=validators(resource_type, return_resource_obj, resource_bytes, resource_read.headers)
+    )
+
+
+async def expand_resource(resource_type: str, resource_obj: dict) -> dict:
+    """Expands references that clients expect inline, e.g. MedicationRequest.medicationReference into medicationCodeableConcept"""
+
+    expanded: dict | None = (await expand_resources(resource_type, [resource_obj], fetch_reference))[0]
+    if expanded is None:
+        logger.warning(f"Unable to expand {resource_type}/{resource_obj.get('id')}, returning it as read")
+        return resource_obj
+    return expanded
+
+
+async def get_resource_entry(resource_type: str, id: str) -> CacheEntry | OperationOutcome:
+    """Returns a resource from the resource cache, reading it if needed with concurrent reads of the same resource sharing one upstream read and expansion"""
+
+    cache_key: str = f"{resource_type}/{id}"
+    cache_entry: CacheEntry | None = await resource_cache.aget(cache_key)
+    if cache_entry:
+        return cache_entry
+    try:
+        return await read_flights.do(cache_key, lambda: read_resource(resource_type, id))
+    except UpstreamUnavailable as exc:
+        return await stale_entry(resource_cache, cache_key, exc)
+
+
+async def fetch_reference(reference: str) -> dict | None:
+    """Reads a referenced resource like Medication/123 for expansion, going through the resource cache"""
+
+    reference = reference.removeprefix(fhir_url)
+    resource_type, _, id = reference.partition("/")
+    if not id or "/" in id or ":" in resource_type:
+        logger.warning(f"Unable to expand reference {reference} since it is not a relative reference to the FHIR server")
+        return None
+
+    entry: CacheEntry | OperationOutcome = await get_resource_entry(resource_type, id)
+    if isinstance(entry, CacheEntry) and entry.status_code == 200:
+        return loads(entry.content)
+    return None
+
+
+async def first_search_page(query: SearchQuery) -> tuple[dict | OperationOutcome, dict[str, str]]:
+    """Runs a search and returns its first page along with the headers used, so following pages can be fetched with the same token"""
+
+    with metrics.stage_timer("token", query.resource_type):
+        token_object: EpicTokenResponse | OperationOutcome = await get_token_object()
 
     if isinstance(token_object, OperationOutcome):
-        return token_object
+        return token_object, {}
 
     query_headers = {"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value}
 
     try:
-        output_search: Bundle | OperationOutcome | None = run_fhir_query(query=fhir_url + query_string, query_headers=query_headers, capability_statement_file=capability_statement_file, debug=True)
+        return await run_search(query, query_headers, fetch_reference), query_headers
     except ValidationError as err:
         logger.error(err)
         return OperationOutcome(
@@ -113,36 +209,108 @@ def return_resource(resource_type: str, req: Request) -> OperationOutcome | Bund
                 "resourceType": "OperationOutcome",
                 "issue": [{"severity": "error", "code": "processing", "diagnostics": "There was an issue during FHIR validation of the returning object, please see logs for more details"}],
             }
-        )
+        ), query_headers
 
-    return (
-        output_search
-        if output_search
-        else OperationOutcome(**{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": "The query ran into an issue, please check the logs"}]})
-    )
 
+async def search_resources(query: SearchQuery, search_cache_key: str | None) -> CacheEntry | OperationOutcome:
+    """Runs a search, storing the resulting Bundle in the search cache when given a key"""
 
-@resource_router.get("/Patient/{id}", response_model=dict)
-def return_patient(id: str) -> OperationOutcome | dict:
-    """Function for reading a patient given an id"""
+    output_search, _ = await first_search_page(query)
+    if isinstance(output_search, OperationOutcome):
+        return output_search
 
-    resource_type: typing.Literal["Patient"] = "Patient"
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+    with metrics.stage_timer("serialization", query.resource_type):
+        bundle_bytes: bytes = serialize_resource(output_search)
+    if search_cache_key:
+        return await search_cache.aset(search_cache_key, query.resource_type, bundle_bytes)
+    return CacheEntry(body=bundle_bytes, status_code=200, expires=0)
 
-    if isinstance(token_object, OperationOutcome):
-        return token_object
 
-    patient_read: httpx.Response = httpx.get(fhir_url + f"{resource_type}/{id}", headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
+def count_search(query: SearchQuery) -> None:
+    # Only parameter names the FHIR server knows are used in the label, so clients cannot add label values without limit
+    known_params: dict = get_search_index().params.get(query.resource_type, {})
+    metrics.searches.labels(resource_type=metrics.resource_type_label(query.resource_type), params=",".join(name for name in query.names if name in known_params)).inc()
 
-    check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=patient_read)
-    if check_output:
-        return check_output.model_dump(exclude_none=True)
 
-    return Patient(**patient_read.json()).model_dump(exclude_none=True)
+async def get_search_entry(query: SearchQuery, cache_control: str = "") -> CacheEntry | OperationOutcome:
+    """Returns a search Bundle from the search cache, running the search if needed with concurrent identical searches sharing one run"""
 
+    count_search(query)
+    search_key: str = query.key
 
-@resource_router.get("/Patient", response_model_exclude_none=True)
-def search_patient(search_params: PatientSearchParams = Depends(PatientSearchParams)) -> OperationOutcome | Bundle | None:
+    # Cache-Control: no-cache skips reading from the search cache, no-store also skips writing to it
+    cache_control = cache_control.lower()
+    search_cache_key: str | None = search_key if search_cache_enabled and "no-store" not in cache_control else None
+    if search_cache_key and "no-cache" not in cache_control:
+        cache_entry: CacheEntry | None = await search_cache.aget(search_cache_key)
+        if cache_entry:
+            logger.info("Returning cached search results for %s", search_cache_key)
+            return cache_entry
+
+    # Concurrent identical searches share a single run of the query
+    try:
+        return await search_flights.do(search_key, lambda: search_resources(query, search_cache_key))
+    except UpstreamUnavailable as exc:
+        if not search_cache_enabled:
+            raise
+        return await stale_entry(search_cache, search_key, exc)
+
+
+@resource_router.get("/{resource_type}/{id}", response_model=dict)
+async def return_resource_by_id(resource_type: str, id: str, req: Request) -> Response:
+    """Function for reading a resource given its id, answering If-None-Match and If-Modified-Since with 304 when the client's copy is current"""
+
+    read_output: CacheEntry | OperationOutcome = await get_resource_entry(resource_type, id)
+    if not isinstance(read_output, CacheEntry):
+        return entry_response(read_output)
+
+    if read_output.status_code == 200 and not_modified(req.headers, read_output.headers):
+        conditional_stats["not_modified"] += 1
+        return Response(status_code=304, headers={name: value for name, value in read_output.headers.items() if name in ("ETag", "Last-Modified")})
+    return entry_response(read_output)
+
+
+async def search_all_pages(query: SearchQuery) -> Response:
+    """Streams the entries of every page of a search as one Bundle, errors on the first page are returned as usual"""
+
+    count_search(query)
+    first_page, query_headers = await first_search_page(query)
+    if isinstance(first_page, OperationOutcome):
+        return entry_response(first_page)
+    return StreamingResponse(stream_all_pages(query, first_page, query_headers, fetch_reference), media_type=accept_header_value)
+
+
+@resource_router.get("/{resource_type}", response_model_exclude_none=True, response_model=dict)
+async def return_resource(resource_type: str, req: Request) -> Response:
+    # Parsed once into the canonical query, which the upstream URL, the cache and coalescing keys and the logs all use
+    query: SearchQuery = SearchQuery.parse(resource_type, req.url.query)
+    all_pages: bool = (query.get(all_pages_param) or "").lower() == "true"
+    query = query.without(all_pages_param)
+
+    # _proxyAllPages=true follows next links and streams every page back, these searches are not cached or coalesced
+    if all_pages:
+        logger.info("Searching all pages of %s", query)
+        return await search_all_pages(query)
+
+    logger.info("Searching %s", query)
+
+    search_output: CacheEntry | OperationOutcome = await get_search_entry(query, req.headers.get("cache-control", ""))
+
+    return entry_response(search_output)
+
+
+# The generic /{resource_type}/{id} and /{resource_type} routes above are registered first and match these paths, so requests never reach the routes below.
+# return_patient is still called by /get_resource_health, and the search routes document the parameters Epic expects for each type.
+@resource_router.get("/Patient/{id}", response_model=dict)
+async def return_patient(id: str) -> Response:
+    """Function for reading a patient given an id, through the same cached and validated read as the generic read route"""
+
+    read_output: CacheEntry | OperationOutcome = await get_resource_entry("Patient", id)
+    return entry_response(read_output)
+
+
+@resource_router.get("/Patient", response_model=dict)
+async def search_patient(search_params: PatientSearchParams = Depends(PatientSearchParams)) -> Response:
     """
     Function to search Patient resources
 
@@ -156,29 +324,16 @@ def search_patient(search_params: PatientSearchParams = Depends(PatientSearchPar
 
     """
 
-    logger.info(f"Searching Patient with Parameters: {search_params}")
-
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
-
-    if isinstance(token_object, OperationOutcome):
-        return token_object
-
-    query_headers = {"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value}
-
-    query_string: str = create_query_string(resource_type="Patient", search_params=search_params)
-
-    patient_search: Bundle | OperationOutcome | None = run_fhir_query(query=fhir_url + query_string, query_headers=query_headers, capability_statement_file=capability_statement_file, debug=True)
+    logger.info("Searching Patient with Parameters: %s", search_params)
 
-    # patient_search: httpx.Response = httpx.get(fhir_url+query_string, headers=query_headers)
+    # Goes through the same search path as the other resource types, so unsupported parameters are found with the preloaded CapabilityStatement index
+    patient_search: CacheEntry | OperationOutcome = await get_search_entry(create_search_query(resource_type="Patient", search_params=search_params))
 
-    # check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=patient_search)
-    # if check_output:
-    #     return check_output
-    return patient_search
+    return entry_response(patient_search)
 
 
 @resource_router.get("/Condition", response_model=dict)
-def search_condition(search_params: ConditionSearchParams = Depends(ConditionSearchParams)) -> OperationOutcome | Bundle:
+async def search_condition(search_params: ConditionSearchParams = Depends(ConditionSearchParams)) -> OperationOutcome | Response:
     """
     Function to search Condition resources
 
@@ -190,26 +345,27 @@ def search_condition(search_params: ConditionSearchParams = Depends(ConditionSea
     """
 
     resource_type: typing.Literal["Condition"] = "Condition"
-    logger.info(f"Searching {resource_type} with Parameters: {search_params.not_null()}")
+    logger.info("Searching %s with Parameters: %s", resource_type, search_params.not_null())
 
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+    with metrics.stage_timer("token", resource_type):
+        token_object: EpicTokenResponse | OperationOutcome = await get_token_object()
 
     if isinstance(token_object, OperationOutcome):
         return token_object
 
-    query_string: str = create_query_string(resource_type=resource_type, search_params=search_params)
+    query: SearchQuery = create_search_query(resource_type=resource_type, search_params=search_params)
 
-    condition_search: httpx.Response = httpx.get(fhir_url + query_string, headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
+    condition_search: httpx.Response = await upstream.get(query.url(), headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
 
     check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=condition_search)
     if check_output:
         return check_output
 
-    return condition_search.json()
+    return Response(content=condition_search.content, media_type=accept_header_value)
 
 
 @resource_router.get("/Observation", response_model=dict)
-def search_observation(search_params: ObservationSearchParams = Depends(ObservationSearchParams)) -> OperationOutcome | Bundle:
+async def search_observation(search_params: ObservationSearchParams = Depends(ObservationSearchParams)) -> OperationOutcome | Response:
     """
     Function to search Observation resources
 
@@ -218,26 +374,27 @@ def search_observation(search_params: ObservationSearchParams = Depends(Observat
     Must contain category or code, code would be a better option for specifics
     """
     resource_type: typing.Literal["Observation"] = "Observation"
-    logger.info(f"Searching {resource_type} with Parameters: {search_params.not_null()}")
+    logger.info("Searching %s with Parameters: %s", resource_type, search_params.not_null())
 
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+    with metrics.stage_timer("token", resource_type):
+        token_object: EpicTokenResponse | OperationOutcome = await get_token_object()
 
     if isinstance(token_object, OperationOutcome):
         return token_object
 
-    query_string: str = create_query_string(resource_type=resource_type, search_params=search_params)
+    query: SearchQuery = create_search_query(resource_type=resource_type, search_params=search_params)
 
-    observation_search: httpx.Response = httpx.get(fhir_url + query_string, headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
+    observation_search: httpx.Response = await upstream.get(query.url(), headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
 
     check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=observation_search)
     if check_output:
         return check_output
 
-    return observation_search.json()
+    return Response(content=observation_search.content, media_type=accept_header_value)
 
 
 @resource_router.get("/MedicationRequest", response_model=dict)
-def search_medication_request(search_params: MedicationRequestSearchParams = Depends(MedicationRequestSearchParams)) -> OperationOutcome | Bundle:
+async def search_medication_request(search_params: MedicationRequestSearchParams = Depends(MedicationRequestSearchParams)) -> OperationOutcome | Response:
     """
     Function to search MedicationRequest resources
 
@@ -248,19 +405,20 @@ def search_medication_request(search_params: MedicationRequestSearchParams = Dep
     This is no longer the case. The R4 version of this resource returns patient-reported medications with the reportedBoolean element set to True.
     """
     resource_type: typing.Literal["MedicationRequest"] = "MedicationRequest"
-    logger.info(f"Searching {resource_type} with Parameters: {search_params.not_null()}")
+    logger.info("Searching %s with Parameters: %s", resource_type, search_params.not_null())
 
-    token_object: EpicTokenResponse | OperationOutcome = get_token_object()
+    with metrics.stage_timer("token", resource_type):
+        token_object: EpicTokenResponse | OperationOutcome = await get_token_object()
 
     if isinstance(token_object, OperationOutcome):
         return token_object
 
-    query_string: str = create_query_string(resource_type=resource_type, search_params=search_params)
+    query: SearchQuery = create_search_query(resource_type=resource_type, search_params=search_params)
 
-    mr_search: httpx.Response = httpx.get(fhir_url + query_string, headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
+    mr_search: httpx.Response = await upstream.get(query.url(), headers={"Authorization": f"{token_object.token_type} {token_object.access_token}", "Accept": accept_header_value})
 
     check_output: OperationOutcome | None = check_response(resource_type=resource_type, resp=mr_search)
     if check_output:
         return check_output
 
-    return mr_search.json()
+    return Response(content=mr_search.content, media_type=accept_header_value)
@@ -0,0 +1,275 @@
+"""File for sharing the proxy fairly between clients, with a token bucket rate limit per client and weighted priority lanes for reads, searches and bulk work"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import re
+import time
+from collections import OrderedDict
+
+import jwt
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import metrics
+import tracing
+from serializer import FastJSONResponse
+from util import (
+    client_id_header,
+    client_ip_rate_burst,
+    client_ip_rate_limit,
+    client_rate_burst,
+    client_rate_limit,
+    scheduler_concurrency,
+    scheduler_queue_timeout,
+    scheduler_weights,
+)
+
+logger: logging.Logger = logging.getLogger("main.scheduler")
+
+lanes: tuple[str, ...] = ("read", "search", "bulk")
+# Resource types start with a capital, so /Patient/123 is a read and /Observation a search while /metrics or /health are not scheduled
+resource_path_pattern: re.Pattern[str] = re.compile(r"/[A-Z][A-Za-z]*(/[^/]+)?")
+
+
+def request_lane(method: str, path: str, query_string: bytes) -> str | None:
+    """The lane of a request, bulk for batches, export kick-offs and searches that follow every page, None for requests that are not scheduled"""
+
+    if method == "POST" and path in ("/", "/$export"):
+        return "bulk"
+    match: re.Match[str] | None = resource_path_pattern.fullmatch(path)
+    if match is None or method != "GET":
+        return None
+    if match.group(1):
+        return "read"
+    return "bulk" if b"_proxyallpages=true" in query_string.lower() else "search"
+
+
+def client_ip(scope: Scope) -> str:
+    client: tuple[str, int] | None = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+def client_key(scope: Scope) -> str:
+    """Who a request says it is from, its API key, or else the subject of its bearer token, or else its IP address"""
+
+    headers: Headers = Headers(scope=scope)
+    api_key: str | None = headers.get(client_id_header)
+    if api_key:
+        # Hashed so API keys are not kept in memory or written to the logs
+        return f"key:{hashlib.blake2b(api_key.encode('utf-8'), digest_size=8).hexdigest()}"
+    authorization: str = headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        try:
+            # Only used to tell clients apart, so the signature is not checked here
+            subject: str | None = jwt.decode(authorization[7:], options={"verify_signature": False}).get("sub")
+        except jwt.PyJWTError:
+            subject = None
+        if subject:
+            return f"sub:{subject}"
+    return client_ip(scope)
+
+
+class TokenBucket:
+    """Holds up to burst tokens and refills rate tokens per second, each request takes one"""
+
+    __slots__ = ("burst", "rate", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated: float = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Takes a token, returning 0 or the seconds until one will be available"""
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter:
+    """A token bucket per client, only the max_clients most recently seen clients are kept"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000) -> None:
+        self.rate: float = rate
+        self.burst: float = max(burst, 1.0)
+        self.max_clients: int = max_clients
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def take(self, client: str) -> float:
+        bucket: TokenBucket | None = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket.take(time.monotonic())
+
+    def give_back(self, client: str) -> None:
+        """Returns the token of a request that was turned away by another limit"""
+
+        bucket: TokenBucket | None = self._buckets.get(client)
+        if bucket is not None:
+            bucket.give_back()
+
+
+class FairScheduler:
+    """
+    Lets at most concurrency requests be handled at once, queueing the rest by weighted fair queuing
+
+    Each waiting request gets a virtual finish time of 1/weight of its lane past the later of the current virtual time and the finish time of the request before it
+    from the same client in the same lane, and the earliest is handled next. Reads are picked ahead of searches and searches ahead of bulk work in proportion to the
+    lane weights without starving any lane, and a client with many queued requests in a lane takes turns with the other clients there instead of going first.
+    """
+
+    def __init__(self, concurrency: int, weights: dict[str, float], queue_timeout: float) -> None:
+        self.concurrency: int = concurrency
+        self.weights: dict[str, float] = weights
+        self.queue_timeout: float = queue_timeout
+        self.in_flight: int = 0
+        self.virtual_time: float = 0.0
+        self._finish_times: dict[tuple[str, str], float] = {}
+        self._queue: list[tuple[float, int, str, asyncio.Future]] = []
+        self._sequence: itertools.count = itertools.count()
+        self.queued: dict[str, int] = dict.fromkeys(lanes, 0)
+        self.admitted: dict[str, int] = dict.fromkeys(lanes, 0)
+        self.timed_out: dict[str, int] = dict.fromkeys(lanes, 0)
+
+    async def acquire(self, lane: str, client: str) -> bool:
+        """Waits for a slot, returning False if none was handed over within queue_timeout"""
+
+        if self.in_flight < self.concurrency and not self._queue:
+            self.in_flight += 1
+            self.admitted[lane] += 1
+            metrics.scheduler_wait.labels(lane=lane).observe(0.0)
+            return True
+
+        finish_time: float = max(self.virtual_time, self._finish_times.get((lane, client), 0.0)) + 1 / self.weights.get(lane, 1.0)
+        self._finish_times[(lane, client)] = finish_time
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (finish_time, next(self._sequence), lane, waiter))
+        self.queued[lane] += 1
+        start_time: float = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended, so it is given back
+                self.release()
+            else:
+                waiter.cancel()
+                self.queued[lane] -= 1
+                self.dispatch()
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            self.timed_out[lane] += 1
+            return False
+        finally:
+            metrics.scheduler_wait.labels(lane=lane).observe(time.perf_counter() - start_time)
+        self.admitted[lane] += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """Hands free slots to the waiting requests with the earliest finish times, dropping requests that stopped waiting so the first one in the queue is always waiting"""
+
+        while self._queue and (self._queue[0][3].done() or self.in_flight < self.concurrency):
+            finish_time, _, lane, waiter = heapq.heappop(self._queue)
+            if waiter.done():
+                continue
+            self.queued[lane] -= 1
+            self.virtual_time = finish_time
+            self.in_flight += 1
+            waiter.set_result(None)
+        if not self._queue:
+            # With nothing waiting no client is behind any other, so earlier finish times no longer count
+            self._finish_times.clear()
+
+    def stats(self, lane: str) -> dict[str, int]:
+        return {"queue_depth": self.queued[lane], "admitted": self.admitted[lane], "timed_out": self.timed_out[lane]}
+
+
+scheduler: FairScheduler | None = FairScheduler(scheduler_concurrency, scheduler_weights, scheduler_queue_timeout) if scheduler_concurrency > 0 else None
+rate_limiter: RateLimiter | None = RateLimiter(client_rate_limit, client_rate_burst) if client_rate_limit > 0 else None
+ip_rate_limiter: RateLimiter | None = RateLimiter(client_ip_rate_limit, client_ip_rate_burst) if client_ip_rate_limit > 0 else None
+rate_limited: dict[str, int] = dict.fromkeys(lanes, 0)
+
+for lane_name in lanes:
+    metrics.register_stats("scheduler", "lane", lane_name, lambda lane=lane_name: (scheduler.stats(lane) if scheduler else {}) | {"rate_limited": rate_limited[lane]})
+
+
+def outcome_response(status_code: int, diagnostics: str, retry_after: float) -> FastJSONResponse:
+    return FastJSONResponse(
+        {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "throttled" if status_code == 429 else "transient", "diagnostics": diagnostics}]},
+        status_code=status_code,
+        headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+    )
+
+
+class SchedulerMiddleware:
+    """Rate limits each client and each IP address with a 429 and then waits for a slot from the scheduler, in front of the FHIR routes"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        fair_scheduler: FairScheduler | None = scheduler,
+        client_limiter: RateLimiter | None = rate_limiter,
+        ip_limiter: RateLimiter | None = ip_rate_limiter,
+    ) -> None:
+        self.app: ASGIApp = app
+        self.scheduler: FairScheduler | None = fair_scheduler
+        self.rate_limiter: RateLimiter | None = client_limiter
+        self.ip_rate_limiter: RateLimiter | None = ip_limiter
+
+    def retry_after(self, ip: str, client: str) -> float:
+        """0 if the request is within the limits of both its client and its IP address, else the seconds until it would be"""
+
+        if self.rate_limiter is not None and (retry_after := self.rate_limiter.take(client)):
+            return retry_after
+        if self.ip_rate_limiter is not None and (retry_after := self.ip_rate_limiter.take(ip)):
+            # The request is not handled, so it does not count against its client
+            if self.rate_limiter is not None:
+                self.rate_limiter.give_back(client)
+            return retry_after
+        return 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        lane: str | None = request_lane(scope["method"], scope["path"], scope["query_string"]) if scope["type"] == "http" else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+
+        client, ip = client_key(scope), client_ip(scope)
+        if retry_after := self.retry_after(ip, client):
+            rate_limited[lane] += 1
+            logger.warning("Rate limited %s from %s on a %s request", client, ip, lane)
+            await outcome_response(429, "Too many requests, please slow down", retry_after)(scope, receive, send)
+            return
+
+        if self.scheduler is None:
+            await self.app(scope, receive, send)
+            return
+        with tracing.span("queue", lane=lane):
+            admitted: bool = await self.scheduler.acquire(lane, client)
+        if not admitted:
+            await outcome_response(503, f"The proxy is busy, no slot freed up within {self.scheduler.queue_timeout} seconds", self.scheduler.queue_timeout)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.scheduler.release()
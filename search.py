@@ -0,0 +1,292 @@
+"""File for running searches against the FHIR server, filtering on the search parameters it does not support and expanding the results"""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from dataclasses import dataclass
+from urllib.parse import quote
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.operationoutcome import OperationOutcome
+from fhirsearchhelper.helpers.fhirfilter import filter_bundle
+from fhirsearchhelper.models.models import QuerySearchParams
+from pydantic import ValidationError
+
+import metrics
+import upstream
+from capability import get_search_index
+from expansion import Fetch, expand_resources
+from helpers import check_response
+from query import SearchQuery
+from serializer import dumps, loads
+from util import fhir_url, paging_max_bytes, paging_max_entries, paging_prefetch
+from validation import validate_resource, validate_sampled, validate_strict
+
+logger: logging.Logger = logging.getLogger("main.search")
+
+
+def empty_bundle(url: str) -> dict:
+    return {"resourceType": "Bundle", "type": "searchset", "total": 0, "link": [{"relation": "self", "url": url}]}
+
+
+def filter_params(query: SearchQuery) -> QuerySearchParams:
+    """The parameters for filter_bundle, whose code filter splits on %2C and %7C while its other filters match the decoded values"""
+    return QuerySearchParams(resourceType=query.resource_type, searchParams={name: quote(value, safe=":/") if name == "code" else value for name, value in query.params})
+
+
+def filter_search_bundle(bundle_json: dict, search_params: QuerySearchParams, gap_output: list[str]) -> dict:
+    """Filters the Bundle on the parameters the FHIR server ignored, which validates it since filter_bundle works on the models"""
+
+    bundle: Bundle = validate_resource(search_params.resourceType, bundle_json)  # type: ignore
+    if not bundle.entry:
+        return bundle_json
+
+    # Dumping models is slower than validating them, so only the entries that matched are dumped back into the Bundle
+    filtered_bundle: Bundle = filter_bundle(input_bundle=bundle, search_params=search_params, gap_analysis_output=gap_output)
+    bundle_json["entry"] = [entry.model_dump(mode="json", exclude_none=True) for entry in filtered_bundle.entry or []]
+    bundle_json["total"] = filtered_bundle.total
+    return bundle_json
+
+
+def drop_operation_outcomes(bundle_json: dict) -> None:
+    """Epic returns warnings as OperationOutcome entries, these are logged and removed so the Bundle only holds matches"""
+
+    outcomes: list[dict] = [entry["resource"] for entry in bundle_json.get("entry", []) if entry.get("resource", {}).get("resourceType") == "OperationOutcome"]
+    if not outcomes:
+        return
+    messages: set[str | None] = {issue.get("diagnostics", issue.get("details", {}).get("text")) for outcome in outcomes for issue in outcome.get("issue", [])}
+    logger.warning(f"There were {len(outcomes)} OperationOutcomes in the returned Bundle with diagnostics or details of {messages}")
+    bundle_json["entry"] = [entry for entry in bundle_json["entry"] if entry.get("resource", {}).get("resourceType") != "OperationOutcome"]
+
+
+def remove_empty_address_lines(bundle_json: dict) -> None:
+    for entry in bundle_json.get("entry", []):
+        for address in entry.get("resource", {}).get("address", []):
+            if "line" in address:
+                address["line"] = [line for line in address["line"] if line]
+
+
+async def expand_entries(resource_type: str, bundle_json: dict, fetch: Fetch) -> None:
+    """Expands every entry of the Bundle concurrently, dropping entries that could not be expanded"""
+
+    entries: list[dict] = bundle_json.get("entry", [])
+    if not entries:
+        return
+
+    with metrics.stage_timer("expansion", resource_type):
+        expanded: list[dict | None] = await expand_resources(resource_type, [entry["resource"] for entry in entries], fetch)
+
+    bundle_json["entry"] = [entry for entry, resource in zip(entries, expanded) if resource is not None]
+    if len(bundle_json["entry"]) != len(entries):
+        logger.warning(f"Dropped {len(entries) - len(bundle_json['entry'])} {resource_type} entries that could not be expanded")
+        bundle_json["total"] = len(bundle_json["entry"])
+
+
+@dataclass(slots=True)
+class SearchPlan:
+    """A search split into what is sent to the FHIR server and the parameters it does not support, which are filtered on"""
+
+    resource_type: str
+    search_params: QuerySearchParams
+    gap_output: list[str]
+    upstream_query: str
+
+
+def plan_search(query: SearchQuery) -> SearchPlan:
+    gap_output: list[str] = get_search_index().unsupported_params(query.resource_type, dict(query.params))
+    logger.debug("Search parameters %s are not supported by the FHIR server and will be filtered on", gap_output)
+
+    return SearchPlan(query.resource_type, filter_params(query), gap_output, query.without(*gap_output).url())
+
+
+async def fetch_search_page(resource_type: str, url: str, query_headers: dict[str, str]) -> dict | OperationOutcome:
+    """Gets one page of search results from the FHIR server"""
+
+    search_response: httpx.Response = await upstream.get(url, headers=query_headers)
+
+    if search_response.status_code == 400:
+        logger.warning(
+            "The query responded with a status code of 400 Bad Request. Most likely this is due to using an incorrect codesystem when searching a code, "
+            "e.g. searching CPT or HCPCS codes on an Observation. Returning an empty Bundle."
+        )
+        return empty_bundle(url)
+    if search_response.status_code != 200:
+        return check_response(resource_type=resource_type, resp=search_response) or OperationOutcome(
+            issue=[{"severity": "error", "code": "processing", "diagnostics": f"The search responded with a status code of {search_response.status_code}"}]  # type: ignore
+        )
+
+    return loads(search_response.content)
+
+
+async def process_search_page(plan: SearchPlan, bundle_json: dict, fetch: Fetch) -> dict:
+    """Filters and expands one page of search results"""
+
+    resource_type: str = plan.resource_type
+    drop_operation_outcomes(bundle_json)
+    remove_empty_address_lines(bundle_json)
+
+    # Medications are expanded before filtering since searching on code matches the expanded medicationCodeableConcept
+    if resource_type == "MedicationRequest":
+        await expand_entries(resource_type, bundle_json, fetch)
+
+    filtered: bool = bool(plan.gap_output and bundle_json.get("entry"))
+    with metrics.stage_timer("filtering", resource_type):
+        if filtered:
+            bundle_json = await run_in_threadpool(filter_search_bundle, bundle_json, plan.search_params, plan.gap_output)
+        else:
+            await validate_strict(resource_type, bundle_json)
+    logger.info("Size of %s Bundle after filtering is %s resources", resource_type, bundle_json.get("total", len(bundle_json.get("entry", []))))
+
+    if resource_type == "DocumentReference" or (
+        resource_type == "Condition"
+        and any(
+            coding.get("code") == "encounter-diagnosis" for entry in bundle_json.get("entry", []) for category in entry["resource"].get("category", []) for coding in category.get("coding", [])[:1]
+        )
+    ):
+        await expand_entries(resource_type, bundle_json, fetch)
+
+    if not filtered:
+        validate_sampled(resource_type, bundle_json)
+    return bundle_json
+
+
+async def run_search(query: SearchQuery, query_headers: dict[str, str], fetch: Fetch) -> dict | OperationOutcome:
+    """
+    Runs a search, returning the first page of results as a searchset Bundle dictionary
+
+    Parameters the FHIR server does not support are removed from the upstream query and applied by filtering the returned Bundle instead.
+    MedicationRequest, Condition and DocumentReference results are expanded using fetch, which each distinct reference goes through once.
+    """
+
+    resource_type: str = query.resource_type
+
+    if resource_type not in get_search_index().resource_types:
+        logger.error(f"Resource {resource_type} is not supported for searching, returning empty Bundle")
+        return empty_bundle(fhir_url + resource_type)
+
+    if not query.params:
+        logger.error("No search params, Epic does not support pulling all resources of a given type with no search parameters. Please refine your query.")
+        no_params_search: httpx.Response = await upstream.get(fhir_url + resource_type, headers=query_headers)
+        return check_response(resource_type=resource_type, resp=no_params_search) or OperationOutcome(
+            issue=[{"severity": "error", "code": "processing", "diagnostics": "Searching without search parameters is not supported, please refine your query"}]  # type: ignore
+        )
+
+    plan: SearchPlan = plan_search(query)
+    first_page: dict | OperationOutcome = await fetch_search_page(resource_type, plan.upstream_query, query_headers)
+    if isinstance(first_page, OperationOutcome):
+        return first_page
+
+    return await process_search_page(plan, first_page, fetch)
+
+
+def next_page_url(bundle_json: dict) -> str | None:
+    """The next link of a page, only followed when it points back at the FHIR server since the request's token is sent along"""
+
+    next_url: str | None = next((link.get("url") for link in bundle_json.get("link", []) if link.get("relation") == "next"), None)
+    if next_url and not next_url.startswith(fhir_url):
+        logger.warning(f"Not following next link {next_url} since it is not on the FHIR server")
+        return None
+    return next_url
+
+
+async def prefetch_pages(resource_type: str, next_url: str | None, query_headers: dict[str, str], pages: asyncio.Queue) -> None:
+    """
+    Fetches the following pages ahead of the client, the bounded queue keeps it at most PAGING_PREFETCH pages ahead
+
+    A page that fails with an HTTP or JSON error, e.g. the FHIR server being unreachable or the circuit breaker being open, is put on the queue as an
+    OperationOutcome. The queue always ends with None so the consumer is never left waiting, and any other error is raised from the task after it.
+    """
+
+    try:
+        while next_url:
+            page: dict | OperationOutcome = await fetch_search_page(resource_type, next_url, query_headers)
+            await pages.put(page)
+            if isinstance(page, OperationOutcome):
+                break
+            next_url = next_page_url(page)
+    except (httpx.HTTPError, ValueError) as exc:
+        logger.error(f"Fetching {next_url} failed: {exc!r}")
+        await pages.put(OperationOutcome(issue=[{"severity": "error", "code": "transient", "diagnostics": f"The page could not be fetched from the FHIR server: {exc!r}"}]))  # type: ignore
+    except Exception:
+        await pages.put(None)
+        raise
+    await pages.put(None)
+
+
+def outcome_entry(diagnostics: str, severity: str = "warning") -> bytes:
+    outcome: dict = {"resourceType": "OperationOutcome", "issue": [{"severity": severity, "code": "incomplete", "diagnostics": diagnostics}]}
+    return dumps({"resource": outcome, "search": {"mode": "outcome"}})
+
+
+async def all_pages(query: SearchQuery, first_page: dict, query_headers: dict[str, str], fetch: Fetch) -> AsyncIterator[dict | OperationOutcome]:
+    """
+    Yields the first page of a search and then every following page, filtered and expanded like the first
+
+    The following pages are fetched ahead of the consumer. A page that could not be retrieved or validated is yielded as an OperationOutcome and ends the iteration.
+    """
+
+    yield first_page
+
+    next_url: str | None = next_page_url(first_page)
+    if not query.params or not next_url:
+        return
+
+    plan: SearchPlan = plan_search(query)
+    pages: asyncio.Queue[dict | OperationOutcome | None] = asyncio.Queue(maxsize=paging_prefetch)
+    prefetch: asyncio.Task = asyncio.create_task(prefetch_pages(query.resource_type, next_url, query_headers, pages))
+    try:
+        while (page := await pages.get()) is not None:
+            if isinstance(page, OperationOutcome):
+                yield page
+                return
+            try:
+                yield await process_search_page(plan, page, fetch)
+            except ValidationError as err:
+                logger.error(err)
+                yield OperationOutcome(issue=[{"severity": "error", "code": "processing", "diagnostics": "The page failed FHIR validation, please see logs for more details"}])  # type: ignore
+                return
+        # Raises any error that stopped the prefetching
+        await prefetch
+    finally:
+        prefetch.cancel()
+
+
+async def stream_all_pages(query: SearchQuery, first_page: dict, query_headers: dict[str, str], fetch: Fetch) -> AsyncIterator[bytes]:
+    """
+    Streams a single searchset Bundle with the entries of every page, following next links while the client is sent the pages before them
+
+    Stops at PAGING_MAX_ENTRIES entries or PAGING_MAX_BYTES bytes, adding an OperationOutcome entry when the results were cut short.
+    """
+
+    self_links: list[dict] = [link for link in first_page.get("link", []) if link.get("relation") == "self"]
+    head: bytes = dumps({"resourceType": "Bundle", "type": "searchset"} | ({"link": self_links} if self_links else {}))[:-1] + b',"entry":['
+    entries: int = 0
+    sent_bytes: int = len(head)
+    page_count: int = 0
+    outcome: bytes | None = None
+
+    yield head
+    async with aclosing(all_pages(query, first_page, query_headers, fetch)) as pages:
+        async for page in pages:
+            page_count += 1
+            if isinstance(page, OperationOutcome):
+                outcome = outcome_entry(f"Page {page_count} of the search could not be retrieved, results are incomplete: {page.model_dump_json(exclude_none=True)}", "error")
+                break
+            for entry in page.get("entry", []):
+                entry_bytes: bytes = dumps(entry)
+                if entries >= paging_max_entries or sent_bytes + len(entry_bytes) > paging_max_bytes:
+                    outcome = outcome_entry(f"Results were limited to {entries} entries from {page_count} pages, please refine your query")
+                    break
+                yield entry_bytes if entries == 0 else b"," + entry_bytes
+                entries += 1
+                sent_bytes += len(entry_bytes) + 1
+            if outcome:
+                break
+
+    logger.info("Streamed %s %s entries from %s pages", entries, query.resource_type, page_count)
+    if outcome:
+        yield (b"," if entries else b"") + outcome
+    yield f'],"total":{entries}}}'.encode()
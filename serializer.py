@@ -0,0 +1,28 @@
+"""File for the orjson-backed JSON encoding and response class used by every router"""
+
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON bytes, the same as json.dumps with separators=(",", ":") except that non-ASCII characters are written as UTF-8 instead of escaped"""
+    return orjson.dumps(obj)
+
+
+def loads(data: bytes | str) -> Any:
+    return orjson.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson
+
+    Bytes are sent as they are, so handlers can return an upstream or cached body that is already JSON without decoding and encoding it again.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
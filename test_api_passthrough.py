@@ -0,0 +1,83 @@
+import asyncio
+import gzip
+import json
+from collections.abc import AsyncIterator
+
+import httpx
+from fastapi import FastAPI
+
+import api_passthrough
+import upstream
+from util import fhir_url
+
+bundle: bytes = json.dumps({"resourceType": "Bundle", "type": "searchset", "total": 3, "entry": [{"resource": {"resourceType": "Observation", "id": str(i)}} for i in range(3)]}).encode()
+
+
+async def chunks(body: bytes, size: int = 16) -> AsyncIterator[bytes]:
+    for start in range(0, len(body), size):
+        yield body[start : start + size]
+
+
+def relay(handler, path: str, headers: dict[str, str] | None = None) -> tuple[list[str], httpx.Response]:
+    """Sends a request to the passthrough routes with the FHIR_URL answered by handler, returning the upstream URLs and the response"""
+
+    app = FastAPI()
+    app.include_router(api_passthrough.api_passthrough_router)
+    requested: list[str] = []
+
+    def recording_handler(request: httpx.Request) -> httpx.Response:
+        requested.append(str(request.url))
+        return handler(request)
+
+    async def main() -> httpx.Response:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(recording_handler))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+                return await client.get(path, headers=headers)
+        finally:
+            await upstream.close_client()
+
+    return requested, asyncio.run(main())
+
+
+def test_the_body_is_streamed_as_is_with_only_the_relayed_headers() -> None:
+    upstream_headers: dict[str, str] = {"Content-Type": "application/fhir+json", "ETag": 'W/"3"', "Set-Cookie": "session=1", "X-Epic-Internal": "1"}
+
+    requested, resp = relay(lambda request: httpx.Response(200, headers=upstream_headers, content=chunks(bundle)), "/Observation?patient=1&code=4548-4")
+
+    assert requested == [f"{fhir_url}Observation?patient=1&code=4548-4"]
+    assert resp.status_code == 200
+    assert resp.content == bundle
+    assert resp.headers["content-type"] == "application/fhir+json"
+    assert resp.headers["etag"] == 'W/"3"'
+    assert "set-cookie" not in resp.headers
+    assert "x-epic-internal" not in resp.headers
+
+
+def test_bundle_totals_are_logged_from_the_start_of_a_compressed_body(monkeypatch) -> None:
+    logged: list[tuple] = []
+    monkeypatch.setattr(api_passthrough, "passthrough_log_totals", True)
+    monkeypatch.setattr(api_passthrough, "passthrough_scan_bytes", 64)
+    monkeypatch.setattr(api_passthrough.logger, "info", lambda *args: logged.append(args))
+    compressed: bytes = gzip.compress(bundle)
+
+    _, resp = relay(
+        lambda request: httpx.Response(200, headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}, content=chunks(compressed)),
+        "/Observation?patient=1",
+        headers={"Accept-Encoding": "gzip"},
+    )
+
+    assert resp.headers["content-encoding"] == "gzip"
+    assert resp.content == bundle
+    assert ("Found %s %s resources and returned %s bytes", "3", "Observation", len(compressed)) in logged
+
+
+def test_upstream_errors_are_returned_as_operation_outcomes() -> None:
+    outcome: dict = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found", "diagnostics": "Resource not found"}]}
+
+    _, not_found = relay(lambda request: httpx.Response(404, json=outcome), "/Patient/missing")
+    _, not_json = relay(lambda request: httpx.Response(200, headers={"Content-Type": "text/html"}, content=b"<html></html>"), "/Patient/1")
+
+    assert not_found.status_code == 404
+    assert not_found.json() == outcome
+    assert not_json.json()["issue"][0]["diagnostics"] == api_passthrough.not_json_outcome.issue[0].diagnostics
@@ -0,0 +1,45 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import upstream
+from batchHandler import run_entry
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    if request.url.path.endswith("/Patient/missing"):
+        return httpx.Response(404, json={"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]})
+    if request.url.path.endswith("/Patient/1"):
+        return httpx.Response(200, json={"resourceType": "Patient", "id": "1"})
+    return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": {"resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "A1c"}}}]})
+
+
+@pytest.fixture(autouse=True)
+def fhir_auth(monkeypatch) -> None:
+    monkeypatch.setattr("helpers.fhir_auth", "Bearer abc")
+
+
+def test_batch_entries_get_their_own_status() -> None:
+    entries: list[dict] = [
+        {"request": {"method": "GET", "url": "Patient/1"}},
+        {"request": {"method": "GET", "url": "/Observation?patient=1"}},
+        {"request": {"method": "GET", "url": "Patient/missing"}},
+        {"request": {"method": "POST", "url": "Patient"}},
+        {"request": {"method": "GET", "url": "Patient/1/_history/2"}},
+    ]
+
+    async def main() -> list[tuple[int, bytes]]:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await asyncio.gather(*(run_entry(entry, "") for entry in entries))
+        finally:
+            await upstream.close_client()
+
+    results: list[tuple[int, bytes]] = asyncio.run(main())
+
+    assert [status_code for status_code, _ in results] == [200, 200, 404, 405, 400]
+    assert json.loads(results[0][1])["id"] == "1"
+    assert json.loads(results[1][1])["entry"][0]["resource"]["id"] == "o1"
+    assert all(json.loads(body)["resourceType"] == "OperationOutcome" for _, body in results[2:])
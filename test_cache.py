@@ -0,0 +1,140 @@
+import asyncio
+import sqlite3
+import time
+
+from cache import DiskCache, ResourceCache
+
+
+def test_cache_hit_and_miss() -> None:
+    cache = ResourceCache(max_bytes=1024, default_ttl=60)
+
+    assert cache.get("Patient/1") is None
+    cache.set("Patient/1", "Patient", b'{"resourceType":"Patient"}')
+    entry = cache.get("Patient/1")
+
+    assert entry
+    assert entry.body == b'{"resourceType":"Patient"}'
+    assert entry.status_code == 200
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_evicts_least_recently_used() -> None:
+    cache = ResourceCache(max_bytes=30, default_ttl=60)
+
+    cache.set("Patient/1", "Patient", b"x" * 10)
+    cache.set("Patient/2", "Patient", b"x" * 10)
+    cache.get("Patient/1")
+    cache.set("Patient/3", "Patient", b"x" * 15)
+
+    assert "Patient/1" in cache
+    assert "Patient/2" not in cache
+    assert "Patient/3" in cache
+    assert cache.size <= cache.max_bytes
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_skips_entries_over_budget() -> None:
+    cache = ResourceCache(max_bytes=10, default_ttl=60)
+
+    cache.set("Binary/1", "Binary", b"x" * 11)
+
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_cache_drops_the_old_entry_when_the_new_one_is_over_budget(tmp_path) -> None:
+    for cache in (ResourceCache(max_bytes=10, default_ttl=60), DiskCache(str(tmp_path / "cache.sqlite3"), "resources", max_bytes=16, default_ttl=60)):
+        cache.set("Binary/1", "Binary", b"x")
+        cache.set("Binary/1", "Binary", bytes(range(100)))
+
+        assert cache.get("Binary/1") is None
+        assert cache.size == 0
+
+
+def test_cache_ttl_per_resource_type() -> None:
+    cache = ResourceCache(max_bytes=1024, default_ttl=60, ttls={"Observation": 0})
+
+    cache.set("Observation/1", "Observation", b"{}")
+    cache.set("Patient/1", "Patient", b"{}")
+    time.sleep(0.01)
+
+    assert cache.get("Observation/1") is None
+    assert cache.get("Patient/1")
+    assert cache.stats()["expirations"] == 1
+
+
+def test_disk_cache_is_shared_between_workers(tmp_path) -> None:
+    path: str = str(tmp_path / "cache.sqlite3")
+    first_worker = DiskCache(path, "resources", max_bytes=1024, default_ttl=60)
+    second_worker = DiskCache(path, "resources", max_bytes=1024, default_ttl=60)
+    searches = DiskCache(path, "searches", max_bytes=1024, default_ttl=60)
+
+    first_worker.set("Patient/1", "Patient", b'{"resourceType":"Patient"}', status_code=200, headers={"etag": 'W/"1"'})
+    entry = second_worker.get("Patient/1")
+
+    assert entry
+    assert entry.body == b'{"resourceType":"Patient"}'
+    assert entry.headers == {"etag": 'W/"1"'}
+    assert searches.get("Patient/1") is None
+
+
+def test_disk_cache_evicts_least_recently_used_and_expires(tmp_path) -> None:
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), "resources", max_bytes=60, default_ttl=60)
+    body: bytes = bytes(range(20))
+
+    cache.set("Patient/1", "Patient", body)
+    cache.set("Patient/2", "Patient", body)
+    cache.set("Patient/3", "Patient", body, ttl=-1)
+
+    assert "Patient/3" not in cache
+    assert cache.get("Patient/3") is None
+
+    cache.set("Patient/4", "Patient", body)
+
+    assert "Patient/1" not in cache
+    assert "Patient/2" in cache
+    assert "Patient/4" in cache
+    assert cache.size <= cache.max_bytes
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_cache_errors_are_misses(tmp_path) -> None:
+    # A directory cannot be opened as a database, so every call fails the way a corrupt or unreadable file would
+    cache = DiskCache(str(tmp_path), "resources", max_bytes=1024, default_ttl=60)
+
+    entry = cache.set("Patient/1", "Patient", b"{}")
+
+    assert entry.body == b"{}"
+    assert cache.get("Patient/1") is None
+    assert cache.get_stale("Patient/1") is None
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["errors"] == 3
+    assert "entries" not in cache.stats()
+
+
+def test_disk_cache_does_not_wait_long_on_a_locked_database(tmp_path) -> None:
+    path: str = str(tmp_path / "cache.sqlite3")
+    cache = DiskCache(path, "resources", max_bytes=1024, default_ttl=60)
+    cache.busy_timeout = 0.05
+    cache.set("Patient/1", "Patient", b"1")
+    # Another worker holding the write lock
+    other_worker = sqlite3.connect(path, isolation_level=None)
+    other_worker.execute("BEGIN IMMEDIATE")
+
+    async def main() -> tuple:
+        return await cache.aset("Patient/2", "Patient", b"2"), await cache.aget("Patient/1"), await cache.aget("Patient/2")
+
+    try:
+        start_time: float = time.perf_counter()
+        stored, cached, missing = asyncio.run(main())
+        elapsed: float = time.perf_counter() - start_time
+    finally:
+        other_worker.rollback()
+        other_worker.close()
+
+    assert elapsed < 1
+    assert stored.body == b"2"
+    assert cached and cached.body == b"1"
+    assert missing is None
+    assert cache.stats()["errors"] == 1
@@ -0,0 +1,42 @@
+import os
+
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement
+from fhirsearchhelper.helpers.gapanalysis import run_gap_analysis
+from fhirsearchhelper.models.models import QuerySearchParams
+
+import capability
+from serializer import dumps
+from util import capability_statement_file
+
+
+def test_index_matches_gap_analysis() -> None:
+    supported = get_supported_search_params(load_capability_statement(client=None, file_path=capability_statement_file))  # type: ignore
+    index = capability.load_search_index()
+    searches: list[tuple[str, dict[str, str]]] = [
+        ("Observation", {"patient": "abc", "category": "laboratory", "code": "http://loinc.org%7C4548-4", "date": "ge2020"}),
+        ("Condition", {"patient": "abc", "category": "problem-list-item", "clinical-status": "active", "code": "123"}),
+        ("Condition", {"patient": "abc", "category": "encounter-diagnosis,problem-list-item", "encounter": "e1"}),
+        ("DocumentReference", {"patient": "abc", "category": "clinical-note", "type": "x", "_count": "10"}),
+        ("Patient", {"family": "Smith", "given": "Jo", "birthdate": "2000-01-01", "legal-sex": "female"}),
+    ]
+
+    for resource_type, search_params in searches:
+        expected: list[str] = run_gap_analysis(supported_search_params=supported, query_search_params=QuerySearchParams(resourceType=resource_type, searchParams=search_params))
+        assert index.unsupported_params(resource_type, search_params) == expected
+    assert index.resource_types == {params.resourceType for params in supported}
+
+
+def test_index_reloads_when_the_file_changes(tmp_path, monkeypatch) -> None:
+    path = tmp_path / "metadata.json"
+    path.write_bytes(dumps({"rest": [{"resource": [{"type": "Patient", "searchParam": [{"name": "family"}]}]}]}))
+    monkeypatch.setattr(capability, "capability_statement_file", str(path))
+    monkeypatch.setattr(capability, "capability_check_interval", 0)
+    # The index and check time are set back after the test, so later tests use the real CapabilityStatement again
+    monkeypatch.setattr(capability, "search_index", None)
+    monkeypatch.setattr(capability, "next_check", 0.0)
+
+    assert capability.load_search_index().unsupported_params("Patient", {"family": "Smith", "given": "Jo"}) == ["given"]
+
+    path.write_bytes(dumps({"rest": [{"resource": [{"type": "Patient", "searchParam": [{"name": "family"}, {"name": "given"}]}]}]}))
+    os.utime(path, (capability.loaded_mtime + 1, capability.loaded_mtime + 1))
+    assert capability.get_search_index().unsupported_params("Patient", {"family": "Smith", "given": "Jo"}) == []
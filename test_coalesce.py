@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from coalesce import SingleFlight
+
+
+def test_concurrent_calls_share_one_run() -> None:
+    flights = SingleFlight()
+    runs: list[str] = []
+
+    async def fetch() -> str:
+        runs.append("fetch")
+        await asyncio.sleep(0.01)
+        return "Patient/1"
+
+    async def main() -> list[str]:
+        return await asyncio.gather(*[flights.do("Patient/1", fetch) for _ in range(10)])
+
+    results = asyncio.run(main())
+
+    assert results == ["Patient/1"] * 10
+    assert len(runs) == 1
+    assert flights.stats() == {"calls": 1, "coalesced": 9, "in_flight": 0}
+
+
+def test_errors_are_shared_and_not_kept() -> None:
+    flights = SingleFlight()
+
+    async def fail() -> None:
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def main() -> list:
+        return await asyncio.gather(*[flights.do("Patient/1", fail) for _ in range(3)], return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(flights) == 0
+    with pytest.raises(ValueError):
+        asyncio.run(flights.do("Patient/1", fail))
+    assert flights.calls == 2
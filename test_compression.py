@@ -0,0 +1,63 @@
+import asyncio
+import gzip
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import Response
+
+from cache import DiskCache, ResourceCache
+from compression import CompressionMiddleware, accepts, choose_encoding
+
+body: bytes = b'{"resourceType":"Bundle","entry":[' + b",".join([b'{"resource":{"resourceType":"Patient"}}'] * 100) + b"]}"
+
+
+def test_accept_encoding_negotiation() -> None:
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("gzip;q=0, identity") is None
+    assert choose_encoding("*") is not None
+    assert accepts("deflate, gzip;q=0.5", "gzip")
+    assert not accepts("", "gzip")
+
+
+def test_caches_store_large_bodies_gzipped(tmp_path) -> None:
+    for cache in (
+        ResourceCache(max_bytes=10_000, default_ttl=60, compress_min_size=1024),
+        DiskCache(str(tmp_path / "cache.sqlite3"), "test", max_bytes=10_000, default_ttl=60, compress_min_size=1024),
+    ):
+        cache.set("Bundle/big", "Bundle", body)
+        cache.set("Bundle/small", "Bundle", b"{}")
+        entry = cache.get("Bundle/big")
+        assert entry is not None and entry.encoding == "gzip" and entry.size < len(body)
+        assert entry.content == body
+        assert cache.get("Bundle/small").encoding is None
+
+
+def test_middleware_sends_cached_gzip_as_is_or_decompressed() -> None:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
+    @app.get("/cached")
+    async def cached() -> Response:
+        return Response(content=gzip.compress(body), headers={"Content-Encoding": "gzip", "ETag": '"abc"'}, media_type="application/json")
+
+    @app.get("/plain")
+    async def plain() -> Response:
+        return Response(content=body, headers={"ETag": 'W/"1"'}, media_type="application/json")
+
+    async def main() -> list[httpx.Response]:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+            return [
+                await client.get("/cached", headers={"Accept-Encoding": "gzip"}),
+                await client.get("/cached", headers={"Accept-Encoding": "identity"}),
+                await client.get("/plain", headers={"Accept-Encoding": "gzip"}),
+            ]
+
+    passed_through, decompressed, compressed = asyncio.run(main())
+    assert passed_through.headers["content-encoding"] == "gzip" and passed_through.content == body
+    assert "content-encoding" not in decompressed.headers and decompressed.content == body
+    assert int(decompressed.headers["content-length"]) == len(body)
+    assert compressed.headers["content-encoding"] == "gzip" and int(compressed.headers["content-length"]) < len(body) and compressed.content == body
+    # Strong ETags differ between the encodings of a body, weak ones do not
+    assert passed_through.headers["etag"] == '"abc-gzip"'
+    assert decompressed.headers["etag"] == '"abc"'
+    assert compressed.headers["etag"] == 'W/"1"'
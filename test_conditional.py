@@ -0,0 +1,68 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.datastructures import Headers
+
+import main
+import upstream
+from conditional import content_tag, not_modified, validators
+from resourceHandler import resource_cache
+
+
+@pytest.fixture(autouse=True)
+def fhir_auth(monkeypatch) -> None:
+    monkeypatch.setattr("helpers.fhir_auth", "Bearer abc")
+
+
+def test_validators_and_preconditions() -> None:
+    observation: dict = {"resourceType": "Observation", "id": "1", "meta": {"versionId": "3", "lastUpdated": "2024-05-01T12:00:00Z"}}
+    headers: dict[str, str] = validators("Observation", observation, b"{}", {})
+    assert headers == {"ETag": 'W/"3"', "Last-Modified": "Wed, 01 May 2024 12:00:00 GMT"}
+    # Expanded resources can change without a new version, so they are tagged by what is sent
+    assert validators("MedicationRequest", observation, b"{}", {})["ETag"] == content_tag(b"{}")
+
+    assert not_modified(Headers({"if-none-match": '"2", "3"'}), headers)
+    assert not not_modified(Headers({"if-none-match": 'W/"2"', "if-modified-since": "Wed, 01 May 2024 12:00:00 GMT"}), headers)
+    assert not_modified(Headers({"if-modified-since": "Thu, 02 May 2024 00:00:00 GMT"}), headers)
+    assert not not_modified(Headers({"if-modified-since": "Tue, 30 Apr 2024 00:00:00 GMT"}), headers)
+    # -0000 and numeric zones are compared in UTC like GMT
+    assert not_modified(Headers({"if-modified-since": "Thu, 02 May 2024 00:00:00 -0000"}), headers)
+    assert not not_modified(Headers({"if-modified-since": "Wed, 01 May 2024 13:00:00 +0200"}), headers)
+    assert not_modified(Headers({"if-modified-since": "Wed, 01 May 2024 12:00:00 GMT"}), {"Last-Modified": "Wed, 01 May 2024 12:00:00 -0000"})
+    # A client can send back the ETag of any encoding of the body
+    assert not_modified(Headers({"if-none-match": '"abc-gzip"'}), {"ETag": '"abc"'})
+    assert not_modified(Headers({"if-none-match": '"abc"'}), {"ETag": '"abc"'})
+    assert not not_modified(Headers({"if-none-match": '"abd-br"'}), {"ETag": '"abc"'})
+
+
+def test_reads_answer_304_from_cache_and_revalidate_upstream() -> None:
+    upstream_conditions: list[str | None] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        upstream_conditions.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == 'W/"7"':
+            return httpx.Response(304)
+        return httpx.Response(200, json={"resourceType": "Observation", "id": "conditional", "meta": {"versionId": "7"}, "status": "final", "code": {"text": "A1c"}})
+
+    async def run() -> list[httpx.Response]:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy") as client:
+                first: httpx.Response = await client.get("/Observation/conditional")
+                cached: httpx.Response = await client.get("/Observation/conditional", headers={"if-none-match": first.headers["etag"]})
+                # Expire the entry so the next read goes upstream with the version it has
+                stale = resource_cache.get_stale("Observation/conditional")
+                resource_cache.set("Observation/conditional", "Observation", stale.content, ttl=-1, headers=stale.headers)
+                revalidated: httpx.Response = await client.get("/Observation/conditional")
+                return [first, cached, revalidated]
+        finally:
+            await upstream.close_client()
+
+    first, cached, revalidated = asyncio.run(run())
+
+    assert first.status_code == 200 and first.headers["etag"] == 'W/"7"'
+    assert cached.status_code == 304 and cached.content == b""
+    assert revalidated.status_code == 200 and revalidated.json() == first.json()
+    assert upstream_conditions == [None, 'W/"7"']
+    assert resource_cache.get("Observation/conditional") is not None
@@ -0,0 +1,35 @@
+import asyncio
+
+from expansion import expand_resources
+
+
+def test_medication_references_are_fetched_once_per_bundle() -> None:
+    fetched: list[str] = []
+
+    async def fetch(reference: str) -> dict | None:
+        fetched.append(reference)
+        await asyncio.sleep(0.01)
+        return {"resourceType": "Medication", "code": {"text": reference}}
+
+    resources = [{"resourceType": "MedicationRequest", "id": str(i), "medicationReference": {"reference": f"Medication/{i % 2}"}} for i in range(6)]
+    expanded = asyncio.run(expand_resources("MedicationRequest", resources, fetch))
+
+    assert sorted(fetched) == ["Medication/0", "Medication/1"]
+    assert [resource["id"] for resource in expanded if resource] == ["0", "1", "2", "3", "4", "5"]
+    assert all(resource and resource["medicationCodeableConcept"]["text"] == f"Medication/{int(resource['id']) % 2}" for resource in expanded)
+    assert all(resource and "medicationReference" not in resource for resource in expanded)
+
+
+def test_condition_onset_from_encounter() -> None:
+    async def fetch(reference: str) -> dict | None:
+        return None if reference == "Encounter/missing" else {"resourceType": "Encounter", "period": {"start": "2023-01-02"}}
+
+    resources = [
+        {"resourceType": "Condition", "id": "a", "encounter": {"reference": "Encounter/1"}},
+        {"resourceType": "Condition", "id": "b", "onsetDateTime": "2020-05-05"},
+        {"resourceType": "Condition", "id": "c"},
+        {"resourceType": "Condition", "id": "d", "encounter": {"reference": "Encounter/missing"}},
+    ]
+    expanded = asyncio.run(expand_resources("Condition", resources, fetch))
+
+    assert [resource["onsetDateTime"] if resource else None for resource in expanded] == ["2023-01-02", "2020-05-05", "9999-12-31", None]
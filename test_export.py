@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+import exportHandler
+import upstream
+from exportHandler import ExportJob
+from util import fhir_url
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    patient: str = request.url.params["patient"]
+    if patient == "broken":
+        return httpx.Response(500, json={"resourceType": "OperationOutcome", "issue": [{"severity": "fatal", "code": "exception", "diagnostics": "boom"}]})
+    page: int = int(request.url.params.get("page", 0))
+    bundle: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "entry": [{"resource": {"resourceType": "Observation", "id": f"{patient}-{page}-{i}", "status": "final", "code": {"text": "A1c"}}} for i in range(2)],
+    }
+    if page == 0:
+        bundle["link"] = [{"relation": "next", "url": f"{fhir_url}Observation?patient={patient}&page=1"}]
+    return httpx.Response(200, json=bundle)
+
+
+def new_job(patients: list[str]) -> ExportJob:
+    job = ExportJob(
+        {
+            "id": "0" * 32,
+            "status": "in-progress",
+            "request": {"patients": patients, "types": ["Observation"]},
+            "requestUrl": "http://localhost/$export",
+            "transactionTime": "2024-01-01T00:00:00+00:00",
+            "searches": len(patients),
+            "completed": [],
+            "files": {},
+            "stats": {},
+            "elapsed": 0.0,
+        }
+    )
+    os.makedirs(job.directory, exist_ok=True)
+    return job
+
+
+def run_job(job: ExportJob, resume: bool = False) -> None:
+    async def main() -> None:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            if resume:
+                job.truncate_files()
+            job.start()
+            assert job.task
+            await job.task
+        finally:
+            await upstream.close_client()
+
+    asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def export_environment(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(exportHandler, "export_dir", str(tmp_path))
+    monkeypatch.setattr("helpers.fhir_auth", "Bearer abc")
+
+
+def test_export_writes_every_page_and_records_errors() -> None:
+    job = new_job(["1", "broken", "2"])
+    run_job(job)
+
+    with open(job.file_path("Observation")) as fo:
+        ids: list[str] = [json.loads(line)["id"] for line in fo]
+    with open(os.path.join(job.directory, exportHandler.manifest_file_name)) as fo:
+        manifest: dict = json.load(fo)
+
+    assert sorted(ids) == ["1-0-0", "1-0-1", "1-1-0", "1-1-1", "2-0-0", "2-0-1", "2-1-0", "2-1-1"]
+    assert manifest["status"] == "completed"
+    assert manifest["files"]["Observation"] == {"count": 8, "bytes": os.path.getsize(job.file_path("Observation"))}
+    assert manifest["files"]["OperationOutcome"]["count"] == 1
+    assert manifest["stats"]["Observation"]["searches"] == 3
+
+
+def test_resumed_export_truncates_unrecorded_lines_and_skips_completed_searches() -> None:
+    job = new_job(["1", "2"])
+    first_line: bytes = b'{"resourceType":"Observation","id":"1-0-0"}\n'
+    with open(job.file_path("Observation"), "wb") as fo:
+        fo.write(first_line + b'{"resourceType":"Observation","id":"partial')
+    job.manifest["completed"] = ["1|Observation"]
+    job.manifest["files"] = {"Observation": {"count": 1, "bytes": len(first_line)}}
+    job.completed = {"1|Observation"}
+    run_job(job, resume=True)
+
+    with open(job.file_path("Observation")) as fo:
+        ids: list[str] = [json.loads(line)["id"] for line in fo]
+
+    assert ids == ["1-0-0", "2-0-0", "2-0-1", "2-1-0", "2-1-1"]
+    assert job.manifest["files"]["Observation"]["count"] == 5
+
+
+def test_resumed_export_removes_files_first_written_after_the_checkpoint() -> None:
+    job = new_job(["1"])
+    with open(job.file_path("Observation"), "wb") as fo:
+        fo.write(b'{"resourceType":"Observation","id":"1-0-0"}\n')
+    with open(job.file_path(exportHandler.error_file_type), "wb") as fo:
+        fo.write(b'{"resourceType":"OperationOutcome"}\n')
+    run_job(job, resume=True)
+
+    with open(job.file_path("Observation")) as fo:
+        ids: list[str] = [json.loads(line)["id"] for line in fo]
+
+    assert ids == ["1-0-0", "1-0-1", "1-1-0", "1-1-1"]
+    assert job.manifest["files"] == {"Observation": {"count": 4, "bytes": os.path.getsize(job.file_path("Observation"))}}
+    assert not os.path.exists(job.file_path(exportHandler.error_file_type))
@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import helpers
+import upstream
+from models import EpicTokenResponse, SmartEndpoints
+from util import fhir_url
+
+
+def capability_statement(token_url: str) -> dict:
+    return {
+        "resourceType": "CapabilityStatement",
+        "rest": [
+            {
+                "security": {
+                    "extension": [
+                        {
+                            "url": helpers.oauth_uris_extension_url,
+                            "extension": [{"url": "token", "valueUri": token_url}, {"url": "authorize", "valueUri": "https://auth.example.org/authorize"}],
+                        }
+                    ]
+                }
+            }
+        ],
+    }
+
+
+def metadata_server(responses: list[httpx.Response]) -> list[str]:
+    """Opens the upstream client on a MockTransport that answers /metadata with the next of responses, returning the URLs it was called with"""
+
+    requested: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(str(request.url))
+        return responses.pop(0)
+
+    upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return requested
+
+
+@pytest.fixture(autouse=True)
+def reset_smart_endpoints(monkeypatch) -> None:
+    monkeypatch.setattr(helpers, "smart_endpoints", None)
+    monkeypatch.setattr(helpers, "smart_endpoints_refresh", None)
+
+
+def test_smart_endpoints_are_fetched_once_within_the_ttl() -> None:
+    async def main() -> tuple[list[str], SmartEndpoints, SmartEndpoints]:
+        requested: list[str] = metadata_server([httpx.Response(200, json=capability_statement("https://auth.example.org/token"))])
+        try:
+            return requested, await helpers.get_smart_endpoints(), await helpers.get_smart_endpoints()
+        finally:
+            await upstream.close_client()
+
+    requested, first, second = asyncio.run(main())
+
+    assert requested == [f"{fhir_url}metadata"]
+    assert first is second
+    assert first.token_url == "https://auth.example.org/token"
+    assert first.authorize_url == "https://auth.example.org/authorize"
+
+
+def test_expired_smart_endpoints_are_served_while_refreshed_in_the_background(monkeypatch) -> None:
+    monkeypatch.setattr(helpers, "smart_endpoints", SmartEndpoints(token_url="https://auth.example.org/old", fetched=time.time() - 7200))
+
+    async def main() -> tuple[str, str]:
+        metadata_server([httpx.Response(200, json=capability_statement("https://auth.example.org/new"))])
+        try:
+            served: str = (await helpers.get_smart_endpoints()).token_url
+            refresh: asyncio.Task | None = helpers.smart_endpoints_refresh
+            assert refresh is not None
+            await refresh
+            return served, (await helpers.get_smart_endpoints()).token_url
+        finally:
+            await upstream.close_client()
+
+    assert asyncio.run(main()) == ("https://auth.example.org/old", "https://auth.example.org/new")
+    assert helpers.smart_endpoints_refresh is None
+
+
+def test_a_failed_background_refresh_keeps_the_cached_endpoints(monkeypatch) -> None:
+    stale: SmartEndpoints = SmartEndpoints(token_url="https://auth.example.org/old", fetched=time.time() - 7200)
+    monkeypatch.setattr(helpers, "smart_endpoints", stale)
+
+    async def main() -> None:
+        metadata_server([httpx.Response(200, json={"resourceType": "CapabilityStatement", "rest": []})])
+        try:
+            await helpers.get_smart_endpoints()
+            await helpers.smart_endpoints_refresh
+        finally:
+            await upstream.close_client()
+
+    asyncio.run(main())
+
+    assert helpers.smart_endpoints is stale
+    assert helpers.smart_endpoints_refresh is None
+
+
+def test_the_first_fetch_fails_without_a_token_url() -> None:
+    async def main() -> None:
+        metadata_server([httpx.Response(200, json={"resourceType": "CapabilityStatement", "rest": [{"security": {}}]})])
+        try:
+            await helpers.get_smart_endpoints()
+        finally:
+            await upstream.close_client()
+
+    with pytest.raises(ValueError, match="token URL"):
+        asyncio.run(main())
+    assert helpers.smart_endpoints is None
+
+
+def token(expires_in: float) -> EpicTokenResponse:
+    return EpicTokenResponse(access_token="abc", token_type="Bearer", expires_in=int(expires_in), expires=time.time() + expires_in, scope="system/*.read")
+
+
+def token_endpoint(monkeypatch, tokens: list[EpicTokenResponse | None]) -> list[float]:
+    """Replaces the token request with one that returns the next of tokens after a moment, returning the times it was called"""
+
+    calls: list[float] = []
+
+    async def get_token() -> EpicTokenResponse | None:
+        calls.append(time.monotonic())
+        await asyncio.sleep(0.01)
+        return tokens.pop(0)
+
+    monkeypatch.setattr(helpers, "get_token", get_token)
+    return calls
+
+
+def test_requests_without_a_token_share_one_refresh(monkeypatch) -> None:
+    calls: list[float] = token_endpoint(monkeypatch, [token(3600)])
+    manager = helpers.TokenManager(refresh_skew=60)
+
+    async def main() -> list[EpicTokenResponse | None]:
+        return await asyncio.gather(*[manager.get_token() for _ in range(10)])
+
+    tokens: list[EpicTokenResponse | None] = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert all(shared is manager.token for shared in tokens)
+    assert manager.stats()["refreshes"] == 1
+
+
+def test_a_failed_refresh_is_shared_and_backs_off(monkeypatch) -> None:
+    calls: list[float] = token_endpoint(monkeypatch, [None, None, token(3600)])
+    manager = helpers.TokenManager(refresh_skew=60, min_backoff=0.05, max_backoff=1)
+
+    async def main() -> tuple[list[EpicTokenResponse | None], EpicTokenResponse | None, EpicTokenResponse | None, EpicTokenResponse | None]:
+        failed: list[EpicTokenResponse | None] = await asyncio.gather(*[manager.get_token() for _ in range(10)])
+        backing_off: EpicTokenResponse | None = await manager.get_token()
+        await asyncio.sleep(0.08)
+        failed_again: EpicTokenResponse | None = await manager.get_token()
+        await asyncio.sleep(0.15)
+        return failed, backing_off, failed_again, await manager.get_token()
+
+    failed, backing_off, failed_again, refreshed = asyncio.run(main())
+
+    assert failed == [None] * 10
+    assert backing_off is None
+    assert failed_again is None
+    assert refreshed is manager.token
+    assert len(calls) == 3
+    assert manager.stats()["failures"] == 2
+    assert manager.backoff == 0.0
+
+
+def test_tokens_about_to_expire_are_refreshed_in_the_background(monkeypatch) -> None:
+    calls: list[float] = token_endpoint(monkeypatch, [None, token(3600)])
+    manager = helpers.TokenManager(refresh_skew=60, min_backoff=60)
+    expiring: EpicTokenResponse = token(30)
+    manager.token = expiring
+
+    async def main() -> list[EpicTokenResponse | None]:
+        served: list[EpicTokenResponse | None] = await asyncio.gather(*[manager.get_token() for _ in range(5)])
+        await manager._refresh_task
+        # The background refresh failed, so the expiring token keeps being used without another refresh until the backoff is over
+        served.append(await manager.get_token())
+        assert manager._refresh_task is None
+        manager.retry_at = 0.0
+        served.append(await manager.get_token())
+        await manager._refresh_task
+        return served
+
+    served: list[EpicTokenResponse | None] = asyncio.run(main())
+
+    assert all(used is expiring for used in served)
+    assert len(calls) == 2
+    assert manager.token is not expiring
+    assert not manager.needs_refresh()
+
+
+def test_a_refresh_raises_errors_other_than_http_and_json_ones(monkeypatch) -> None:
+    async def get_token() -> EpicTokenResponse | None:
+        raise TypeError("bug")
+
+    monkeypatch.setattr(helpers, "get_token", get_token)
+    manager = helpers.TokenManager(refresh_skew=60)
+
+    with pytest.raises(TypeError, match="bug"):
+        asyncio.run(manager.get_token())
+    assert manager._refresh_task is None
+    assert manager.failures == 0
+
+
+def test_a_refresh_that_cannot_reach_the_server_fails_and_backs_off(monkeypatch) -> None:
+    async def get_token() -> EpicTokenResponse | None:
+        raise httpx.ConnectError("Connection refused")
+
+    monkeypatch.setattr(helpers, "get_token", get_token)
+    manager = helpers.TokenManager(refresh_skew=60)
+
+    assert asyncio.run(manager.get_token()) is None
+    assert manager.failures == 1
+    assert manager.backoff == manager.min_backoff
@@ -0,0 +1,31 @@
+import logging
+
+import logs
+from serializer import loads
+
+
+class ListHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def test_access_logs_are_sampled_but_errors_are_kept(monkeypatch) -> None:
+    handler = ListHandler()
+    logs.access_logger.addHandler(handler)
+    logs.access_logger.setLevel(logging.INFO)
+    monkeypatch.setattr(logs, "access_log_sample_rate", 0.0)
+    try:
+        logs.log_access("GET", "/Patient/1", 200, 0.01, "120", "Patient")
+        logs.log_access("GET", "/Patient/2", 503, 0.01, None, "Patient")
+    finally:
+        logs.access_logger.removeHandler(handler)
+
+    assert [record.path for record in handler.records] == ["/Patient/2"]
+
+    log: dict = loads(logs.JSONFormatter().format(handler.records[0]))
+    assert log["message"] == "GET /Patient/2 returned 503 in 0.01 seconds with a size of unknown bytes"
+    assert log["status_code"] == 503 and log["resource_type"] == "Patient" and log["logger"] == "main.access"
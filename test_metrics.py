@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+
+import metrics
+from main import app
+
+
+def test_stats_are_exported_as_gauges() -> None:
+    collector = metrics.StatsCollector()
+    collector.register("widgets", "kind", "small", lambda: {"count": 3, "hit_ratio": 0.5, "enabled": True, "name": "small"})
+    collector.register("widgets", "kind", "large", lambda: {"count": 1})
+
+    families = {family.name: family for family in collector.collect()}
+
+    assert set(families) == {"fhirproxy_widgets_count", "fhirproxy_widgets_hit_ratio"}
+    assert [(sample.labels, sample.value) for sample in families["fhirproxy_widgets_count"].samples] == [({"kind": "small"}, 3), ({"kind": "large"}, 1)]
+
+
+def test_unknown_resource_types_share_one_label() -> None:
+    assert metrics.resource_type_label("Observation") == "Observation"
+    assert metrics.resource_type_label("token") == "token"
+    assert metrics.resource_type_label("") == ""
+    assert metrics.resource_type_label("Foo1") == "other"
+
+    for made_up in ("Foo1", "Foo2", "Foo3"):
+        metrics.observe_request(method="GET", route="/{resource_type}", resource_type=made_up, status_code=404, seconds=0.01, size=None)
+        metrics.observe_upstream(made_up, 404, 0.01)
+
+    rendered: str = metrics.render_metrics().decode()
+
+    assert "Foo1" not in rendered
+    assert 'fhirproxy_responses_total{method="GET",resource_type="other",route="/{resource_type}",status_code="404"} 3.0' in rendered
+    assert 'fhirproxy_upstream_responses_total{resource_type="other",status_code="404"}' in rendered
+
+
+def test_metrics_endpoint_serves_prometheus_text() -> None:
+    async def main() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+            await client.get("/health")
+            return await client.get("/metrics")
+
+    resp: httpx.Response = asyncio.run(main())
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == metrics.metrics_content_type
+    assert 'fhirproxy_responses_total{method="GET",resource_type="",route="/health",status_code="200"}' in resp.text
+    assert "fhirproxy_cache_hit_ratio" in resp.text
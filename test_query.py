@@ -0,0 +1,62 @@
+from urllib.parse import quote, quote_plus
+
+from hypothesis import assume, given
+from hypothesis import strategies as st
+
+from query import SearchQuery
+from search import plan_search
+from util import fhir_url
+
+names = st.text(alphabet="abcdefghijklmnopqrstuvwxyz-_:", min_size=1, max_size=12)
+values = st.text(alphabet=st.characters(blacklist_categories=("Cs",)), min_size=1, max_size=20)
+params = st.lists(st.tuples(names, values), max_size=6)
+# Ways clients encode a value, every one of them has to escape &, =, + and %
+encoders = st.sampled_from([lambda value: quote(value, safe=""), quote_plus, lambda value: quote(value, safe=",|:/")])
+
+
+def raw_query(pairs: list[tuple[str, str]], encode) -> str:
+    return "&".join(f"{name}={encode(value)}" for name, value in pairs)
+
+
+@given(params, st.randoms(), encoders, encoders)
+def test_order_and_encoding_do_not_change_the_key(pairs: list[tuple[str, str]], random, first_encoder, second_encoder) -> None:
+    shuffled: list[tuple[str, str]] = random.sample(pairs, len(pairs))
+
+    first: SearchQuery = SearchQuery.parse("Observation", raw_query(pairs, first_encoder))
+    second: SearchQuery = SearchQuery.parse("Observation", raw_query(shuffled, second_encoder))
+
+    assert first == second
+    assert first.key == second.key
+
+
+@given(params)
+def test_the_canonical_query_parses_back_to_itself(pairs: list[tuple[str, str]]) -> None:
+    query: SearchQuery = SearchQuery.from_params("Condition", pairs)
+
+    assert SearchQuery.parse("Condition", query.query) == query
+    assert list(query.params) == sorted(set(query.params))
+
+
+@given(values, params)
+def test_patient_references_match_patient_ids(patient: str, pairs: list[tuple[str, str]]) -> None:
+    assume(not patient.startswith(("Patient/", fhir_url)))
+    plain: SearchQuery = SearchQuery.from_params("Observation", [*pairs, ("patient", patient)])
+
+    assert SearchQuery.from_params("Observation", [*pairs, ("patient", f"Patient/{patient}")]) == plain
+    assert SearchQuery.from_params("Observation", [*pairs, ("patient", f"{fhir_url}Patient/{patient}")]) == plain
+
+
+def test_empty_parameters_are_dropped_and_repeated_ones_kept() -> None:
+    query: SearchQuery = SearchQuery.parse("Observation", "date=lt2025-01-01&patient=&code=&date=ge2024-01-01&category=laboratory")
+
+    assert query.params == (("category", "laboratory"), ("date", "ge2024-01-01"), ("date", "lt2025-01-01"))
+    assert query.names == ("category", "date")
+    assert query.without("date").key == "Observation?category=laboratory"
+
+
+def test_the_upstream_url_leaves_out_filtered_parameters() -> None:
+    plan = plan_search(SearchQuery.parse("Observation", "patient=Patient/abc&category=laboratory&code=http://loinc.org|4548-4&unknown=1"))
+
+    assert plan.gap_output == ["unknown"]
+    assert plan.upstream_query == f"{fhir_url}Observation?category=laboratory&code=http%3A%2F%2Floinc.org%7C4548-4&patient=abc"
+    assert plan.search_params.searchParams["code"] == "http://loinc.org%7C4548-4"
@@ -0,0 +1,139 @@
+import asyncio
+
+import httpx
+import pytest
+
+import upstream
+from resilience import AdaptiveLimiter, CircuitBreaker, RetryBudget, UpstreamUnavailable
+from util import fhir_url
+
+
+def test_limiter_queues_over_the_limit_and_backs_off() -> None:
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=4, latency_target=0.0, queue_timeout=0.05)
+
+    async def main() -> None:
+        await limiter.acquire()
+        await limiter.acquire()
+        with pytest.raises(UpstreamUnavailable):
+            await limiter.acquire()
+
+        waiting: asyncio.Task = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.stats()["queued"] == 1
+        limiter.release(overloaded=False)
+        await waiting
+        assert limiter.limit == 2.5
+
+        limiter.release(overloaded=True)
+        assert limiter.stats() == {"limit": 1, "in_flight": 1, "queued": 0, "rejected": 1, "decreases": 1}
+
+    asyncio.run(main())
+
+
+def test_breaker_opens_on_failures_and_closes_after_a_good_probe() -> None:
+    breaker = CircuitBreaker(failure_ratio=0.5, min_calls=4, window=60, open_seconds=0.01)
+
+    for failed in (False, True, False, True):
+        assert breaker.allow() is False
+        breaker.record(failed, probe=False)
+
+    with pytest.raises(UpstreamUnavailable):
+        breaker.allow()
+
+    asyncio.run(asyncio.sleep(0.02))
+    assert breaker.allow() is True
+    with pytest.raises(UpstreamUnavailable):
+        breaker.allow()
+    breaker.record(False, probe=True)
+
+    assert breaker.state == "closed"
+    assert breaker.stats()["opened"] == 1
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_retry_budget_caps_extra_calls() -> None:
+    budget = RetryBudget(ratio=0.5, min_per_second=0, window=60)
+    for _ in range(4):
+        budget.record_call()
+
+    assert [budget.try_spend() for _ in range(3)] == [True, True, False]
+    assert budget.stats() == {"budget_spent": 2, "budget_exhausted": 1}
+
+
+def test_get_retries_a_503_after_retry_after() -> None:
+    statuses: list[int] = [503, 200]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(statuses.pop(0), headers={"Retry-After": "0"}, json={"resourceType": "Patient"})
+
+    async def main() -> httpx.Response:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await upstream.get(f"{fhir_url}Patient/1")
+        finally:
+            await upstream.close_client()
+
+    assert asyncio.run(main()).status_code == 200
+    assert statuses == []
+    assert upstream.extra_calls["retries"] >= 1
+
+
+def test_get_hedges_a_slow_call(monkeypatch) -> None:
+    monkeypatch.setattr(upstream, "upstream_hedging", True)
+    monkeypatch.setattr(upstream.latencies, "value", 0.01)
+    calls: list[int] = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(len(calls))
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"resourceType": "Patient", "id": str(len(calls))})
+
+    async def main() -> httpx.Response:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await upstream.get(f"{fhir_url}Patient/1")
+        finally:
+            await upstream.close_client()
+
+    assert asyncio.run(main()).json()["id"] == "2"
+    assert upstream.extra_calls["hedge_wins"] >= 1
+
+
+def test_slow_calls_lower_the_limit_without_opening_the_breaker(monkeypatch) -> None:
+    monkeypatch.setattr(upstream, "upstream_latency_target", 0.0)
+    monkeypatch.setattr(upstream, "limiter", AdaptiveLimiter(initial_limit=8, min_limit=1, max_limit=8, latency_target=0.0, queue_timeout=1))
+    monkeypatch.setattr(upstream, "breaker", CircuitBreaker(failure_ratio=0.5, min_calls=2, window=60, open_seconds=60))
+    statuses: list[int] = [200, 200, 200, 500, 500, 500]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(statuses.pop(0), json={"resourceType": "Patient"})
+
+    async def main() -> None:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            for _ in range(3):
+                await upstream.get(f"{fhir_url}Patient/1")
+            assert upstream.breaker.state == "closed"
+            assert upstream.limiter.stats()["decreases"] == 3
+            for _ in range(3):
+                await upstream.get(f"{fhir_url}Patient/1")
+            with pytest.raises(UpstreamUnavailable):
+                await upstream.get(f"{fhir_url}Patient/1")
+        finally:
+            await upstream.close_client()
+
+    asyncio.run(main())
+
+
+def test_calls_go_through_with_the_breaker_turned_off(monkeypatch) -> None:
+    monkeypatch.setattr(upstream, "breaker", None)
+
+    async def main() -> httpx.Response:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(500, json={"resourceType": "OperationOutcome"})))
+        try:
+            return [await upstream.get(f"{fhir_url}Patient/1") for _ in range(30)][-1]
+        finally:
+            await upstream.close_client()
+
+    assert asyncio.run(main()).status_code == 500
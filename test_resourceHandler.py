@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fhir.resources.R4B.operationoutcome import OperationOutcome
+from prometheus_client import REGISTRY
+
+import resourceHandler
+import upstream
+import validation
+from cache import CacheEntry, ResourceCache
+from models import EpicTokenResponse
+from query import SearchQuery
+from serializer import loads
+
+invalid_patient: dict = {"resourceType": "Patient", "id": "1", "gender": {"text": "female"}}
+
+
+@pytest.fixture
+def searches(monkeypatch) -> list[str]:
+    """Turns the search cache on with an empty cache and replaces the upstream search with one that numbers its Bundles, returning the searches it ran"""
+
+    ran: list[str] = []
+
+    async def first_search_page(query: SearchQuery) -> tuple[dict, dict[str, str]]:
+        ran.append(query.key)
+        return {"resourceType": "Bundle", "type": "searchset", "id": str(len(ran))}, {}
+
+    monkeypatch.setattr(resourceHandler, "search_cache_enabled", True)
+    monkeypatch.setattr(resourceHandler, "search_cache", ResourceCache(max_bytes=1024 * 1024, default_ttl=60))
+    monkeypatch.setattr(resourceHandler, "first_search_page", first_search_page)
+    return ran
+
+
+def bundle_id(entry: CacheEntry | object) -> str:
+    assert isinstance(entry, CacheEntry)
+    return loads(entry.content)["id"]
+
+
+def test_searches_written_differently_share_a_cache_entry(searches: list[str]) -> None:
+    async def main() -> list[str]:
+        first = await resourceHandler.get_search_entry(SearchQuery.parse("Observation", "patient=Patient/1&code=http://loinc.org|4548-4"))
+        second = await resourceHandler.get_search_entry(SearchQuery.parse("Observation", "code=http%3A%2F%2Floinc.org%7C4548-4&patient=1&category="))
+        return [bundle_id(first), bundle_id(second)]
+
+    assert asyncio.run(main()) == ["1", "1"]
+    assert searches == ["Observation?code=http%3A%2F%2Floinc.org%7C4548-4&patient=1"]
+    assert "Observation?code=http%3A%2F%2Floinc.org%7C4548-4&patient=1" in resourceHandler.search_cache
+
+
+def test_cache_control_skips_reading_or_writing_the_search_cache(searches: list[str]) -> None:
+    query: SearchQuery = SearchQuery.parse("Condition", "patient=1")
+
+    async def main() -> list[str]:
+        cached = await resourceHandler.get_search_entry(query)
+        # no-cache runs the search again and stores the new result, no-store runs it without touching the cache
+        refreshed = await resourceHandler.get_search_entry(query, "no-cache")
+        not_stored = await resourceHandler.get_search_entry(query, "No-Store")
+        return [bundle_id(cached), bundle_id(refreshed), bundle_id(not_stored), bundle_id(await resourceHandler.get_search_entry(query))]
+
+    assert asyncio.run(main()) == ["1", "2", "3", "2"]
+    assert len(searches) == 3
+
+
+@pytest.fixture
+def patient_server(monkeypatch) -> None:
+    """Answers Patient reads with an invalid Patient, from an empty resource cache"""
+
+    async def get_token_object() -> EpicTokenResponse:
+        return EpicTokenResponse(access_token="abc", token_type="Bearer", expires_in=3600, expires=9999999999, scope="system/*.read")
+
+    monkeypatch.setattr(resourceHandler, "get_token_object", get_token_object)
+    monkeypatch.setattr(resourceHandler, "resource_cache", ResourceCache(max_bytes=1024 * 1024, default_ttl=60))
+    monkeypatch.setattr(validation, "sample_counter", itertools.count())
+    upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=invalid_patient)))
+    yield
+    asyncio.run(upstream.close_client())
+
+
+def validations(result: str) -> float:
+    return REGISTRY.get_sample_value("fhirproxy_validations_total", {"resource_type": "Patient", "result": result}) or 0.0
+
+
+def test_patient_reads_are_validated_in_strict_mode(patient_server, monkeypatch) -> None:
+    monkeypatch.setattr(validation, "validation_mode", "strict")
+    app = FastAPI()
+    app.include_router(resourceHandler.resource_router)
+    failed: float = validations("failed")
+
+    async def main() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+            return await client.get("/Patient/1")
+
+    resp: httpx.Response = asyncio.run(main())
+
+    assert resp.json()["resourceType"] == "OperationOutcome"
+    assert "failed FHIR validation" in resp.json()["issue"][0]["diagnostics"]
+    assert validations("failed") == failed + 1
+    assert "Patient/1" not in resourceHandler.resource_cache
+
+
+def test_patient_reads_are_sampled_in_sampled_mode(patient_server, monkeypatch) -> None:
+    monkeypatch.setattr(validation, "validation_mode", "sampled")
+    monkeypatch.setattr(validation, "validation_sample_rate", 2)
+    failed, skipped = validations("failed"), validations("skipped")
+
+    async def main() -> list[CacheEntry | OperationOutcome]:
+        entries: list[CacheEntry | OperationOutcome] = [await resourceHandler.get_resource_entry("Patient", id) for id in ("1", "2", "3")]
+        await asyncio.gather(*validation.background_validations)
+        return entries
+
+    entries: list[CacheEntry | OperationOutcome] = asyncio.run(main())
+
+    # Invalid reads are still returned, 1 in 2 is validated in the background and its failure only counted
+    assert all(isinstance(entry, CacheEntry) and loads(entry.content) == invalid_patient for entry in entries)
+    assert validations("failed") == failed + 2
+    assert validations("skipped") == skipped + 1
+
+
+def test_other_reads_are_not_validated(patient_server, monkeypatch) -> None:
+    monkeypatch.setattr(validation, "validation_mode", "strict")
+    upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=invalid_patient | {"resourceType": "Observation"})))
+
+    entry: CacheEntry | OperationOutcome = asyncio.run(resourceHandler.get_resource_entry("Observation", "1"))
+
+    assert not isinstance(entry, OperationOutcome)
@@ -0,0 +1,103 @@
+import asyncio
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from scheduler import FairScheduler, RateLimiter, SchedulerMiddleware, request_lane
+
+
+def test_requests_are_put_in_lanes() -> None:
+    assert request_lane("GET", "/Patient/123", b"") == "read"
+    assert request_lane("GET", "/Observation", b"patient=123") == "search"
+    assert request_lane("GET", "/Observation", b"patient=123&_proxyAllPages=true") == "bulk"
+    assert request_lane("POST", "/", b"") == "bulk"
+    assert request_lane("POST", "/$export", b"") == "bulk"
+    # Export status polls and downloads do not wait behind bulk work
+    assert request_lane("GET", "/$export/abc", b"") is None
+    assert request_lane("GET", "/$export/abc/Patient.ndjson", b"") is None
+    assert request_lane("GET", "/metrics", b"") is None
+
+
+def test_lanes_are_weighted_and_clients_take_turns() -> None:
+    scheduler = FairScheduler(concurrency=1, weights={"read": 8, "search": 4, "bulk": 1}, queue_timeout=5)
+    handled: list[str] = []
+
+    async def request(name: str, lane: str, client: str) -> None:
+        await scheduler.acquire(lane, client)
+        handled.append(name)
+        scheduler.release()
+
+    async def main() -> None:
+        await scheduler.acquire("search", "busy")
+        waiting: list[asyncio.Task] = []
+        for name, lane, client in [("bulk", "bulk", "a"), ("a1", "search", "a"), ("a2", "search", "a"), ("a3", "search", "a"), ("b1", "search", "b"), ("read", "read", "c")]:
+            waiting.append(asyncio.create_task(request(name, lane, client)))
+            await asyncio.sleep(0)
+        assert scheduler.stats("search")["queue_depth"] == 4
+        scheduler.release()
+        await asyncio.gather(*waiting)
+
+    asyncio.run(main())
+
+    assert handled == ["read", "a1", "b1", "a2", "a3", "bulk"]
+    assert scheduler.in_flight == 0
+
+
+def test_queue_timeout_frees_the_queue() -> None:
+    scheduler = FairScheduler(concurrency=1, weights={"read": 1}, queue_timeout=0.01)
+
+    async def main() -> tuple[bool, bool]:
+        await scheduler.acquire("read", "a")
+        timed_out: bool = await scheduler.acquire("read", "b")
+        scheduler.release()
+        return timed_out, await scheduler.acquire("read", "c")
+
+    assert asyncio.run(main()) == (False, True)
+    assert scheduler.stats("read") == {"queue_depth": 0, "admitted": 2, "timed_out": 1}
+
+
+def test_each_client_is_rate_limited_on_its_own() -> None:
+    app = Starlette(routes=[Route("/Patient/{id}", lambda request: PlainTextResponse("ok")), Route("/health", lambda request: PlainTextResponse("ok"))])
+    limited = SchedulerMiddleware(app, FairScheduler(concurrency=2, weights={"read": 1}, queue_timeout=1), RateLimiter(rate=1, burst=2), None)
+
+    async def main() -> list[httpx.Response]:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=limited), base_url="http://proxy") as client:
+            responses: list[httpx.Response] = [await client.get("/Patient/1", headers={"X-API-Key": "one"}) for _ in range(3)]
+            responses.append(await client.get("/Patient/1", headers={"X-API-Key": "two"}))
+            responses.append(await client.get("/health", headers={"X-API-Key": "one"}))
+            return responses
+
+    responses: list[httpx.Response] = asyncio.run(main())
+
+    assert [response.status_code for response in responses] == [200, 200, 429, 200, 200]
+    assert responses[2].headers["Retry-After"] == "1"
+    assert responses[2].json()["issue"][0]["code"] == "throttled"
+
+
+def test_clients_behind_one_ip_each_get_their_own_burst_within_the_ip_limit() -> None:
+    app = Starlette(routes=[Route("/Patient/{id}", lambda request: PlainTextResponse("ok"))])
+    limited = SchedulerMiddleware(app, None, RateLimiter(rate=1, burst=2), RateLimiter(rate=1, burst=5))
+
+    async def main() -> list[int]:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=limited), base_url="http://proxy") as client:
+            # A request turned away by its client limit does not use up the IP limit
+            statuses: list[int] = [(await client.get("/Patient/1", headers={"X-API-Key": key})).status_code for key in ("one", "one", "one", "two", "two")]
+            # A client told apart only by its IP address has its own client limit too
+            statuses.append((await client.get("/Patient/1")).status_code)
+            statuses.append((await client.get("/Patient/1", headers={"X-API-Key": "three"})).status_code)
+            return statuses
+
+    assert asyncio.run(main()) == [200, 200, 429, 200, 200, 200, 429]
+
+
+def test_clients_without_an_api_key_are_limited_by_ip_address() -> None:
+    app = Starlette(routes=[Route("/Patient/{id}", lambda request: PlainTextResponse("ok"))])
+    limited = SchedulerMiddleware(app, None, RateLimiter(rate=1, burst=2), None)
+
+    async def main() -> list[int]:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=limited), base_url="http://proxy") as client:
+            return [(await client.get("/Patient/1")).status_code for _ in range(3)]
+
+    assert asyncio.run(main()) == [200, 200, 429]
@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from pydantic import ValidationError
+
+import upstream
+import validation
+from query import SearchQuery
+from search import all_pages, run_search, stream_all_pages
+from util import fhir_url
+
+
+def observation_page(page: int, pages: int) -> dict:
+    bundle: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "entry": [{"resource": {"resourceType": "Observation", "id": f"{page}-{i}", "status": "final", "code": {"text": "A1c"}}} for i in range(2)],
+    }
+    if page + 1 < pages:
+        bundle["link"] = [{"relation": "next", "url": f"{fhir_url}Observation?patient=1&page={page + 1}"}]
+    return bundle
+
+
+def test_all_pages_are_streamed_as_one_bundle() -> None:
+    requested: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(str(request.url))
+        return httpx.Response(200, json=observation_page(int(request.url.params.get("page", 0)), 3))
+
+    async def fetch(reference: str) -> dict | None:
+        return None
+
+    async def main() -> bytes:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            first_page = await run_search(SearchQuery.parse("Observation", "patient=1"), {}, fetch)
+            assert isinstance(first_page, dict)
+            return b"".join([chunk async for chunk in stream_all_pages(SearchQuery.parse("Observation", "patient=1"), first_page, {}, fetch)])
+        finally:
+            await upstream.close_client()
+
+    bundle: dict = json.loads(asyncio.run(main()))
+
+    assert len(requested) == 3
+    assert bundle["total"] == 6
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == ["0-0", "0-1", "1-0", "1-1", "2-0", "2-1"]
+
+
+def test_a_page_that_fails_ends_the_stream_with_an_outcome() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        page: int = int(request.url.params.get("page", 0))
+        if page == 2:
+            raise httpx.ConnectError("Connection refused", request=request)
+        return httpx.Response(200, json=observation_page(page, 4))
+
+    async def fetch(reference: str) -> dict | None:
+        return None
+
+    async def main() -> bytes:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            first_page = await run_search(SearchQuery.parse("Observation", "patient=1"), {}, fetch)
+            assert isinstance(first_page, dict)
+
+            async def collect() -> bytes:
+                return b"".join([chunk async for chunk in stream_all_pages(SearchQuery.parse("Observation", "patient=1"), first_page, {}, fetch)])
+
+            # Before the fix the stream waited forever for a page that was never going to come
+            return await asyncio.wait_for(collect(), timeout=5)
+        finally:
+            await upstream.close_client()
+
+    bundle: dict = json.loads(asyncio.run(main()))
+
+    assert bundle["total"] == 4
+    assert bundle["entry"][-1]["search"]["mode"] == "outcome"
+    assert "ConnectError" in bundle["entry"][-1]["resource"]["issue"][0]["diagnostics"]
+
+
+def test_other_errors_fetching_a_page_are_raised_to_the_consumer() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        page: int = int(request.url.params.get("page", 0))
+        if page == 2:
+            raise RuntimeError("bug")
+        return httpx.Response(200, json=observation_page(page, 4))
+
+    async def fetch(reference: str) -> dict | None:
+        return None
+
+    async def main() -> list[str]:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        ids: list[str] = []
+        try:
+            first_page = await run_search(SearchQuery.parse("Observation", "patient=1"), {}, fetch)
+            assert isinstance(first_page, dict)
+
+            async def collect() -> None:
+                async for page in all_pages(SearchQuery.parse("Observation", "patient=1"), first_page, {}, fetch):
+                    ids.extend(entry["resource"]["id"] for entry in page["entry"])
+
+            with pytest.raises(RuntimeError, match="bug"):
+                await asyncio.wait_for(collect(), timeout=5)
+            return ids
+        finally:
+            await upstream.close_client()
+
+    assert asyncio.run(main()) == ["0-0", "0-1", "1-0", "1-1"]
+
+
+def test_validation_mode_decides_whether_invalid_pages_fail(monkeypatch) -> None:
+    invalid_page: dict = {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": {"resourceType": "Observation", "id": "1", "code": {"text": "A1c"}}}]}
+
+    async def fetch(reference: str) -> dict | None:
+        return None
+
+    async def search() -> dict | object:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=invalid_page)))
+        try:
+            return await run_search(SearchQuery.parse("Observation", "patient=1"), {}, fetch)
+        finally:
+            await upstream.close_client()
+
+    monkeypatch.setattr(validation, "validation_mode", "strict")
+    with pytest.raises(ValidationError):
+        asyncio.run(search())
+
+    monkeypatch.setattr(validation, "validation_mode", "off")
+    assert asyncio.run(search()) == invalid_page
@@ -1,13 +1,21 @@
 import json
+from collections.abc import Iterator
 from importlib.resources import files
 
 import fhirsearchhelper.resources
+import pytest
 from fastapi.testclient import TestClient
 from httpx import Response
 
 from main import app
 
-client = TestClient(app)
+
+@pytest.fixture(scope="module")
+def client() -> Iterator[TestClient]:
+    # Entering the TestClient runs the app lifespan, which opens the shared upstream client
+    with TestClient(app) as test_client:
+        yield test_client
+
 
 epic_r4_search_supported_resources: list[str] = [
     "Account",
@@ -57,7 +65,7 @@ with files(fhirsearchhelper.resources).joinpath("fhir_r4_search_params.json").op
     data: dict[str, dict[str, dict[str, str]]] = json.load(fin)
 
 
-def test_patient_search() -> None:
+def test_patient_search(client: TestClient) -> None:
     query_dict: dict[str, str] = {
         "address": "123 Main St.",
         "family": "Mychart",
@@ -82,7 +90,7 @@ def test_patient_search() -> None:
     assert query_dict["telecom"] in [item["value"] for item in resource["telecom"]]
 
 
-def test_condition_search() -> None:
+def test_condition_search(client: TestClient) -> None:
     query_dict: dict[str, str] = {
         "patient": "eovSKnwDlsv-8MsEzCJO3BA3",
         "clinical-status": "active,inactive,resolved",
@@ -113,7 +121,7 @@ def test_condition_search() -> None:
     assert any([query_dict["code"].split("|")[1] == coding["code"] for entry in entries_filtered for coding in entry["resource"]["code"]["coding"]])
 
 
-def test_observation_search():
+def test_observation_search(client: TestClient):
     query_dict: dict[str, str] = {
         "patient": "e63wRTbPfr1p8UW81d8Seiw3",
         "category": "laboratory",
@@ -145,7 +153,7 @@ def test_observation_search():
     assert all([entry["resource"]["code"]["coding"][0]["code"] == query_dict["code"].split("|")[1] for entry in filtered_entries])
 
 
-def test_medication_request_search() -> None:
+def test_medication_request_search(client: TestClient) -> None:
     query_dict: dict[str, str] = {
         "patient": "e.Rxkbv0HmfyDyboA-LtyRQ3",
         "code": "http://www.nlm.nih.gov/research/umls/rxnorm|2418",
@@ -172,7 +180,7 @@ def test_medication_request_search() -> None:
     assert any([query_dict["code"].split("|")[1] == coding["code"] for entry in filtered_entries for coding in entry["resource"]["medicationCodeableConcept"]["coding"]])
 
 
-def test_document_reference_search() -> None:
+def test_document_reference_search(client: TestClient) -> None:
     query_dict: dict[str, str] = {
         "subject": "e63wRTbPfr1p8UW81d8Seiw3",
         "type": "http://loinc.org|18748-4",
@@ -0,0 +1,20 @@
+from serializer import FastJSONResponse, dumps, loads
+
+
+def test_bytes_are_sent_as_they_are() -> None:
+    # Spacing, key order and escapes an orjson round trip would change
+    body: bytes = b'{"resourceType": "Patient",  "id":"1", "name":[{"text":"Ren\\u00e9e"}], "b":1, "a":2}'
+
+    response = FastJSONResponse(body, status_code=201)
+
+    assert response.body == body
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["content-length"] == str(len(body))
+
+
+def test_objects_are_encoded_with_orjson() -> None:
+    response = FastJSONResponse({"resourceType": "Patient", "name": [{"text": "Renée"}], 1: "non-string key"})
+
+    assert response.body == '{"resourceType":"Patient","name":[{"text":"Renée"}],"1":"non-string key"}'.encode()
+    assert loads(dumps({"a": [1, 2]})) == {"a": [1, 2]}
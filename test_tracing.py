@@ -0,0 +1,57 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+import tracing
+import upstream
+
+incoming_trace_id: str = "4bf92f3577b34da6a3ce929d0e0e4736"
+incoming_parent_id: str = "00f067aa0ba902b7"
+
+
+@pytest.fixture(autouse=True)
+def fhir_auth(monkeypatch) -> None:
+    monkeypatch.setattr("helpers.fhir_auth", "Bearer abc")
+
+
+def test_request_spans_continue_the_incoming_trace(monkeypatch) -> None:
+    exporter = tracing.InMemoryExporter()
+    monkeypatch.setattr(tracing, "exporter", exporter)
+    monkeypatch.setattr(tracing, "tracing_enabled", True)
+    monkeypatch.setattr(main, "server_timing_enabled", True)
+    upstream_traceparents: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        upstream_traceparents.append(request.headers["traceparent"])
+        return httpx.Response(200, json={"resourceType": "Observation", "id": "traced", "status": "final", "code": {"text": "A1c"}})
+
+    async def run() -> httpx.Response:
+        upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy") as client:
+                return await client.get("/Observation/traced", headers={"traceparent": f"00-{incoming_trace_id}-{incoming_parent_id}-01"})
+        finally:
+            await upstream.close_client()
+
+    response: httpx.Response = asyncio.run(run())
+
+    assert response.status_code == 200
+    assert {part.split(";")[0] for part in response.headers["Server-Timing"].split(", ")} >= {"token", "upstream", "expansion", "serialization"}
+
+    spans: list[tracing.Span] = exporter.traces[-1]
+    by_name: dict[str, tracing.Span] = {span.name: span for span in spans}
+    assert {span.trace_id for span in spans} == {incoming_trace_id}
+    assert by_name["request"].parent_id == incoming_parent_id
+    assert by_name["token"].parent_id == by_name["request"].span_id
+    assert upstream_traceparents == [f"00-{incoming_trace_id}-{by_name['upstream'].span_id}-01"]
+
+
+def test_exporters_have_to_implement_export() -> None:
+    class Incomplete(tracing.SpanExporter):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()  # type: ignore[abstract]
+    tracing.InMemoryExporter().shutdown()
@@ -0,0 +1,190 @@
+"""File for lightweight request tracing, with W3C traceparent propagation, spans for each stage of a request and pluggable exporters"""
+
+import atexit
+import logging
+import queue
+import random
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from serializer import dumps
+from util import server_timing_enabled, trace_exporter, trace_file, trace_sample_rate
+
+logger: logging.Logger = logging.getLogger("main.tracing")
+
+traceparent_pattern: re.Pattern[str] = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+
+@dataclass(slots=True)
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    start: float
+    duration: float = 0.0
+    attributes: dict[str, str | int | float] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentId": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "durationMs": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+@dataclass(slots=True)
+class Trace:
+    """The spans of one request, sampled decides whether they are exported"""
+
+    trace_id: str
+    sampled: bool
+    spans: list[Span] = field(default_factory=list)
+    finished: bool = False
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class SpanExporter(ABC):
+    """Receives the spans of every sampled request once it has been handled"""
+
+    @abstractmethod
+    def export(self, spans: list[Span]) -> None: ...
+
+    def shutdown(self) -> None:
+        """Called at exit, exporters that buffer spans flush them here"""
+
+
+class InMemoryExporter(SpanExporter):
+    """Keeps the spans of the last max_traces traces, for tests and debugging"""
+
+    def __init__(self, max_traces: int = 1000) -> None:
+        self.traces: deque[list[Span]] = deque(maxlen=max_traces)
+
+    def export(self, spans: list[Span]) -> None:
+        self.traces.append(spans)
+
+
+class FileExporter(SpanExporter):
+    """Appends each span as a JSON line to a file, written by a background thread so requests do not wait on the file"""
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self._queue: queue.SimpleQueue[list[Span] | None] = queue.SimpleQueue()
+        self._thread: threading.Thread = threading.Thread(target=self._write, name="trace-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def export(self, spans: list[Span]) -> None:
+        self._queue.put(spans)
+
+    def _write(self) -> None:
+        with open(self.path, "ab") as file:
+            while (spans := self._queue.get()) is not None:
+                file.write(b"".join(dumps(span.to_dict()) + b"\n" for span in spans))
+                if self._queue.empty():
+                    file.flush()
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+def open_exporter(kind: str, path: str) -> SpanExporter | None:
+    """Creates the exporter for the TRACE_EXPORTER setting, none, memory or file"""
+
+    if kind == "file":
+        logger.info(f"Writing trace spans to {path}")
+        return FileExporter(path)
+    if kind == "memory":
+        return InMemoryExporter()
+    return None
+
+
+exporter: SpanExporter | None = open_exporter(trace_exporter, trace_file)
+# Requests are only traced when the spans go somewhere
+tracing_enabled: bool = exporter is not None or server_timing_enabled
+
+
+def new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def start_trace(traceparent: str | None) -> tuple[Trace, str | None] | None:
+    """
+    Starts the trace of a request, continuing the one in the request's traceparent header if it has a valid one
+
+    Returns the trace and the span id of the caller, which is the parent of the request's root span, or None when tracing is off.
+    """
+
+    if not tracing_enabled:
+        return None
+    match: re.Match[str] | None = traceparent_pattern.fullmatch(traceparent.strip().lower()) if traceparent else None
+    if match and match.group(1) != "0" * 32:
+        trace: Trace = Trace(trace_id=match.group(1), sampled=bool(int(match.group(3), 16) & 1))
+        parent_id: str | None = match.group(2)
+    else:
+        trace = Trace(trace_id=new_id(128), sampled=random.random() < trace_sample_rate)
+        parent_id = None
+    current_trace.set(trace)
+    return trace, parent_id
+
+
+def finish_trace(trace: Trace) -> None:
+    trace.finished = True
+    if exporter is not None and trace.sampled:
+        exporter.export(trace.spans)
+
+
+@contextmanager
+def span(name: str, parent_id: str | None = None, **attributes: str | float) -> Iterator[Span | None]:
+    """Times a block as a span of the current trace, a child of the current span, and does nothing outside a traced request"""
+
+    trace: Trace | None = current_trace.get()
+    if trace is None or trace.finished:
+        yield None
+        return
+
+    parent: Span | None = current_span.get()
+    new_span: Span = Span(trace.trace_id, new_id(64), parent.span_id if parent else parent_id, name, time.time(), attributes=attributes)
+    current_span.set(new_span)
+    start_time: float = time.perf_counter()
+    try:
+        yield new_span
+    finally:
+        new_span.duration = time.perf_counter() - start_time
+        # Set rather than reset, since a span in a streamed body can end in a different context than it started in
+        current_span.set(parent)
+        trace.spans.append(new_span)
+
+
+def traceparent() -> str | None:
+    """The traceparent header for a call made in the current span, so the FHIR server can join the trace"""
+
+    trace: Trace | None = current_trace.get()
+    parent: Span | None = current_span.get()
+    if trace is None or parent is None:
+        return None
+    return f"00-{trace.trace_id}-{parent.span_id}-{'01' if trace.sampled else '00'}"
+
+
+def server_timing(trace: Trace) -> str:
+    """A Server-Timing header value with the total time of each stage, e.g. token;dur=1.2, upstream;dur=830.5"""
+
+    totals: dict[str, float] = {}
+    for finished_span in trace.spans:
+        totals[finished_span.name] = totals.get(finished_span.name, 0.0) + finished_span.duration
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
@@ -0,0 +1,243 @@
+"""File for the shared upstream client used for every call to the FHIR server"""
+
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+import metrics
+import tracing
+from compression import encodings
+from resilience import AdaptiveLimiter, CircuitBreaker, LatencyTracker, RetryBudget
+from util import (
+    breaker_enabled,
+    breaker_failure_ratio,
+    breaker_min_calls,
+    breaker_open_seconds,
+    breaker_window,
+    fhir_url,
+    retry_budget_min_per_second,
+    retry_budget_ratio,
+    upstream_hedge_min_delay,
+    upstream_hedge_percentile,
+    upstream_hedging,
+    upstream_http2,
+    upstream_keepalive_expiry,
+    upstream_latency_target,
+    upstream_limit_initial,
+    upstream_limit_max,
+    upstream_limit_min,
+    upstream_max_connections,
+    upstream_max_keepalive_connections,
+    upstream_queue_timeout,
+    upstream_retries,
+    upstream_retry_base_delay,
+    upstream_retry_max_delay,
+    upstream_timeout,
+)
+
+logger: logging.Logger = logging.getLogger("main.upstream")
+
+client: httpx.AsyncClient | None = None
+
+limiter: AdaptiveLimiter = AdaptiveLimiter(
+    initial_limit=upstream_limit_initial, min_limit=upstream_limit_min, max_limit=upstream_limit_max, latency_target=upstream_latency_target, queue_timeout=upstream_queue_timeout
+)
+breaker: CircuitBreaker | None = CircuitBreaker(failure_ratio=breaker_failure_ratio, min_calls=breaker_min_calls, window=breaker_window, open_seconds=breaker_open_seconds) if breaker_enabled else None
+
+latencies: LatencyTracker = LatencyTracker(percentile=upstream_hedge_percentile)
+retry_budget: RetryBudget = RetryBudget(ratio=retry_budget_ratio, min_per_second=retry_budget_min_per_second)
+extra_calls: dict[str, int] = {"retries": 0, "hedges": 0, "hedge_wins": 0}
+
+metrics.register_stats("upstream", "kind", "limiter", limiter.stats)
+if breaker is not None:
+    metrics.register_stats("upstream", "kind", "breaker", breaker.stats)
+metrics.register_stats("upstream", "kind", "retries", lambda: extra_calls | retry_budget.stats())
+
+
+async def open_client() -> httpx.AsyncClient:
+    """Create the application-scoped client, called from the FastAPI lifespan"""
+
+    global client
+    if client is None:
+        limits = httpx.Limits(max_connections=upstream_max_connections, max_keepalive_connections=upstream_max_keepalive_connections, keepalive_expiry=upstream_keepalive_expiry)
+        # Asking for the same encodings that are offered to clients lets passthrough mode relay compressed bodies as they are
+        client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout=upstream_timeout), http2=upstream_http2, headers={"Accept-Encoding": ", ".join(encodings)})
+        logger.info(f"Opened upstream client with {upstream_max_connections} max connections, {upstream_max_keepalive_connections} keep-alive connections and HTTP/2 set to {upstream_http2}")
+    return client
+
+
+async def close_client() -> None:
+    """Close the application-scoped client and its connection pool"""
+
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+        logger.info("Closed upstream client")
+
+
+def get_client() -> httpx.AsyncClient:
+    if client is None:
+        raise RuntimeError("The upstream client is not open, the application lifespan has not been started")
+    return client
+
+
+def elapsed_seconds(resp: httpx.Response) -> float:
+    """Time the upstream took to respond, 0 for responses that never went over the network (e.g. from a MockTransport)"""
+    try:
+        return resp.elapsed.total_seconds()
+    except RuntimeError:
+        return 0.0
+
+
+def resource_type_from_url(url: str) -> str:
+    """Label for metrics, the resource type (or operation like metadata) for calls to the FHIR_URL and token for anything else"""
+    if not url.startswith(fhir_url):
+        return "token"
+    return url[len(fhir_url) :].split("?", 1)[0].split("/", 1)[0]
+
+
+def retry_delay(resp: httpx.Response, attempt: int) -> float | None:
+    """Seconds to wait before retrying a 429 or 503, from Retry-After if the FHIR server sent one, None if that is longer than UPSTREAM_RETRY_MAX_DELAY"""
+
+    retry_after: str | None = resp.headers.get("Retry-After")
+    if retry_after is None:
+        # Full jitter keeps the retries of many requests that failed together from arriving together
+        return random.uniform(0, min(upstream_retry_base_delay * 2**attempt, upstream_retry_max_delay))
+    try:
+        delay: float = float(retry_after)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return max(delay, 0.0) if delay <= upstream_retry_max_delay else None
+
+
+def is_failure(status_code: int) -> bool:
+    """Whether a response says the FHIR server is failing or overloaded, which counts against the circuit breaker and lowers the concurrency limit"""
+    return status_code == 429 or status_code >= 500
+
+
+async def send(request: httpx.Request, stream: bool = False) -> httpx.Response:
+    """
+    Sends a request with the shared client and records its status and upstream latency
+
+    Calls to the FHIR_URL go through the circuit breaker and the adaptive concurrency limit, which raise UpstreamUnavailable instead of calling a failing or overloaded server.
+    Calls slower than UPSTREAM_LATENCY_TARGET only lower the concurrency limit, since large searches and exports are slow even when the server is healthy,
+    while errors, 429s and 5xx responses also count against the breaker.
+    """
+
+    resource_type: str = resource_type_from_url(str(request.url))
+    guarded: bool = resource_type != "token"
+    probe: bool = False
+    if guarded:
+        probe = breaker.allow() if breaker is not None else False
+        try:
+            await limiter.acquire()
+        except BaseException:
+            if breaker is not None:
+                breaker.record(None, probe)
+            raise
+
+    failed: bool | None = None
+    overloaded: bool | None = None
+    start_time: float = time.perf_counter()
+    with tracing.span("upstream", resource_type=resource_type, method=request.method) as upstream_span:
+        # The FHIR server gets the trace context so its own traces can be joined up with the proxy's, the token endpoint does not
+        header: str | None = tracing.traceparent() if guarded else None
+        if header:
+            request.headers["traceparent"] = header
+        try:
+            resp: httpx.Response = await get_client().send(request, stream=stream)
+            # A streamed response only has elapsed once the body has been read, so time to headers is used for those
+            upstream_seconds: float = (0.0 if stream else elapsed_seconds(resp)) or time.perf_counter() - start_time
+            failed = is_failure(resp.status_code)
+            overloaded = failed or upstream_seconds > upstream_latency_target
+        except httpx.HTTPError:
+            metrics.observe_upstream(resource_type, 0, time.perf_counter() - start_time)
+            failed = overloaded = True
+            raise
+        finally:
+            if guarded:
+                limiter.release(overloaded)
+                if breaker is not None:
+                    breaker.record(failed, probe)
+        if upstream_span is not None:
+            upstream_span.attributes["status_code"] = resp.status_code
+    if guarded:
+        latencies.record(upstream_seconds)
+    metrics.observe_upstream(resource_type, resp.status_code, upstream_seconds)
+    return resp
+
+
+async def hedged_send(url: str, headers: dict[str, str] | None) -> httpx.Response:
+    """
+    Sends a GET and, if there is no response after the hedge delay, the same GET again, returning whichever response comes first
+
+    The delay is the UPSTREAM_HEDGE_PERCENTILE latency of recent calls, so only the slowest few calls are hedged. Until enough calls have been seen there is no
+    delay to go by and nothing is hedged.
+    """
+
+    if not upstream_hedging or latencies.value is None:
+        return await send(get_client().build_request("GET", url, headers=headers))
+
+    tasks: list[asyncio.Task] = [asyncio.create_task(send(get_client().build_request("GET", url, headers=headers)))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=max(latencies.value, upstream_hedge_min_delay))
+        if done or not retry_budget.try_spend():
+            return await tasks[0]
+
+        extra_calls["hedges"] += 1
+        tasks.append(asyncio.create_task(send(get_client().build_request("GET", url, headers=headers))))
+        pending: set[asyncio.Task] = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    if task is tasks[1]:
+                        extra_calls["hedge_wins"] += 1
+                    return task.result()
+        # Both calls failed, the error of the first one is raised
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def get(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    """Sends a GET, which is idempotent, so it is hedged and retried on a 429 or 503 while the retry budget allows"""
+
+    guarded: bool = url.startswith(fhir_url)
+    if not guarded:
+        return await send(get_client().build_request("GET", url, headers=headers))
+
+    retry_budget.record_call()
+    attempt: int = 0
+    while True:
+        resp: httpx.Response = await hedged_send(url, headers)
+        if resp.status_code not in (429, 503) or attempt >= upstream_retries:
+            return resp
+        delay: float | None = retry_delay(resp, attempt)
+        if delay is None or not retry_budget.try_spend():
+            return resp
+        attempt += 1
+        extra_calls["retries"] += 1
+        logger.warning(f"The FHIR server returned a {resp.status_code} for {url}, retrying in {delay:.2f} seconds ({attempt}/{upstream_retries})")
+        await asyncio.sleep(delay)
+
+
+async def stream_get(url: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    """Sends a GET without reading the body, the caller has to read or close the returned response"""
+    return await send(get_client().build_request("GET", url, headers=headers), stream=True)
+
+
+async def post(url: str, data: dict | None = None, headers: dict[str, str] | None = None) -> httpx.Response:
+    return await send(get_client().build_request("POST", url, data=data, headers=headers))
@@ -3,7 +3,39 @@ import os
 
 logger: logging.Logger = logging.getLogger("main.util")
 
+
+def parse_pairs(pairs_str: str, setting: str, pair_format: str) -> dict[str, float]:
+    """Parses a comma separated list of name=number pairs, e.g. Patient=600,Observation=60"""
+
+    pairs: dict[str, float] = {}
+    for pair in pairs_str.split(","):
+        if not pair.strip():
+            continue
+        if "=" not in pair:
+            logger.error(f"Ignoring {setting} setting {pair} since it is not formatted as {pair_format}")
+            continue
+        name, number = pair.split("=", 1)
+        pairs[name.strip()] = float(number)
+    return pairs
+
+
+def parse_ttls(ttls_str: str) -> dict[str, float]:
+    """Parses a comma separated list of ResourceType=seconds pairs, e.g. Patient=600,Observation=60"""
+    return parse_pairs(ttls_str, "cache TTL", "ResourceType=seconds")
+
+
 log_level: str = os.environ.get("LOG_LEVEL", "INFO")
+# LOG_FORMAT=json writes each log record as one JSON object per line instead of colored text
+log_format: str = os.environ.get("LOG_FORMAT", "text").lower()
+# Share of successful requests, from 0 to 1, that get an access log line, requests that fail with a 4xx or 5xx are always logged
+access_log_sample_rate: float = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", "1"))
+
+# Requests are traced when TRACE_EXPORTER is memory or file, which appends spans as JSON lines to TRACE_FILE, or when SERVER_TIMING is set
+trace_exporter: str = os.environ.get("TRACE_EXPORTER", "none").lower()
+trace_file: str = os.environ.get("TRACE_FILE", "traces.ndjson")
+trace_sample_rate: float = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+server_timing_enabled: bool = os.environ.get("SERVER_TIMING", "False").lower() == "true"
+
 client_id: str = os.environ["CLIENT_ID"]
 scope: str = os.environ["SCOPE"]
 fhir_url: str = os.environ["FHIR_URL"]
@@ -21,6 +53,9 @@ if capability_statement == "EPIC_R4_STANDARD":
 else:
     capability_statement_file = "epic_r4_metadata_edited.json"
 
+# Seconds between checks of whether the CapabilityStatement file changed and its search parameters need reloading
+capability_check_interval: float = float(os.environ.get("CAPABILITY_CHECK_INTERVAL", "5"))
+
 if public_key_text and public_key_file:
     public_key = public_key_text
 elif public_key_file:
@@ -51,3 +86,113 @@ if passthrough_mode_str.lower() == "true":
     passthrough_mode = True
 else:
     passthrough_mode = False
+
+# Passthrough mode only logs Bundle totals when asked to, and then only scans the start of the body for them
+passthrough_log_totals: bool = os.environ.get("PASSTHROUGH_LOG_TOTALS", "False").lower() == "true"
+passthrough_scan_bytes: int = int(os.environ.get("PASSTHROUGH_SCAN_BYTES", "4096"))
+
+# Shared upstream client settings
+upstream_timeout: float = float(os.environ.get("UPSTREAM_TIMEOUT", "300"))
+upstream_max_connections: int = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+upstream_max_keepalive_connections: int = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+upstream_keepalive_expiry: float = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+upstream_http2: bool = os.environ.get("UPSTREAM_HTTP2", "False").lower() == "true"
+
+# Calls to the FHIR_URL are limited by an adaptive concurrency limit, calls slower than UPSTREAM_LATENCY_TARGET seconds lower it
+upstream_limit_initial: int = int(os.environ.get("UPSTREAM_LIMIT_INITIAL", "20"))
+upstream_limit_min: int = int(os.environ.get("UPSTREAM_LIMIT_MIN", "2"))
+upstream_limit_max: int = int(os.environ.get("UPSTREAM_LIMIT_MAX", os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100")))
+upstream_latency_target: float = float(os.environ.get("UPSTREAM_LATENCY_TARGET", "10"))
+upstream_queue_timeout: float = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "30"))
+
+# The circuit breaker pauses calls to the FHIR_URL for BREAKER_OPEN_SECONDS once BREAKER_FAILURE_RATIO of the calls in the last BREAKER_WINDOW seconds failed, unless BREAKER_ENABLED is false
+breaker_enabled: bool = os.environ.get("BREAKER_ENABLED", "True").lower() == "true"
+breaker_failure_ratio: float = float(os.environ.get("BREAKER_FAILURE_RATIO", "0.5"))
+breaker_min_calls: int = int(os.environ.get("BREAKER_MIN_CALLS", "20"))
+breaker_window: float = float(os.environ.get("BREAKER_WINDOW", "30"))
+breaker_open_seconds: float = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+
+# GETs to the FHIR_URL are retried on a 429 or 503 up to UPSTREAM_RETRIES times, after Retry-After or a jittered backoff of at most UPSTREAM_RETRY_MAX_DELAY seconds
+upstream_retries: int = int(os.environ.get("UPSTREAM_RETRIES", "2"))
+upstream_retry_base_delay: float = float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+upstream_retry_max_delay: float = float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY", "5"))
+
+# With UPSTREAM_HEDGING set, a GET with no response after the UPSTREAM_HEDGE_PERCENTILE latency of recent calls is sent again and the first response is used
+upstream_hedging: bool = os.environ.get("UPSTREAM_HEDGING", "False").lower() == "true"
+upstream_hedge_percentile: float = float(os.environ.get("UPSTREAM_HEDGE_PERCENTILE", "95"))
+upstream_hedge_min_delay: float = float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", "0.05"))
+
+# Retries and hedged GETs together stay under RETRY_BUDGET_RATIO of the calls in the last 10 seconds, plus RETRY_BUDGET_MIN_PER_SECOND
+retry_budget_ratio: float = float(os.environ.get("RETRY_BUDGET_RATIO", "0.1"))
+retry_budget_min_per_second: float = float(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", "1"))
+
+# Responses of at least COMPRESSION_MIN_SIZE bytes are compressed for clients that accept gzip or brotli, and stored gzipped in the caches
+compression_enabled: bool = os.environ.get("COMPRESSION_ENABLED", "True").lower() == "true"
+compression_min_size: int = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+compression_level: int = int(os.environ.get("COMPRESSION_LEVEL", "6"))
+brotli_quality: int = int(os.environ.get("BROTLI_QUALITY", "4"))
+
+# Resource cache settings
+cache_max_bytes: int = int(os.environ.get("CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+cache_default_ttl: float = float(os.environ.get("CACHE_DEFAULT_TTL", "300"))
+cache_ttls: dict[str, float] = parse_ttls(os.environ.get("CACHE_TTLS", ""))
+cache_error_ttl: float = float(os.environ.get("CACHE_ERROR_TTL", "30"))
+
+# CACHE_BACKEND=sqlite keeps the resource and search caches in a SQLite file at CACHE_PATH that every worker on the node shares, instead of in memory
+cache_backend: str = os.environ.get("CACHE_BACKEND", "memory").lower()
+cache_path: str = os.environ.get("CACHE_PATH", "fhirproxy_cache.sqlite3")
+
+# Seconds past their TTL that cached responses are kept, to be served while the FHIR_URL is unavailable
+cache_stale_ttl: float = float(os.environ.get("CACHE_STALE_TTL", "3600"))
+
+# Seconds the SMART endpoints from the CapabilityStatement are used before they are refreshed in the background
+discovery_ttl: float = float(os.environ.get("DISCOVERY_TTL", "3600"))
+
+# Seconds before a token expires that a new one is requested in the background
+token_refresh_skew: float = float(os.environ.get("TOKEN_REFRESH_SKEW", "60"))
+
+# Search cache settings, the search cache is off unless SEARCH_CACHE_ENABLED is set
+search_cache_enabled: bool = os.environ.get("SEARCH_CACHE_ENABLED", "False").lower() == "true"
+search_cache_max_bytes: int = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+search_cache_default_ttl: float = float(os.environ.get("SEARCH_CACHE_DEFAULT_TTL", "60"))
+search_cache_ttls: dict[str, float] = parse_ttls(os.environ.get("SEARCH_CACHE_TTLS", ""))
+
+# Most references fetched at once while expanding a single read or search Bundle
+expansion_concurrency: int = int(os.environ.get("EXPANSION_CONCURRENCY", "10"))
+
+# Searches with _proxyAllPages=true follow next links, with this many pages fetched ahead of the client, and stop at these limits
+paging_prefetch: int = int(os.environ.get("PAGING_PREFETCH", "2"))
+paging_max_entries: int = int(os.environ.get("PAGING_MAX_ENTRIES", "10000"))
+paging_max_bytes: int = int(os.environ.get("PAGING_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Bulk export jobs write their NDJSON files under EXPORT_DIR, running at most EXPORT_WORKERS searches at once across all jobs
+export_dir: str = os.environ.get("EXPORT_DIR", "exports")
+export_workers: int = int(os.environ.get("EXPORT_WORKERS", "4"))
+
+# Most entries of a batch Bundle run at once
+batch_concurrency: int = int(os.environ.get("BATCH_CONCURRENCY", "10"))
+
+# Requests to the FHIR routes are handled at most SCHEDULER_CONCURRENCY at once, 0 (the default) turns this off, and waiting ones are picked by weighted fair queuing
+# across the read, search and bulk lanes and across clients, failing with a 503 after SCHEDULER_QUEUE_TIMEOUT seconds
+scheduler_concurrency: int = int(os.environ.get("SCHEDULER_CONCURRENCY", "0"))
+scheduler_queue_timeout: float = float(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", "30"))
+scheduler_weights: dict[str, float] = {"read": 8.0, "search": 4.0, "bulk": 1.0} | parse_pairs(os.environ.get("SCHEDULER_WEIGHTS", ""), "scheduler weight", "lane=weight")
+
+# Each client, told apart by the CLIENT_ID_HEADER API key, its bearer token's subject or its IP address, gets CLIENT_RATE_LIMIT requests per second
+# with bursts of up to CLIENT_RATE_BURST, 0 (the default) turns this off
+client_id_header: str = os.environ.get("CLIENT_ID_HEADER", "X-API-Key")
+client_rate_limit: float = float(os.environ.get("CLIENT_RATE_LIMIT", "0"))
+client_rate_burst: float = float(os.environ.get("CLIENT_RATE_BURST", "100"))
+
+# The API key and token subject are not checked, so all the clients of an IP address together can also be limited to CLIENT_IP_RATE_LIMIT requests per second
+# with bursts of up to CLIENT_IP_RATE_BURST, 0 (the default) turns this off. Behind a load balancer or NAT it is shared by everyone, so set it well above the client limit
+client_ip_rate_limit: float = float(os.environ.get("CLIENT_IP_RATE_LIMIT", "0"))
+client_ip_rate_burst: float = float(os.environ.get("CLIENT_IP_RATE_BURST", "1000"))
+
+# strict validates every search Bundle against the fhir.resources models, sampled validates 1 in VALIDATION_SAMPLE_RATE in the background and only logs failures, off skips it
+validation_mode: str = os.environ.get("VALIDATION_MODE", "strict").lower()
+validation_sample_rate: int = max(int(os.environ.get("VALIDATION_SAMPLE_RATE", "100")), 1)
+
+if validation_mode not in ("strict", "sampled", "off"):
+    logger.error(f"Unknown VALIDATION_MODE {validation_mode}, using strict")
+    validation_mode = "strict"
@@ -0,0 +1,62 @@
+"""File for validating responses from the FHIR server against the fhir.resources models according to VALIDATION_MODE"""
+
+import asyncio
+import itertools
+import logging
+
+from fastapi.concurrency import run_in_threadpool
+from fhir.resources.R4B import get_fhir_model_class
+from fhir.resources.R4B.fhirresourcemodel import FHIRResourceModel
+from pydantic import ValidationError
+
+import metrics
+from util import validation_mode, validation_sample_rate
+
+logger: logging.Logger = logging.getLogger("main.validation")
+
+sample_counter: itertools.count = itertools.count()
+# Keeps a reference to background validations so they are not garbage collected before they finish
+background_validations: set[asyncio.Task] = set()
+
+
+def validate_resource(resource_type: str, resource_json: dict) -> FHIRResourceModel:
+    """Validates a resource or Bundle whatever the mode, for callers like filtering that need the model"""
+
+    try:
+        model: FHIRResourceModel = get_fhir_model_class(resource_json["resourceType"]).model_validate(resource_json)
+    except ValidationError:
+        metrics.validations.labels(resource_type=resource_type, result="failed").inc()
+        raise
+    metrics.validations.labels(resource_type=resource_type, result="passed").inc()
+    return model
+
+
+async def validate_strict(resource_type: str, resource_json: dict) -> None:
+    """Validates in strict mode, raising ValidationError so the response is replaced by an OperationOutcome"""
+
+    if validation_mode == "strict":
+        await run_in_threadpool(validate_resource, resource_type, resource_json)
+
+
+async def validate_in_background(resource_type: str, resource_json: dict) -> None:
+    try:
+        await run_in_threadpool(validate_resource, resource_type, resource_json)
+    except ValidationError as err:
+        logger.error(f"A sampled {resource_type} response failed FHIR validation and was returned anyway: {err}")
+
+
+def validate_sampled(resource_type: str, resource_json: dict) -> None:
+    """
+    Validates 1 in VALIDATION_SAMPLE_RATE responses in sampled mode without holding up the response, failures are only logged
+
+    Call this once the response will no longer be changed, since the validation reads it from another thread.
+    """
+
+    if validation_mode == "strict":
+        return
+    if validation_mode == "sampled" and next(sample_counter) % validation_sample_rate == 0:
+        task: asyncio.Task = asyncio.create_task(validate_in_background(resource_type, resource_json))
+        background_validations.add(task)
+        task.add_done_callback(background_validations.discard)
+        return
+    metrics.validations.labels(resource_type=resource_type, result="skipped").inc()